@@ -0,0 +1,482 @@
+#!/usr/bin/python
+
+# Benchmarks for realitykeysdemo.py, using the same keys and transactions as test.py.
+#
+# Time makekeys, setup and claim, fetching facts from a local stand-in for the Reality Keys API:
+#    ./benchmark.py stages
+# Each stage is run in its own process, so the peak memory reported is for that stage alone.
+# Save the results with --json --output results.json, and check a later version against them with --baseline results.json.
+#
+# Compare the elliptic curve backends in ecbackend.py, including checking a signature as verify.py does:
+#    ./benchmark.py ec
+#
+# Time coin selection for an address with thousands of unspent outputs:
+#    ./benchmark.py coinselect
+#
+# Time loading a big UTXO dump with --inputs-file, and how much memory it takes:
+#    ./benchmark.py inputs --rows 1000000
+#
+# Time running realitykeysdemo.py from the shell, starting a fresh interpreter each time, as scripts calling it do:
+#    ./benchmark.py startup
+# This takes --baseline and --tolerance too.
+# Add --json to get the results as JSON instead of a table.
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import resource
+import argparse
+import platform
+import multiprocessing
+
+import simplejson
+
+from pybitcointools import address_to_script, pubtoaddr, sha256, txhash
+
+import ecbackend
+import coinselect
+import utxoindex
+import realitykeysdemo
+from factclient import FactClient
+from lrucache import LRUCache
+from rawtx import RawTransaction
+from verify import Verifier
+from standin import FactServer
+from test import RealityKeysDemoTestCast as fixtures, decided_facts
+
+DEFAULT_ITERATIONS = 100
+DEFAULT_OUTPUTS = 5000
+DEFAULT_ROWS = 100000
+DEFAULT_STARTUP_ITERATIONS = 20
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'realitykeysdemo.py')
+
+def percentile(sorted_values, pct):
+    """Return the value pct percent of the way through a sorted list.
+    """
+    if len(sorted_values) == 0:
+        return None
+    i = int(round((len(sorted_values) - 1) * pct / 100.0))
+    return sorted_values[i]
+
+def measure(func, iterations):
+    """Call func iterations times, and return a dictionary of the ops per second and the p50 and p99 latencies in milliseconds.
+    """
+    latencies = []
+    start = time.time()
+    for i in range(iterations):
+        t = time.time()
+        func()
+        latencies.append(time.time() - t)
+    total = time.time() - start
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total > 0 else None,
+        'mean_ms': total * 1000 / iterations,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000
+    }
+
+def benchmark_facts():
+    """Return the facts for the stand-in server: the real ones used in test.py, which only have their public keys,
+    and some decided ones with keys we know, so we can claim them.
+    """
+    facts = {}
+    for reality_key_id, fact_json in fixtures.facts.items():
+        facts[reality_key_id] = dict(fact_json, winner=None, winner_privkey=None)
+    facts.update(decided_facts())
+    return facts
+
+def claim_inputs(api_url, ecc_voodoo):
+    """Set up a contract on fact 101, which we can claim, with the inputs used in test.py, and return the inputs to claim it with.
+    """
+    inputs = fixtures.ecc_inputs if ecc_voodoo else fixtures.normal_inputs_yes_wins
+    tx = None
+    for seed in [fixtures.alice_seed, fixtures.bob_seed]:
+        settings = {'testnet': True, 'no_pushtx': True, 'api_url': api_url, 'seed': seed, 'inputs': inputs, 'ecc_voodoo': ecc_voodoo}
+        tx = realitykeysdemo.execute_setup(settings, '101', fixtures.alice_pub, 90000, fixtures.bob_pub, 90000, tx)[0]
+    return [':' + txhash(tx) + ':0:180000']
+
+def stage_functions(api_url):
+    """Return a list of (name, function) for each of the stages to benchmark.
+
+    Each function takes a flag saying whether to run cold, with empty caches, or warm, reusing caches from earlier runs.
+    """
+
+    def settings(cold, **kwargs):
+        s = {'testnet': True, 'no_pushtx': True, 'api_url': api_url}
+        if cold:
+            s['fact_client'] = FactClient(api_url, retries=0)
+            s['script_cache'] = LRUCache()
+        s.update(kwargs)
+        return s
+
+    def setup(cold, seed, inputs, ecc_voodoo, reality_key_id, existing_tx):
+        return realitykeysdemo.execute_setup(settings(cold, seed=seed, inputs=inputs, ecc_voodoo=ecc_voodoo), reality_key_id, fixtures.alice_pub, 90000, fixtures.bob_pub, 90000, existing_tx)[0]
+
+    def claim(cold, inputs, ecc_voodoo):
+        return realitykeysdemo.execute_claim(settings(cold, seed=fixtures.alice_seed, inputs=inputs, ecc_voodoo=ecc_voodoo), '101', fixtures.alice_pub, fixtures.bob_pub, 10000)[0]
+
+    # Replay the setups in test.py once, to check we still get the same transactions, and to get the half-signed ones to complete.
+    half_signed = {}
+    for ecc_voodoo, inputs, expected in [(False, fixtures.normal_inputs_yes_wins, fixtures.normal_claimable_tx_yes_wins), (True, fixtures.ecc_inputs, fixtures.ecc_claimable_tx)]:
+        half_signed[ecc_voodoo] = setup(True, fixtures.alice_seed, inputs, ecc_voodoo, fixtures.yes_fact_id, None)
+        if setup(True, fixtures.bob_seed, inputs, ecc_voodoo, fixtures.yes_fact_id, half_signed[ecc_voodoo]) != expected:
+            raise Exception("Setup no longer makes the same transaction as it did in test.py, so there's no point benchmarking it.")
+
+    # Set up contracts on a fact we can claim, with the same inputs.
+    inputs_to_claim = dict((ecc_voodoo, claim_inputs(api_url, ecc_voodoo)) for ecc_voodoo in [False, True])
+
+    return [
+        ('makekeys', lambda cold: realitykeysdemo.execute_makekeys(settings(cold, seed=fixtures.alice_seed))),
+        ('setup_half_signed', lambda cold: setup(cold, fixtures.alice_seed, fixtures.normal_inputs_yes_wins, False, fixtures.yes_fact_id, None)),
+        ('setup_complete', lambda cold: setup(cold, fixtures.bob_seed, fixtures.normal_inputs_yes_wins, False, fixtures.yes_fact_id, half_signed[False])),
+        ('setup_half_signed_ecc', lambda cold: setup(cold, fixtures.alice_seed, fixtures.ecc_inputs, True, fixtures.yes_fact_id, None)),
+        ('setup_complete_ecc', lambda cold: setup(cold, fixtures.bob_seed, fixtures.ecc_inputs, True, fixtures.yes_fact_id, half_signed[True])),
+        ('claim', lambda cold: claim(cold, inputs_to_claim[False], False)),
+        ('claim_ecc', lambda cold: claim(cold, inputs_to_claim[True], True)),
+    ]
+
+def _run_stage(func, iterations, cold, queue):
+    result = measure(lambda: func(cold), iterations)
+    # On Linux this is in kilobytes.
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put(result)
+
+def run_stage(func, iterations, cold):
+    """Measure a stage in a process of its own, so its peak memory isn't mixed up with the others.
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_stage, args=(func, iterations, cold, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def benchmark_stages(iterations, cold=False, only=None):
+    """Time each stage against a local fact server, returning the results as a dictionary.
+    """
+    server = FactServer(benchmark_facts()).start()
+    try:
+        results = {
+            'iterations': iterations,
+            'cold': cold,
+            'python': platform.python_version(),
+            'ec_backend': ecbackend.get_backend().name,
+            'timestamp': int(time.time()),
+            'stages': {}
+        }
+        for name, func in stage_functions(server.api_url):
+            if only and name not in only:
+                continue
+            results['stages'][name] = run_stage(func, iterations, cold)
+        results['fact_requests'] = server.requests
+    finally:
+        server.stop()
+    return results
+
+def format_stages(results):
+    lines = ["%-24s %12s %10s %10s %14s" % ('stage', 'ops/sec', 'p50 ms', 'p99 ms', 'peak rss kb')]
+    for name in sorted(results['stages'].keys()):
+        m = results['stages'][name]
+        lines.append("%-24s %12.1f %10.3f %10.3f %14d" % (name, m['ops_per_sec'], m['p50_ms'], m['p99_ms'], m['peak_rss_kb']))
+    return lines
+
+def compare(results, baseline, tolerance):
+    """Compare the ops per second of each stage with a baseline, returning lines describing them and whether any regressed.
+    """
+    lines = []
+    regressed = False
+    for name in sorted(results['stages'].keys()):
+        if name not in baseline.get('stages', {}):
+            continue
+        ratio = results['stages'][name]['ops_per_sec'] / baseline['stages'][name]['ops_per_sec']
+        status = 'ok'
+        if ratio < 1 - tolerance:
+            status = 'REGRESSION'
+            regressed = True
+        lines.append("%-24s %6.2fx of baseline %s" % (name, ratio, status))
+    return lines, regressed
+
+def startup_commands(api_url):
+    """Return a list of (name, command line) for each of the commands to time starting up.
+
+    python and import show how much of the time goes on starting the interpreter, and on loading realitykeysdemo.py.
+    """
+    common = ['-q', '-t', '-P', '--api-url', api_url]
+    def inputs_args(inputs):
+        return sum([['-i', i] for i in inputs], [])
+    return [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('import', [sys.executable, '-c', 'import realitykeysdemo']),
+        ('makekeys', [sys.executable, SCRIPT, 'makekeys', '-q', '-t', '--seed', fixtures.alice_seed]),
+        ('setup', [sys.executable, SCRIPT, 'setup', str(fixtures.yes_fact_id), fixtures.alice_pub, '90000', fixtures.bob_pub, '90000', '--seed', fixtures.alice_seed] + common + inputs_args(fixtures.normal_inputs_yes_wins)),
+        ('claim', [sys.executable, SCRIPT, 'claim', '101', fixtures.alice_pub, fixtures.bob_pub, '-f', '10000', '--seed', fixtures.alice_seed] + common + inputs_args(claim_inputs(api_url, False))),
+    ]
+
+def run_command(command, iterations):
+    """Run a command line iterations times, each in a new process, returning the timings as measure does, and the peak memory of any run.
+    """
+    latencies = []
+    peak_rss_kb = 0
+    devnull = open(os.devnull, 'w')
+    cwd = os.path.dirname(SCRIPT)
+    try:
+        for i in range(iterations):
+            t = time.time()
+            process = subprocess.Popen(command, stdout=devnull, cwd=cwd)
+            # wait4 gives us the resource usage of this process alone, unlike getrusage(RUSAGE_CHILDREN).
+            pid, status, usage = os.wait4(process.pid, 0)
+            latencies.append(time.time() - t)
+            # We've reaped it ourselves, so Popen mustn't try to.
+            process.returncode = status
+            if status != 0:
+                raise Exception("%s exited with status %s" % (" ".join(command[:3]), os.WEXITSTATUS(status)))
+            # This counts from before the fork, so it's never less than the size of this process.
+            peak_rss_kb = max(peak_rss_kb, usage.ru_maxrss)
+    finally:
+        devnull.close()
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total > 0 else None,
+        'mean_ms': total * 1000 / iterations,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'peak_rss_kb': peak_rss_kb
+    }
+
+def benchmark_startup(iterations, only=None):
+    """Time each command from startup to exit against a local fact server, returning the results in the same form as benchmark_stages.
+    """
+    server = FactServer(benchmark_facts()).start()
+    try:
+        results = {
+            'iterations': iterations,
+            'python': platform.python_version(),
+            # Without compiled modules cached on disk, every run compiles them all again, which takes a good part of the time.
+            'dont_write_bytecode': bool(os.environ.get('PYTHONDONTWRITEBYTECODE', '')),
+            'timestamp': int(time.time()),
+            'stages': {}
+        }
+        for name, command in startup_commands(server.api_url):
+            if only and name not in only:
+                continue
+            results['stages'][name] = run_command(command, iterations)
+    finally:
+        server.stop()
+    return results
+
+def ec_operations():
+    """Return a list of (name, function taking a backend) for the EC operations done by setup and claim.
+    """
+    alice_priv = sha256(fixtures.alice_seed)
+    yes_reality_key = fixtures.facts['3']['yes_pubkey']
+    winner_privkey = sha256('yes-3')
+
+    def claim_check(backend):
+        # What an ECC voodoo claim does: make the compound private key and check it matches the compound public key.
+        backend.privtopub(backend.add_privkeys(alice_priv, winner_privkey))
+
+    # What completing a setup does to check the other party's signature, with nothing cached.
+    setup_tx = RawTransaction.from_hex(fixtures.normal_claimable_tx_yes_wins)
+    bob_script = address_to_script(pubtoaddr(fixtures.bob_pub, 111)).decode('hex')
+    def verify_signature(backend):
+        if not Verifier(backend).is_valid(setup_tx, 1, bob_script):
+            raise Exception("The signature in test.py's setup transaction didn't verify.")
+
+    return [
+        ('privtopub', lambda backend: backend.privtopub(alice_priv)),
+        ('add_pubkeys', lambda backend: backend.add_pubkeys(fixtures.alice_pub, yes_reality_key)),
+        ('add_privkeys', lambda backend: backend.add_privkeys(alice_priv, winner_privkey)),
+        ('claim_check', claim_check),
+        ('verify', verify_signature),
+    ]
+
+def benchmark_ec(iterations, backend_names=None):
+    """Time each EC operation with each backend, and work out how much faster each one is than pybitcointools.
+    """
+    if backend_names is None:
+        backend_names = sorted(ecbackend.BACKENDS.keys())
+
+    results = {'iterations': iterations, 'backends': {}, 'speedup': {}}
+    for name in backend_names:
+        try:
+            backend = ecbackend.get_backend(name)
+        except ImportError:
+            results['backends'][name] = None
+            continue
+        # Warm up, so the table backend builds its table outside the timings.
+        backend.privtopub(1)
+        results['backends'][name] = dict((op, measure(lambda: func(backend), iterations)) for op, func in ec_operations())
+
+    baseline = results['backends'].get('pybitcointools', None)
+    if baseline is not None:
+        for name, ops in results['backends'].items():
+            if ops is None:
+                continue
+            results['speedup'][name] = dict((op, baseline[op]['mean_ms'] / ops[op]['mean_ms']) for op in ops)
+    return results
+
+def format_ec(results):
+    lines = ["%-16s %-14s %12s %10s %10s %8s" % ('backend', 'operation', 'ops/sec', 'p50 ms', 'p99 ms', 'speedup')]
+    for name in sorted(results['backends'].keys()):
+        ops = results['backends'][name]
+        if ops is None:
+            lines.append("%-16s (not available)" % (name))
+            continue
+        for op, _ in ec_operations():
+            m = ops[op]
+            speedup = results['speedup'].get(name, {}).get(op, None)
+            lines.append("%-16s %-14s %12.1f %10.3f %10.3f %8s" % (name, op, m['ops_per_sec'], m['p50_ms'], m['p99_ms'], "%.1fx" % speedup if speedup else ''))
+    return lines
+
+def benchmark_coinselect(iterations, num_outputs=DEFAULT_OUTPUTS):
+    """Time choosing outputs from an address with num_outputs of them, for targets that take each of the selection strategies.
+    """
+    # Made up, but deterministic, so runs can be compared.
+    outputs = [{'output': sha256(str(i)) + ':0', 'value': 1000 + int(sha256('value-' + str(i))[:8], 16) % 10000000} for i in range(num_outputs)]
+    total = sum([o['value'] for o in outputs])
+    selector = coinselect.CoinSelector(outputs)
+    largest = max([o['value'] for o in outputs])
+
+    targets = [
+        ('single', outputs[0]['value'] - 2000, 5000),
+        ('combination', largest + 1, 5000),
+        ('most_of_balance', total * 3 / 4, 0),
+    ]
+
+    results = {'iterations': iterations, 'outputs': num_outputs, 'operations': {}}
+    results['operations']['index'] = measure(lambda: coinselect.CoinSelector(outputs), iterations)
+    for name, target, max_excess in targets:
+        results['operations'][name] = measure(lambda: selector.select(target, max_excess), iterations)
+        selected, excess = selector.select(target, max_excess)
+        results['operations'][name].update({'inputs': len(selected), 'excess': excess})
+    return results
+
+def format_coinselect(results):
+    lines = ["%-18s %12s %10s %10s %8s %10s" % ('operation', 'ops/sec', 'p50 ms', 'p99 ms', 'inputs', 'excess')]
+    for name in sorted(results['operations'].keys()):
+        m = results['operations'][name]
+        lines.append("%-18s %12.1f %10.3f %10.3f %8s %10s" % (name, m['ops_per_sec'], m['p50_ms'], m['p99_ms'], m.get('inputs', ''), m.get('excess', '')))
+    return lines
+
+def _load_inputs(filename, queue):
+    start = time.time()
+    index = utxoindex.UTXOIndex()
+    rows = utxoindex.load_inputs_file(index, filename)
+    seconds = time.time() - start
+    lookups = measure(lambda: index.find('address-1', 50000000), DEFAULT_ITERATIONS)
+    queue.put({
+        'rows': rows,
+        'load_seconds': seconds,
+        'rows_per_sec': rows / seconds if seconds > 0 else None,
+        'find': lookups,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    })
+
+def benchmark_inputs(rows=DEFAULT_ROWS, addresses=None):
+    """Write a made-up UTXO dump as CSV, then time loading it into a UTXOIndex in a fresh process, and finding outputs in it.
+    """
+    if addresses is None:
+        addresses = max(1, rows / 50)
+    fd, filename = tempfile.mkstemp('.csv')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write("address,txid,vout,value\n")
+            for i in xrange(rows):
+                f.write("address-%d,%s,%d,%d\n" % (i % addresses, sha256(str(i)), i % 4, 1000 + (i * 7919) % 100000000))
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_load_inputs, args=(filename, queue))
+        process.start()
+        results = queue.get()
+        process.join()
+    finally:
+        os.unlink(filename)
+    results['addresses'] = addresses
+    return results
+
+def format_inputs(results):
+    return [
+        "Loaded %d outputs for %d addresses in %.2f seconds (%.0f rows/sec)" % (results['rows'], results['addresses'], results['load_seconds'], results['rows_per_sec']),
+        "Peak memory: %d kb" % (results['peak_rss_kb']),
+        "Finding an output: p50 %.3f ms, p99 %.3f ms" % (results['find']['p50_ms'], results['find']['p99_ms']),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of realitykeysdemo.py.')
+    subparsers = parser.add_subparsers(dest='command')
+    stages_parser = subparsers.add_parser('stages', help='Time makekeys, setup and claim against a local fact server.')
+    ec_parser = subparsers.add_parser('ec', help='Compare the elliptic curve backends.')
+    coinselect_parser = subparsers.add_parser('coinselect', help='Time coin selection for an address with many unspent outputs.')
+    inputs_parser = subparsers.add_parser('inputs', help='Time loading a big UTXO dump, as done by --inputs-file.')
+    startup_parser = subparsers.add_parser('startup', help='Time running realitykeysdemo.py commands in a fresh process each time.')
+
+    for p in [startup_parser]:
+        p.add_argument( '-n', '--iterations', type=int, required=False, default=DEFAULT_STARTUP_ITERATIONS, help='How many times to run each command.')
+
+    for p in [inputs_parser]:
+        p.add_argument( '--rows', type=int, required=False, default=DEFAULT_ROWS, help='How many outputs to put in the dump.')
+        p.add_argument( '--json', required=False, action='store_true', help='Output the results as JSON.')
+        p.add_argument( '-o', '--output', required=False, help='Write the results to this file as well as to the screen.')
+
+    for p in [coinselect_parser]:
+        p.add_argument( '--outputs', type=int, required=False, default=DEFAULT_OUTPUTS, help='How many unspent outputs the address has.')
+
+    for p in [stages_parser]:
+        p.add_argument( '--cold', required=False, action='store_true', help='Start each run with empty caches.')
+
+    for p in [stages_parser, startup_parser]:
+        p.add_argument( 'only', nargs='*', help='The stages to run. Defaults to all of them.')
+        p.add_argument( '--baseline', required=False, help='A JSON file of earlier results to compare against. Exits with status 1 if any stage got slower.')
+        p.add_argument( '--tolerance', type=float, required=False, default=0.2, help='How much slower than the baseline a stage can get before it counts as a regression.')
+
+    for p in [stages_parser, ec_parser, coinselect_parser]:
+        p.add_argument( '-n', '--iterations', type=int, required=False, default=DEFAULT_ITERATIONS, help='How many times to run each operation.')
+
+    for p in [stages_parser, ec_parser, coinselect_parser, startup_parser]:
+        p.add_argument( '--json', required=False, action='store_true', help='Output the results as JSON.')
+        p.add_argument( '-o', '--output', required=False, help='Write the results to this file as well as to the screen.')
+
+    args = parser.parse_args()
+
+    regressed = False
+    if args.command in ['stages', 'startup']:
+        if args.command == 'stages':
+            results = benchmark_stages(args.iterations, args.cold, args.only)
+        else:
+            results = benchmark_startup(args.iterations, args.only)
+        lines = format_stages(results)
+        if args.baseline:
+            with open(args.baseline, 'r') as f:
+                comparison, regressed = compare(results, simplejson.load(f), args.tolerance)
+            lines = lines + [""] + comparison
+    elif args.command == 'ec':
+        results = benchmark_ec(args.iterations)
+        lines = format_ec(results)
+    elif args.command == 'coinselect':
+        results = benchmark_coinselect(args.iterations, args.outputs)
+        lines = format_coinselect(results)
+    elif args.command == 'inputs':
+        results = benchmark_inputs(args.rows)
+        lines = format_inputs(results)
+
+    if args.json:
+        output = simplejson.dumps(results, indent=2, sort_keys=True)
+    else:
+        output = "\n".join(lines)
+    print output
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+    if regressed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+# Coin selection: choose which of an address's unspent outputs to spend to make up an amount.
+#
+# Both parties to a contract make the setup transaction independently and check they got the same thing,
+# so the selection has to be deterministic: the same outputs and target always give the same choice.
+# There is no randomness here, unlike the knapsack solver in bitcoind.
+#
+# We try, in order:
+#    A single output, the smallest one big enough that doesn't overshoot by more than max_excess.
+#    Branch-and-bound over combinations of outputs, looking for a total that doesn't overshoot by more than max_excess, so no change is needed.
+#    A knapsack-style fallback that gets as close as it can, leaving change.
+# The outputs are sorted by value once, when the CoinSelector is made, and searched with bisect,
+# and branch-and-bound gives up after a fixed number of tries, so selection stays fast for addresses with thousands of outputs.
+
+from bisect import bisect_left, bisect_right
+
+# How many steps branch-and-bound can take before we fall back to the knapsack.
+MAX_TRIES = 1000
+
+class CoinSelector(object):
+    """Choose outputs to spend from a list of unspent outputs, as returned by unspent_outputs.
+
+    Each output is a dictionary with at least 'output' (txid:n) and 'value'.
+    """
+
+    def __init__(self, outputs, max_tries=MAX_TRIES):
+        self.max_tries = max_tries
+        # Outputs of the same value are kept in the order they came in, so given the same list we'll always choose the same ones.
+        self._outputs = list(outputs)
+        # _order[i] is the position in outputs of the i-th smallest.
+        self._order = sorted(range(len(self._outputs)), key=lambda i: self._outputs[i]['value'])
+        self._values = [self._outputs[i]['value'] for i in self._order]
+        # _below[i] is the total of the outputs smaller than the i-th.
+        self._below = [0]
+        for v in self._values:
+            self._below.append(self._below[-1] + v)
+        self.total = self._below[-1]
+
+    def __len__(self):
+        return len(self._outputs)
+
+    def select(self, target, max_excess=0):
+        """Return a list of outputs adding up to at least target, and how much they go over it by, or (None, 0) if we can't.
+
+        If possible the excess will be no more than max_excess, so that it can go to the fee instead of needing change.
+        The outputs are returned in the order they came in.
+        """
+        if target <= 0 or self.total < target:
+            return None, 0
+
+        # A single output in the range, which is what we used to insist on.
+        i = bisect_left(self._values, target)
+        if i < len(self._values) and self._values[i] <= target + max_excess:
+            return self._result([i], target)
+
+        # Only outputs no bigger than target + max_excess can be part of a combination that doesn't overshoot.
+        n = bisect_right(self._values, target + max_excess)
+        selected = self._branch_and_bound(n, target, max_excess)
+        if selected is None:
+            selected = self._knapsack(target)
+        return self._result(selected, target)
+
+    def _result(self, indexes, target):
+        outputs = [self._outputs[j] for j in sorted([self._order[i] for i in indexes])]
+        return outputs, sum([o['value'] for o in outputs]) - target
+
+    def _branch_and_bound(self, n, target, max_excess):
+        """Search combinations of the first n outputs, largest first, for the one that overshoots target least, within max_excess.
+        """
+        values = self._values
+        below = self._below
+        if below[n] < target:
+            return None
+
+        best = None
+        best_excess = None
+        selected = []
+        total = 0
+        # The outputs still to be considered are the ones before m, and the next is the largest of them.
+        m = n
+        for tries in xrange(self.max_tries):
+            if total + below[m] < target or total > target + max_excess:
+                backtrack = True
+            elif total >= target:
+                if best is None or total - target < best_excess:
+                    best = list(selected)
+                    best_excess = total - target
+                    if best_excess == 0:
+                        break
+                backtrack = True
+            else:
+                backtrack = False
+
+            if backtrack:
+                if len(selected) == 0:
+                    break
+                # Try again without the last output we added, and without any of the same value, as they'd give the same totals.
+                j = selected.pop()
+                total = total - values[j]
+                m = j
+                while m > 0 and values[m - 1] == values[j]:
+                    m = m - 1
+                continue
+
+            m = m - 1
+            selected.append(m)
+            total = total + values[m]
+
+        return best
+
+    def _knapsack(self, target):
+        """Get as close to the target as we can, preferring a single output if it's as close as a combination.
+        """
+        values = self._values
+        i = bisect_left(values, target)
+        single = [i] if i < len(values) else None
+
+        # Take the outputs smaller than the target, largest first, until a single one of those left can make up the rest...
+        combination = None
+        if self._below[i] >= target:
+            total = 0
+            k = i
+            while total < target:
+                # The largest of those left is values[k - 1], so only look for one if that's big enough.
+                if values[k - 1] >= target - total:
+                    j = bisect_left(values, target - total, 0, k)
+                    combination = range(k, i) + [j]
+                    total = total + values[j]
+                    break
+                k = k - 1
+                total = total + values[k]
+            if combination is None:
+                combination = range(k, i)
+            # ...then drop any we turn out not to need, smallest first.
+            needed = []
+            for j in sorted(combination):
+                if total - values[j] >= target:
+                    total = total - values[j]
+                else:
+                    needed.append(j)
+            combination = needed
+
+        if combination is None:
+            return single
+        if single is None:
+            return combination
+        if values[single[0]] <= sum([values[j] for j in combination]):
+            return single
+        return combination
+
+def select_coins(outputs, target, max_excess=0):
+    """Choose outputs adding up to at least target, returning them and the excess, or (None, 0) if there isn't enough.
+    """
+    return CoinSelector(outputs).select(target, max_excess)
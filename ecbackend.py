@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+# Elliptic curve backends for the key arithmetic done by realitykeysdemo.py: add_pubkeys, add_privkeys and privtopub.
+# They all take and return keys in the same formats as the pybitcointools functions of the same names, and give the same results.
+# They can also check ECDSA signatures, for verify.py.
+#
+# PybitcointoolsBackend just calls pybitcointools, which does everything in pure Python with a fresh double-and-add for each multiplication.
+# TableBackend is also pure Python, but multiplies the generator using a table of precomputed multiples,
+# adds points in Jacobian coordinates, and uses the built-in pow for modular inverses.
+# Secp256k1Backend uses libsecp256k1 through the coincurve module, if it is installed.
+#
+# Run ./benchmark.py ec to compare them.
+
+from pybitcointools import P, N, G, get_pubkey_format, decode_pubkey, encode_pubkey, get_privkey_format, decode_privkey, encode_privkey, decode, der_encode_sig
+import pybitcointools
+
+from lrucache import LRUCache
+
+# Multiply the generator 4 bits at a time, so the table has 64 rows of 16 points.
+WINDOW_BITS = 4
+
+# How many decoded public keys to remember.
+POINT_CACHE_SIZE = 10000
+
+class PybitcointoolsBackend(object):
+    """Do the arithmetic with pybitcointools.
+    """
+
+    name = 'pybitcointools'
+
+    def add_pubkeys(self, p1, p2):
+        return pybitcointools.add_pubkeys(p1, p2)
+
+    def add_privkeys(self, p1, p2):
+        return pybitcointools.add_privkeys(p1, p2)
+
+    def privtopub(self, priv):
+        return pybitcointools.privtopub(priv)
+
+    def verify(self, msghash, r, s, pub):
+        """Return True if (r, s) is a valid signature of the 32-byte hash by the public key.
+
+        r and s should already have been checked to be between 1 and N - 1.
+        """
+        return pybitcointools.ecdsa_raw_verify(msghash, (None, r, s), pub)
+
+def _inv(a):
+    return pow(a, P - 2, P)
+
+def _to_affine(p):
+    x, y, z = p
+    if z == 0:
+        return None
+    zinv = _inv(z)
+    zinv2 = zinv * zinv % P
+    return (x * zinv2 % P, y * zinv2 * zinv % P)
+
+def _jacobian_double(p):
+    x, y, z = p
+    if y == 0 or z == 0:
+        return (0, 0, 0)
+    ysq = y * y % P
+    s = 4 * x * ysq % P
+    m = 3 * x * x % P
+    nx = (m * m - 2 * s) % P
+    ny = (m * (s - nx) - 8 * ysq * ysq) % P
+    nz = 2 * y * z % P
+    return (nx, ny, nz)
+
+def _jacobian_add_affine(p, q):
+    """Add the affine point q to the Jacobian point p.
+    """
+    x1, y1, z1 = p
+    if z1 == 0:
+        return (q[0], q[1], 1)
+    z1sq = z1 * z1 % P
+    u2 = q[0] * z1sq % P
+    s2 = q[1] * z1sq * z1 % P
+    if u2 == x1:
+        if s2 == y1:
+            return _jacobian_double(p)
+        return (0, 0, 0)
+    h = (u2 - x1) % P
+    r = (s2 - y1) % P
+    hsq = h * h % P
+    hcu = hsq * h % P
+    x1hsq = x1 * hsq % P
+    nx = (r * r - hcu - 2 * x1hsq) % P
+    ny = (r * (x1hsq - nx) - y1 * hcu) % P
+    nz = h * z1 % P
+    return (nx, ny, nz)
+
+def _multiply(point, n):
+    """Return n times an affine point, as an affine point, or None for the point at infinity.
+    """
+    result = (0, 0, 0)
+    for bit in bin(n)[2:]:
+        result = _jacobian_double(result)
+        if bit == '1':
+            result = _jacobian_add_affine(result, point)
+    return _to_affine(result)
+
+def _affine_add(a, b):
+    if a[0] == b[0]:
+        if (a[1] + b[1]) % P == 0:
+            raise Exception("The public keys added up to the point at infinity.")
+        m = 3 * a[0] * a[0] * _inv(2 * a[1]) % P
+    else:
+        m = (b[1] - a[1]) * _inv((b[0] - a[0]) % P) % P
+    x = (m * m - a[0] - b[0]) % P
+    y = (m * (a[0] - x) - a[1]) % P
+    return (x, y)
+
+class TableBackend(object):
+    """Do the arithmetic in pure Python, using a precomputed table of multiples of the generator.
+
+    The table is built the first time it's needed, which takes a few tens of milliseconds.
+    Decoded public keys are cached, as decompressing a compressed key is as slow as the addition itself,
+    and the same reality keys and user keys turn up again and again in a batch.
+    """
+
+    name = 'table'
+
+    def __init__(self):
+        self._table = None
+        self._points = LRUCache(POINT_CACHE_SIZE)
+
+    def _decode_pubkey(self, pub, formt):
+        point = self._points.get(pub)
+        if point is None:
+            point = decode_pubkey(pub, formt)
+            self._points.put(pub, point)
+        return point
+
+    def _build_table(self):
+        table = []
+        base = (G[0], G[1], 1)
+        for i in range(256 / WINDOW_BITS):
+            row = [None]
+            point = base
+            for d in range(1, 2 ** WINDOW_BITS):
+                row.append(_to_affine(point))
+                point = _jacobian_add_affine(point, row[1])
+            table.append(row)
+            # The next row starts from 2^WINDOW_BITS times this one.
+            for j in range(WINDOW_BITS):
+                base = _jacobian_double(base)
+        self._table = table
+
+    def multiply_generator(self, n):
+        """Return n times the generator, as an affine point.
+        """
+        if self._table is None:
+            self._build_table()
+        mask = 2 ** WINDOW_BITS - 1
+        point = (0, 0, 0)
+        i = 0
+        while n > 0:
+            d = n & mask
+            if d:
+                point = _jacobian_add_affine(point, self._table[i][d])
+            n = n >> WINDOW_BITS
+            i = i + 1
+        return _to_affine(point)
+
+    def add_pubkeys(self, p1, p2):
+        f1, f2 = get_pubkey_format(p1), get_pubkey_format(p2)
+        return encode_pubkey(_affine_add(self._decode_pubkey(p1, f1), self._decode_pubkey(p2, f2)), f1)
+
+    def add_privkeys(self, p1, p2):
+        f1, f2 = get_privkey_format(p1), get_privkey_format(p2)
+        return encode_privkey((decode_privkey(p1, f1) + decode_privkey(p2, f2)) % N, f1)
+
+    def privtopub(self, priv):
+        f = get_privkey_format(priv)
+        n = decode_privkey(priv, f)
+        if n == 0 or n >= N:
+            raise Exception("Invalid privkey")
+        return encode_pubkey(self.multiply_generator(n), f.replace('wif', 'hex'))
+
+    def verify(self, msghash, r, s, pub):
+        q = self._decode_pubkey(pub, get_pubkey_format(pub))
+        w = pow(s, N - 2, N)
+        u1 = decode(msghash, 256) * w % N
+        u2 = r * w % N
+        a = self.multiply_generator(u1)
+        b = _multiply(q, u2)
+        if a is None or b is None:
+            point = a or b
+        else:
+            try:
+                point = _affine_add(a, b)
+            except Exception:
+                # The point at infinity, which can't be a signature.
+                return False
+        return point is not None and point[0] % N == r
+
+class Secp256k1Backend(TableBackend):
+    """Do the arithmetic with libsecp256k1, through the coincurve module.
+
+    Private key addition is cheap, so it's inherited from TableBackend.
+    """
+
+    name = 'secp256k1'
+
+    def __init__(self):
+        TableBackend.__init__(self)
+        import coincurve
+        self._coincurve = coincurve
+
+    def _public_key(self, pub):
+        return self._coincurve.PublicKey(encode_pubkey(pub, 'bin'))
+
+    def _encode(self, public_key, formt):
+        pub = public_key.format(compressed=False)
+        return encode_pubkey(pub, formt)
+
+    def add_pubkeys(self, p1, p2):
+        f1 = get_pubkey_format(p1)
+        combined = self._coincurve.PublicKey.combine_keys([self._public_key(p1), self._public_key(p2)])
+        return self._encode(combined, f1)
+
+    def privtopub(self, priv):
+        f = get_privkey_format(priv)
+        n = decode_privkey(priv, f)
+        if n == 0 or n >= N:
+            raise Exception("Invalid privkey")
+        public_key = self._coincurve.PublicKey.from_secret(encode_privkey(n, 'bin'))
+        return self._encode(public_key, f.replace('wif', 'hex'))
+
+    def verify(self, msghash, r, s, pub):
+        # libsecp256k1 only accepts signatures with the lower of the two possible values of s, which pybitcointools doesn't always make.
+        # Either is valid, so use the lower one.
+        if s > N / 2:
+            s = N - s
+        sig = der_encode_sig(None, r, s).decode('hex')
+        try:
+            return self._coincurve.PublicKey(encode_pubkey(pub, 'bin')).verify(sig, msghash, hasher=None)
+        except ValueError:
+            return False
+
+BACKENDS = {
+    'pybitcointools': PybitcointoolsBackend,
+    'table': TableBackend,
+    'secp256k1': Secp256k1Backend,
+}
+
+_backends = {}
+
+def get_backend(name=None):
+    """Return the named backend, creating it the first time it's asked for.
+
+    If no name is given, return the fastest one available: secp256k1 if coincurve is installed, otherwise table.
+    """
+    if name is None:
+        if None not in _backends:
+            try:
+                _backends[None] = get_backend('secp256k1')
+            except ImportError:
+                _backends[None] = get_backend('table')
+        return _backends[None]
+    if name not in _backends:
+        if name not in BACKENDS:
+            raise Exception("Unknown EC backend \"%s\", expected one of %s." % (name, ", ".join(sorted(BACKENDS.keys()))))
+        _backends[name] = BACKENDS[name]()
+    return _backends[name]
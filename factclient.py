@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+# A client for fetching facts from the Reality Keys API, used by realitykeysdemo.py.
+# It keeps HTTP connections open between requests, retries requests that fail for reasons that may pass, and remembers the parts of a fact that can't change:
+# The public keys never change once a fact has been created, and once the winning private key has been published nothing else will change either.
+# The transport that actually makes the requests can be replaced, eg to talk to a local stub server, or to return canned responses in tests.
+#
+# Where there's a stream of fact resolutions to follow, like the one standin.FactServer serves, FactEvents follows it by long polling,
+# so a process waiting on thousands of facts makes one request at a time, which the server answers when something is resolved,
+# instead of polling each fact. The facts it hears about go in the FactClient's cache, so claiming them doesn't fetch them again.
+
+import time
+import socket
+import urllib
+import httplib
+import urlparse
+import threading
+
+import simplejson
+
+# How long to ask the server to hold a request for events open, in seconds, if nothing is resolved.
+DEFAULT_EVENT_WAIT = 25
+
+class HTTPError(Exception):
+    """A response other than a 200, keeping the status and body, which some APIs use to explain what went wrong.
+    """
+
+    def __init__(self, status, body, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.body = body
+
+def is_transient(e):
+    """Return True if a request that failed with the exception might work if we tried it again:
+    if we couldn't talk to the server, or it had a problem of its own, but not if it told us we asked for the wrong thing.
+    """
+    if isinstance(e, HTTPError):
+        return e.status >= 500
+    return isinstance(e, (httplib.HTTPException, socket.error))
+
+class HTTPTransport(object):
+    """Fetch URLs over HTTP or HTTPS, keeping a connection open to each host for each thread so it can be reused.
+    """
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self, scheme, netloc):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = {}
+            self._local.connections = connections
+
+        conn = connections.get((scheme, netloc), None)
+        if conn is None:
+            if scheme == 'https':
+                conn = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = conn
+        return conn
+
+    def _discard(self, scheme, netloc):
+        conn = self._local.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def get(self, url):
+        """Return the body of the response to a GET request for the url, or raise an Exception if it wasn't a 200.
+        """
+        return self.request('GET', url)
+
+    def post(self, url, body, headers=None):
+        """Return the body of the response to a POST of body to the url, or raise an Exception if it wasn't a 200.
+        """
+        return self.request('POST', url, body, headers)
+
+    def request(self, method, url, body=None, headers=None):
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        all_headers = {'Accept': 'application/json', 'Connection': 'keep-alive'}
+        all_headers.update(headers or {})
+
+        # A connection we kept open may have been closed by the server since we last used it.
+        # If so the first attempt will fail, and we'll try again once with a new connection.
+        for attempt in [0, 1]:
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path, body, all_headers)
+                response = conn.getresponse()
+                response_body = response.read()
+            except (httplib.HTTPException, socket.error):
+                self._discard(parts.scheme, parts.netloc)
+                if attempt > 0:
+                    raise
+                continue
+
+            if response.getheader('connection', '').lower() == 'close':
+                self._discard(parts.scheme, parts.netloc)
+            if response.status != 200:
+                raise HTTPError(response.status, response_body, "Got HTTP status %s fetching %s" % (response.status, url))
+            return response_body
+
+class FactClient(object):
+    """Fetch facts from the Reality Keys API, caching whatever can't change and retrying failures.
+
+    api_url is the URL of a fact, with %s where the ID goes.
+    transport is anything with a get(url) method returning the body of the response. By default an HTTPTransport is used.
+    Failed requests are retried up to retries times, waiting backoff seconds before the first retry and doubling it each time.
+    Only connection errors and 5xx responses are retried. Others, like a 404 for a fact that doesn't exist, are raised straight away.
+    If a store is supplied, such as a factstore.FactStore, facts are looked up there before asking the API, and saved there when fetched.
+    """
+
+    def __init__(self, api_url, transport=None, retries=3, backoff=0.5, store=None):
+        self.api_url = api_url
+        if transport is None:
+            transport = HTTPTransport()
+        self.transport = transport
+        self.retries = retries
+        self.backoff = backoff
+        self.store = store
+
+        # The last version of each fact we saw. The public keys in these are always good.
+        self._facts = {}
+        self._lock = threading.Lock()
+
+        self.fetches = 0
+        self.hits = 0
+
+    def fact(self, reality_key_id, need_winner=True):
+        """Return the JSON for a fact, as a dictionary.
+
+        If need_winner is False, the caller only cares about the public keys, so any version of the fact we've seen before will do.
+        Otherwise we'll only use a cached version if it already has the winning private key.
+        """
+        reality_key_id = str(reality_key_id)
+
+        with self._lock:
+            fact_json = self._facts.get(reality_key_id, None)
+        if fact_json is None and self.store is not None:
+            fact_json = self.store.fact(reality_key_id)
+            if fact_json is not None:
+                with self._lock:
+                    self._facts[reality_key_id] = fact_json
+        if fact_json is not None and (not need_winner or is_resolved(fact_json)):
+            with self._lock:
+                self.hits = self.hits + 1
+            return fact_json
+
+        fact_json = self.fetch(reality_key_id)
+        with self._lock:
+            self._facts[reality_key_id] = fact_json
+        if self.store is not None:
+            self.store.put_fact(reality_key_id, fact_json)
+        return fact_json
+
+    def fetch(self, reality_key_id):
+        """Fetch the fact from the API, ignoring the cache.
+        """
+        url = self.api_url % (reality_key_id)
+        delay = self.backoff
+        attempt = 0
+        while True:
+            with self._lock:
+                self.fetches = self.fetches + 1
+            try:
+                return simplejson.loads(self.transport.get(url))
+            except Exception as e:
+                if attempt >= self.retries or not is_transient(e):
+                    raise
+            time.sleep(delay)
+            delay = delay * 2
+            attempt = attempt + 1
+
+    def update(self, reality_key_id, fact_json):
+        """Replace the cached version of a fact with one we got some other way, like from FactEvents.
+        """
+        reality_key_id = str(reality_key_id)
+        with self._lock:
+            self._facts[reality_key_id] = fact_json
+        if self.store is not None:
+            self.store.put_fact(reality_key_id, fact_json)
+
+    def forget(self, reality_key_id):
+        """Remove a fact from the cache.
+        """
+        with self._lock:
+            self._facts.pop(str(reality_key_id), None)
+
+class FactEvents(object):
+    """Follow a stream of fact resolutions by long polling, as served by standin.FactServer.
+
+    events_url is the URL of the stream. transport is anything with a get(url) method, by default an HTTPTransport
+    with a timeout long enough to wait for events. If a client is supplied, such as a FactClient, each fact we hear about
+    is passed to its update method, so the next time it's asked for it's already there.
+    """
+
+    def __init__(self, events_url, transport=None, client=None, wait=DEFAULT_EVENT_WAIT):
+        self.events_url = events_url
+        if transport is None:
+            transport = HTTPTransport(timeout=wait + 10)
+        self.transport = transport
+        self.client = client
+        self.wait = wait
+        self.last_id = None
+        self.requests = 0
+
+    def _get(self, params):
+        separator = '&' if '?' in self.events_url else '?'
+        self.requests = self.requests + 1
+        return simplejson.loads(self.transport.get(self.events_url + separator + urllib.urlencode(params)))
+
+    def subscribe(self):
+        """Start from the latest event, so we only hear about facts resolved from now on.
+
+        Do this before looking at the facts you're waiting for, so nothing resolved in between is missed.
+        """
+        if self.last_id is None:
+            self.last_id = self._get({})['last_id']
+
+    def poll(self, timeout=None):
+        """Return a list of (reality_key_id, fact_json) for each fact resolved since we last asked,
+        waiting up to timeout seconds, or the wait we were made with, for there to be some.
+        """
+        self.subscribe()
+        wait = self.wait if timeout is None else min(timeout, self.wait)
+        response = self._get({'since': self.last_id, 'wait': max(0, wait)})
+        resolved = []
+        for event in response['events']:
+            self.last_id = event['id']
+            reality_key_id = str(event['reality_key_id'])
+            if self.client is not None:
+                self.client.update(reality_key_id, event['fact'])
+            resolved.append((reality_key_id, event['fact']))
+        return resolved
+
+def is_resolved(fact_json):
+    """Return True if the fact has been decided and its winning private key published, so it won't change again.
+    """
+    return fact_json.get('winner', None) is not None and fact_json.get('winner_privkey', None) is not None
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+# An on-disk store for the facts fetched from the Reality Keys API, and the keys derived from them, used by realitykeysdemo.py.
+# This lets a long-running process pick up where it left off after a restart without refetching facts it has already seen.
+# Facts that have been decided and had their winning key published never change, so once they're in the store they never need to be fetched again.
+# It uses SQLite, so it needs nothing beyond the Python standard library, and several processes can share the same file.
+
+import sqlite3
+import threading
+
+import simplejson
+
+from factclient import is_resolved
+
+class FactStore(object):
+    """Store fact JSON, resolved winners and compound public keys in an SQLite database.
+
+    Facts are indexed by reality_key_id, and compound public keys by the pair of keys they were made from.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS facts (reality_key_id TEXT PRIMARY KEY, fact_json TEXT NOT NULL, winner TEXT, resolved INTEGER NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS compound_pubkeys (public_key TEXT NOT NULL, reality_key TEXT NOT NULL, compound_public_key TEXT NOT NULL, PRIMARY KEY (public_key, reality_key))")
+            self._conn.commit()
+
+    def fact(self, reality_key_id):
+        """Return the stored JSON for a fact as a dictionary, or None if we don't have it.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT fact_json FROM facts WHERE reality_key_id = ?", (str(reality_key_id),)).fetchone()
+        if row is None:
+            return None
+        return simplejson.loads(row[0])
+
+    def put_fact(self, reality_key_id, fact_json):
+        """Store the JSON for a fact, replacing any earlier version.
+        """
+        resolved = is_resolved(fact_json)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO facts (reality_key_id, fact_json, winner, resolved) VALUES (?, ?, ?, ?)", (str(reality_key_id), simplejson.dumps(fact_json), fact_json.get('winner', None), int(resolved)))
+            self._conn.commit()
+
+    def winners(self):
+        """Return a dictionary of reality_key_id to winner, for each fact in the store that has been resolved.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT reality_key_id, winner FROM facts WHERE resolved = 1").fetchall()
+        return dict(rows)
+
+    def compound_public_key(self, public_key, reality_key):
+        """Return the stored result of adding the two public keys, or None if we don't have it.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT compound_public_key FROM compound_pubkeys WHERE public_key = ? AND reality_key = ?", (public_key, reality_key)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put_compound_public_key(self, public_key, reality_key, compound_public_key):
+        """Store the result of adding the two public keys.
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO compound_pubkeys (public_key, reality_key, compound_public_key) VALUES (?, ?, ?)", (public_key, reality_key, compound_public_key))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+# Keys for each contract, derived from the user's seed, used by realitykeysdemo.py when makekeys and pay are given --contract.
+#
+# Without them, every contract uses the one key made from the seed, so every contract is funded from, and pays change to, the same address.
+# That address collects outputs for all of them, so finding the ones for a contract means searching through the lot,
+# and contracts can't be set up at the same time without the risk of both choosing the same outputs.
+# With a key per contract, each contract has its own temporary address holding only its own outputs.
+#
+# The keys are BIP32 hardened children of a master key made from the seed, at m/0'/<contract id>',
+# so any BIP32 wallet given the same master key can find them too.
+# Deriving a private key that way is just an HMAC and an addition, but getting its public key takes an elliptic curve multiplication,
+# so public keys are remembered, in memory and in an SQLite file if one is given, and can be looked up by contract id or by public key.
+# Private keys are never written to the file, as anyone with them could spend the contract's funds.
+# The file isn't opened until it's needed, and only made once a contract key is saved in it, so looking for a key
+# that turns out not to be ours, as setup and claim do, leaves nothing behind.
+
+import os
+import hmac
+import hashlib
+import sqlite3
+import threading
+
+from pybitcointools import N, encode, decode, pubtoaddr
+
+import ecbackend
+
+# The branch of the master key that contract keys are made on.
+CONTRACT_BRANCH = 0
+
+HARDENED = 2 ** 31
+
+def _ckd_hardened(key, chain_code, i):
+    """Derive the hardened child i of a private key, as a 32-byte string, with its chain code, as BIP32 does.
+    """
+    I = hmac.new(chain_code, '\x00' + key + encode(HARDENED + i, 256, 4), hashlib.sha512).digest()
+    child = (decode(I[:32], 256) + decode(key, 256)) % N
+    if decode(I[:32], 256) >= N or child == 0:
+        # Vanishingly unlikely, but BIP32 says to skip to the next index, which for us would be another contract's key.
+        raise Exception("Key %d can't be derived, please use another contract id." % (i))
+    return encode(child, 256, 32), I[32:]
+
+class ContractKeys(object):
+    """Derive a key for each contract from a seed, remembering the public keys.
+
+    Contract ids are numbers from 0 up to 2^31 - 1. Using the ID of the Reality Keys fact the contract is on is a good choice,
+    as that's the first thing setup and claim try if the keys they're given aren't ones they've seen before.
+    filename is an SQLite file to keep the public keys in, shared by all the seeds that use it. It's made when the first key is saved.
+    """
+
+    def __init__(self, seed, filename=None, backend=None):
+        I = hmac.new('Bitcoin seed', seed, hashlib.sha512).digest()
+        key, chain_code = _ckd_hardened(I[:32], I[32:], CONTRACT_BRANCH)
+        self._branch = (key, chain_code)
+        # Identifies the seed in the file, without giving anything away about it.
+        self.seed_id = hashlib.sha256(key + chain_code).hexdigest()[:16]
+        self.backend = backend or ecbackend.get_backend()
+        self.filename = filename
+        self._private_keys = {}
+        self._public_keys = {}
+        self._contract_ids = {}
+        # Contract ids whose public keys are in the file.
+        self._saved = set()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self, create):
+        """Return the connection to the file, opening it the first time it's needed.
+
+        Return None if there's no file, or if it doesn't exist yet and create is False.
+        """
+        if self.filename is None:
+            return None
+        with self._lock:
+            if self._conn is None:
+                if not create and not os.path.exists(self.filename):
+                    return None
+                self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+                self._conn.execute("CREATE TABLE IF NOT EXISTS contract_keys (seed_id TEXT NOT NULL, contract_id INTEGER NOT NULL, public_key TEXT NOT NULL, PRIMARY KEY (seed_id, contract_id))")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS contract_keys_public_key ON contract_keys (public_key)")
+                self._conn.commit()
+            return self._conn
+
+    def private_key(self, contract_id):
+        """Return the private key for a contract, in hex, like the one made from the seed.
+        """
+        contract_id = _check_contract_id(contract_id)
+        priv = self._private_keys.get(contract_id, None)
+        if priv is None:
+            priv = _ckd_hardened(self._branch[0], self._branch[1], contract_id)[0].encode('hex')
+            self._private_keys[contract_id] = priv
+        return priv
+
+    def public_key(self, contract_id, save=True):
+        """Return the public key for a contract, in uncompressed hex, like the one made from the seed.
+
+        Unless save is False, it's saved in the file, so we'll know it as one of ours next time.
+        Pass False to work out a key that may not be in use, to see if it's the one we're looking for.
+        """
+        contract_id = _check_contract_id(contract_id)
+        pub = self._public_keys.get(contract_id, None)
+        if pub is None:
+            conn = self._connection(False)
+            if conn is not None:
+                with self._lock:
+                    row = conn.execute("SELECT public_key FROM contract_keys WHERE seed_id = ? AND contract_id = ?", (self.seed_id, contract_id)).fetchone()
+                if row is not None:
+                    pub = str(row[0])
+                    self._saved.add(contract_id)
+        if pub is None:
+            pub = self.backend.privtopub(self.private_key(contract_id))
+        self._remember(contract_id, pub)
+        if save and contract_id not in self._saved:
+            conn = self._connection(True)
+            if conn is not None:
+                with self._lock:
+                    conn.execute("INSERT OR REPLACE INTO contract_keys (seed_id, contract_id, public_key) VALUES (?, ?, ?)", (self.seed_id, contract_id, pub))
+                    conn.commit()
+            self._saved.add(contract_id)
+        return pub
+
+    def address(self, contract_id, magic_byte=0):
+        return pubtoaddr(self.public_key(contract_id), magic_byte)
+
+    def contract_id(self, public_key):
+        """Return the id of the contract a public key was made for, or None if it isn't one we've made.
+        """
+        contract_id = self._contract_ids.get(public_key, None)
+        if contract_id is None:
+            conn = self._connection(False)
+            if conn is not None:
+                with self._lock:
+                    row = conn.execute("SELECT contract_id FROM contract_keys WHERE seed_id = ? AND public_key = ?", (self.seed_id, public_key)).fetchone()
+                if row is not None:
+                    contract_id = row[0]
+                    self._remember(contract_id, public_key)
+                    self._saved.add(contract_id)
+        return contract_id
+
+    def _remember(self, contract_id, public_key):
+        self._public_keys[contract_id] = public_key
+        self._contract_ids[public_key] = contract_id
+
+    def __len__(self):
+        return len(self._public_keys)
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+
+def _check_contract_id(contract_id):
+    try:
+        contract_id = int(contract_id)
+    except ValueError:
+        raise Exception("Contract ids should be numbers, but got \"%s\"." % (contract_id))
+    if contract_id < 0 or contract_id >= HARDENED:
+        raise Exception("Contract ids should be from 0 to %d, but got %d." % (HARDENED - 1, contract_id))
+    return contract_id
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+# Timing for the stages of setup and claim, so when something is slow we can tell where the time went.
+#
+# Put a Profiler in the settings as profiler, or run realitykeysdemo.py with --profile, and each of these is timed and counted:
+#    fact_fetch: Fetching facts from the Reality Keys API
+#    unspent: Finding the outputs to spend, from blockchain.info or the inputs supplied
+#    ec: Elliptic curve arithmetic, like privtopub and adding keys for ECC voodoo
+#    script: Making redeem scripts and P2SH addresses
+#    sign: Signing transactions
+#    verify: Checking the other party's signatures, and our claims, before countersigning or broadcasting them
+#    pushtx: Broadcasting transactions
+#
+# The results can be output as JSON, or as text in the Prometheus exposition format.
+# You can also subscribe a callback to be told about each stage as it finishes, eg to feed your own metrics.
+
+import time
+import threading
+from collections import OrderedDict
+
+STAGES = ['fact_fetch', 'unspent', 'ec', 'script', 'sign', 'verify', 'pushtx']
+
+class _Stage(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler._exit(self.name)
+        return False
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_stage = _NullStage()
+
+class Profiler(object):
+    """Record the wall time and number of calls of each stage.
+
+    Stages can be nested, eg script includes the ec work done to make ECC voodoo keys.
+    The seconds recorded for a stage include any stages inside it; self_seconds leaves them out,
+    so the self_seconds of all the stages add up to the time spent in any of them.
+    It can be shared between threads, but not sent to other processes, so jobs run on an executor aren't timed.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.callbacks = []
+        self._stages = OrderedDict()
+        for name in STAGES:
+            self._stages[name] = {'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0, 'max_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def subscribe(self, callback):
+        """Call callback with the name of the stage and the seconds it took, each time a stage finishes.
+        """
+        self.callbacks.append(callback)
+
+    def stage(self, name):
+        """Return a context manager timing the code inside it as the named stage.
+        """
+        return _Stage(self, name)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _enter(self, name):
+        # Each entry is the stage name, when it started, and how long was spent in stages nested inside it.
+        self._stack().append([name, self.clock(), 0.0])
+
+    def _exit(self, name):
+        stack = self._stack()
+        name, started, nested = stack.pop()
+        seconds = self.clock() - started
+        if len(stack) > 0:
+            stack[-1][2] = stack[-1][2] + seconds
+        self.record(name, seconds, seconds - nested)
+
+    def record(self, name, seconds, self_seconds=None):
+        """Add a call of the named stage taking the given number of seconds.
+        """
+        if self_seconds is None:
+            self_seconds = seconds
+        with self._lock:
+            if name not in self._stages:
+                self._stages[name] = {'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0, 'max_seconds': 0.0}
+            s = self._stages[name]
+            s['calls'] = s['calls'] + 1
+            s['seconds'] = s['seconds'] + seconds
+            s['self_seconds'] = s['self_seconds'] + self_seconds
+            s['max_seconds'] = max(s['max_seconds'], seconds)
+        for callback in self.callbacks:
+            callback(name, seconds)
+
+    def reset(self):
+        with self._lock:
+            for s in self._stages.values():
+                s.update({'calls': 0, 'seconds': 0.0, 'self_seconds': 0.0, 'max_seconds': 0.0})
+
+    def summary(self):
+        """Return a dictionary of stage name to its calls, seconds, self_seconds and max_seconds.
+        """
+        with self._lock:
+            return OrderedDict((name, dict(s)) for name, s in self._stages.items())
+
+    def to_json(self):
+        # Every command imports this module to mark its stages, but only a profiled one needs simplejson.
+        import simplejson
+        return simplejson.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self, prefix='realitykeysdemo'):
+        """Return the summary as text in the Prometheus exposition format.
+        """
+        summary = self.summary()
+        metrics = [
+            ('stage_calls_total', 'calls', 'counter', 'Number of times each stage was run.'),
+            ('stage_seconds_total', 'seconds', 'counter', 'Wall time spent in each stage, including the stages inside it.'),
+            ('stage_self_seconds_total', 'self_seconds', 'counter', 'Wall time spent in each stage, not including the stages inside it.'),
+            ('stage_max_seconds', 'max_seconds', 'gauge', 'Longest single run of each stage.'),
+        ]
+        lines = []
+        for metric, field, metric_type, description in metrics:
+            name = prefix + '_' + metric
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for stage_name, s in summary.items():
+                lines.append('%s{stage="%s"} %s' % (name, stage_name, repr(s[field])))
+        return "\n".join(lines) + "\n"
+
+    def output(self, fmt):
+        """Return the summary formatted as 'json' or 'prometheus'.
+        """
+        if fmt == 'json':
+            return self.to_json()
+        elif fmt == 'prometheus':
+            return self.to_prometheus()
+        raise Exception("Unknown profile format \"%s\", expected json or prometheus." % (fmt))
+
+def stage(settings, name):
+    """Return a context manager timing the named stage with the profiler in the settings, if there is one.
+
+    If there isn't, it does nothing, so the stages can be marked without slowing down unprofiled runs.
+    """
+    profiler = settings.get('profiler', None)
+    if profiler is None:
+        return _null_stage
+    return profiler.stage(name)
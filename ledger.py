@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+# A record of what has happened to each contract, kept by realitykeysdemo.py, so you can tell where they've all got to.
+#
+# Without it, all realitykeysdemo.py kept was the seed, so the only way to find out which contracts could be claimed
+# was to run claim against every one of them and see which worked.
+# Now makekeys, setup, claim and pay, and the batch commands, watch and serve that use them, each append a line of JSON
+# to the ledger file saying what they did, and the state of each contract is worked out from those lines:
+#    unfunded: setup found the temporary addresses hadn't been paid yet
+#    half_signed: setup made the transaction funding the contract, and signed our part of it
+#    complete: the funding transaction has been signed by both parties
+#    broadcast: the funding transaction has been sent to the network
+#    claimed: the winnings have been claimed
+# A claim transaction that was made but not sent, because of --no-pushtx or because broadcasting it failed,
+# is recorded as claim_made, which doesn't change the contract's state, so it stays claimable until a claim is sent.
+# Facts are recorded as resolved when they're fetched with a winner and the winning key, and a contract is claimable
+# once it has a funding transaction, and the fact it's on has been resolved in favour of the side we're on.
+# That includes contracts we only half-signed, as the other party completes and broadcasts the transaction without telling us.
+#
+# The file is only ever appended to, so it's never left half rewritten. Writes are buffered, and flushed and fsynced to disk
+# every SYNC_EVERY records or SYNC_INTERVAL seconds, whichever comes first, and when the ledger is closed,
+# so a batch of thousands of contracts doesn't wait for the disk thousands of times.
+# If we crash part way through writing a record, the partial line is ignored when reading, and cut off before writing again.
+#
+# The state is kept in memory by a LedgerIndex, made by replaying the file a line at a time the first time it's needed,
+# then kept up to date with each record, so looking up a contract, or listing the claimable ones, doesn't go back to the file.
+# Commands that only write to the ledger never read it.
+# Nearly every command writes to it, makekeys included, so it uses the standard library's json, which loads in a fraction of the time simplejson takes.
+
+import os
+import time
+import threading
+import json
+from collections import OrderedDict
+
+# The states of a contract, in the order it goes through them. A contract never goes back to an earlier state.
+STATES = ['unfunded', 'half_signed', 'complete', 'broadcast', 'claimed']
+
+# The states in which the contract may have been funded, so it can be claimed once its fact is resolved.
+FUNDED_STATES = ['half_signed', 'complete', 'broadcast']
+
+SYNC_EVERY = 100
+SYNC_INTERVAL = 1.0
+
+# How much to read at a time when looking back from the end of the file for the last complete line.
+_TAIL_CHUNK = 65536
+
+def contract_key(reality_key_id, yes_key, no_key):
+    """Return what a contract is identified by: its fact and the public keys of the two sides.
+    """
+    return (str(reality_key_id), yes_key, no_key)
+
+def read_records(filename):
+    """Yield each record in a ledger file, as a dictionary, skipping a partial line at the end left by a crash.
+    """
+    if not os.path.exists(filename):
+        return
+    with open(filename, 'rb') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                return
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+class LedgerIndex(object):
+    """The state of each contract, and which facts have been resolved, made from ledger records.
+
+    Apply the records in the order they were written. claimable is kept up to date as they are,
+    so it's there whenever you ask for it rather than being worked out from all the contracts.
+    """
+
+    def __init__(self):
+        self.contracts = OrderedDict()
+        self.winners = {}
+        self.keys = OrderedDict()
+        self.payments = 0
+        self.records = 0
+        self._claimable = OrderedDict()
+        self._by_fact = {}
+
+    @classmethod
+    def replay(cls, records):
+        index = cls()
+        for record in records:
+            index.apply(record)
+        return index
+
+    def apply(self, record):
+        """Update the state for a record.
+        """
+        self.records = self.records + 1
+        event = record.get('event', None)
+        if event == 'keys':
+            self.keys[record['public_key']] = record
+        elif event == 'pay':
+            self.payments = self.payments + 1
+        elif event == 'resolved':
+            reality_key_id = str(record['reality_key_id'])
+            self.winners[reality_key_id] = record['winner']
+            for key in self._by_fact.get(reality_key_id, []):
+                self._update_claimable(key)
+        elif event in ['setup', 'claim']:
+            self._apply_contract(record)
+
+    def _apply_contract(self, record):
+        key = contract_key(record['reality_key_id'], record['yes_key'], record['no_key'])
+        contract = self.contracts.get(key, None)
+        if contract is None:
+            contract = {'reality_key_id': key[0], 'yes_key': key[1], 'no_key': key[2], 'side': None, 'state': None, 'p2sh_address': None, 'funding_txid': None, 'claim_txid': None}
+            self.contracts[key] = contract
+            self._by_fact.setdefault(key[0], []).append(key)
+        for field in ['side', 'p2sh_address']:
+            if record.get(field, None) is not None:
+                contract[field] = record[field]
+        state = record.get('state', None)
+        if state is not None and (contract['state'] is None or STATES.index(state) > STATES.index(contract['state'])):
+            contract['state'] = state
+        if record['event'] == 'setup' and record.get('txid', None) is not None:
+            contract['funding_txid'] = record['txid']
+        if record['event'] == 'claim':
+            contract['claim_txid'] = record.get('txid', None)
+        contract['time'] = record.get('time', None)
+        self._update_claimable(key)
+
+    def _update_claimable(self, key):
+        contract = self.contracts[key]
+        winner = self.winners.get(key[0], None)
+        if contract['state'] in FUNDED_STATES and winner is not None and contract['side'] == winner.lower():
+            self._claimable[key] = contract
+        else:
+            self._claimable.pop(key, None)
+
+    def contract(self, reality_key_id, yes_key, no_key):
+        """Return the state of a contract as a dictionary, or None if there's nothing about it in the ledger.
+        """
+        return self.contracts.get(contract_key(reality_key_id, yes_key, no_key), None)
+
+    def is_claimable(self, reality_key_id, yes_key, no_key):
+        return contract_key(reality_key_id, yes_key, no_key) in self._claimable
+
+    def claimable(self):
+        """Return the contracts we can claim now, in the order they became claimable.
+        """
+        return self._claimable.values()
+
+class Ledger(object):
+    """Append records of what we did to a JSONL file, and keep an index of the state of each contract.
+
+    If filename is None, the records are only kept in memory.
+    clock is what the time of each record is taken from, and how we tell when to sync.
+    """
+
+    def __init__(self, filename=None, sync_every=SYNC_EVERY, sync_interval=SYNC_INTERVAL, clock=time.time):
+        self.filename = filename
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.clock = clock
+        self._file = None
+        self._index = LedgerIndex() if filename is None else None
+        self._unsynced = 0
+        self._last_sync = clock()
+        # Facts we've recorded as resolved, so fetching them again doesn't record them again.
+        self._resolved = set()
+        self._lock = threading.RLock()
+
+    @property
+    def index(self):
+        """The LedgerIndex, replayed from the file the first time it's asked for.
+        """
+        with self._lock:
+            if self._index is None:
+                if self._file is not None:
+                    self._file.flush()
+                self._index = LedgerIndex.replay(read_records(self.filename))
+            return self._index
+
+    def record(self, event, **fields):
+        """Append a record of an event, with the fields given and the time, and return it.
+        """
+        record = OrderedDict([('event', event), ('time', self.clock())])
+        record.update(sorted(fields.items()))
+        with self._lock:
+            if self.filename is not None:
+                self._write(json.dumps(record) + '\n')
+            if self._index is not None:
+                self._index.apply(record)
+        return record
+
+    def record_resolved(self, reality_key_id, winner):
+        """Record that a fact has been resolved, unless we already have.
+        """
+        reality_key_id = str(reality_key_id)
+        with self._lock:
+            if reality_key_id in self._resolved:
+                return
+            self._resolved.add(reality_key_id)
+            if self._index is not None and self._index.winners.get(reality_key_id, None) == winner:
+                return
+            self.record('resolved', reality_key_id=reality_key_id, winner=winner)
+
+    def _write(self, line):
+        if self._file is None:
+            self._file = open(self.filename, 'a+b')
+            _cut_partial_line(self._file)
+        self._file.write(line)
+        self._unsynced = self._unsynced + 1
+        if self._unsynced >= self.sync_every or self.clock() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """Write anything buffered to the file, and wait for it to reach the disk.
+        """
+        with self._lock:
+            if self._file is not None and self._unsynced > 0:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._unsynced = 0
+            self._last_sync = self.clock()
+
+    def contract(self, reality_key_id, yes_key, no_key):
+        return self.index.contract(reality_key_id, yes_key, no_key)
+
+    def claimable(self):
+        return self.index.claimable()
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def _cut_partial_line(f):
+    """Cut off anything after the last newline in a file opened for appending, ie a record we crashed part way through writing.
+    """
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    pos = end
+    while pos > 0:
+        start = max(0, pos - _TAIL_CHUNK)
+        f.seek(start)
+        chunk = f.read(pos - start)
+        newline = chunk.rfind('\n')
+        if newline >= 0:
+            pos = start + newline + 1
+            break
+        pos = start
+    if pos < end:
+        f.truncate(pos)
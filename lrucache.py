@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+# A small least-recently-used cache, used by realitykeysdemo.py to avoid redoing slow derivations, like EC point addition, for contracts it has already seen.
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Remember up to maxsize values, forgetting the one used least recently when it gets full.
+
+    Counts hits and misses, so you can tell whether it's helping.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value for the key, or default if we don't have it.
+        """
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses = self.misses + 1
+                return default
+            # Put it back at the end, as the most recently used.
+            self._items[key] = value
+            self.hits = self.hits + 1
+            return value
+
+    def put(self, key, value):
+        """Store the value for the key, evicting the least recently used item if we're full.
+        """
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """Return a dictionary of the hit and miss counts and the current size.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items), 'maxsize': self.maxsize}
@@ -0,0 +1,370 @@
+#!/usr/bin/python
+
+# Transactions kept as binary strings, for the setup, claim and pay commands of realitykeysdemo.py.
+#
+# The pybitcointools transaction functions take hex or binary, checking which with a regular expression every call,
+# and to change one input script they deserialize the whole transaction into a dictionary, then serialize it again.
+# sign() goes as far as hex encoding a binary transaction and decoding the result, so signing each input of a
+# transaction meant several full copies and conversions of it.
+#
+# A RawTransaction is the binary transaction plus the offsets of its parts, found in one pass without copying anything.
+# Signing an input or replacing its script splices the new script in, and comparing two transactions looks only at the
+# parts we care about, through memoryviews. Hex is only used to read transactions in and print them out.
+# The signatures are made by the same pybitcointools functions as before, so they are byte for byte the same.
+#
+# What's signed for each input is the whole transaction with that input's script swapped in and the others left out,
+# so signing every input of a big transaction meant building and hashing it once per input, and working out the public key
+# for the same private key each time. A SigningContext keeps what all the inputs share: the inputs without their scripts,
+# the SHA256 state after hashing the ones before each input, the outputs, and the keys, so each signature only hashes what's left.
+
+import struct
+import hashlib
+
+from pybitcointools import (address_to_script, bin_dbl_sha256, bin_hash160, der_encode_sig, ecdsa_raw_sign,
+                            num_to_var_int, privkey_to_pubkey, serialize_script_unit, SIGHASH_ALL)
+
+SEQUENCE_FINAL = '\xff\xff\xff\xff'
+
+# Version 1, as mktx makes.
+VERSION = struct.pack('<I', 1)
+LOCKTIME = struct.pack('<I', 0)
+
+class RawTransaction(object):
+    """A serialized transaction, in binary, with the positions of its inputs and outputs.
+
+    inputs has a (start, script_start, script_end) tuple for each input, where start is the position of its outpoint,
+    and its sequence number follows the end of its script.
+    outputs_start is where the output count starts, so everything from there on is the outputs and the locktime.
+    """
+
+    __slots__ = ('data', 'inputs', 'outputs_start')
+
+    def __init__(self, data, inputs=None, outputs_start=None):
+        self.data = data
+        if inputs is None:
+            inputs, outputs_start = _parse_inputs(data)
+        self.inputs = inputs
+        self.outputs_start = outputs_start
+
+    @classmethod
+    def from_hex(cls, tx):
+        try:
+            data = tx.decode('hex')
+        except TypeError:
+            raise Exception("Expected a transaction in hex, but got something else.")
+        return cls(data)
+
+    def hex(self):
+        return self.data.encode('hex')
+
+    def txid(self):
+        return bin_dbl_sha256(self.data)[::-1].encode('hex')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        return isinstance(other, RawTransaction) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __getstate__(self):
+        return (self.data, self.inputs, self.outputs_start)
+
+    def __setstate__(self, state):
+        self.data, self.inputs, self.outputs_start = state
+
+    def version(self):
+        return memoryview(self.data)[:4]
+
+    def outpoint(self, i):
+        """The 36 bytes of the outpoint spent by input i: the txid, reversed, and the output number.
+        """
+        start = self.inputs[i][0]
+        return memoryview(self.data)[start:start + 36]
+
+    def outpoint_string(self, i):
+        """The outpoint spent by input i, as "txid:n", the form used by mktx and the UTXO index.
+        """
+        start = self.inputs[i][0]
+        return self.data[start:start + 32][::-1].encode('hex') + ':' + str(struct.unpack('<I', self.data[start + 32:start + 36])[0])
+
+    def script(self, i):
+        start, script_start, script_end = self.inputs[i]
+        return self.data[script_start:script_end]
+
+    def tail(self):
+        """Everything after the inputs: the outputs and the locktime.
+        """
+        return memoryview(self.data)[self.outputs_start:]
+
+    def outputs(self):
+        """Yield the value and script of each output, with the script in binary.
+        """
+        data = self.data
+        count, pos = _read_var_int(data, self.outputs_start)
+        for i in range(count):
+            value = struct.unpack('<Q', data[pos:pos + 8])[0]
+            length, pos = _read_var_int(data, pos + 8)
+            yield value, data[pos:pos + length]
+            pos = pos + length
+
+    def is_fully_signed(self):
+        """Return True if every input has a script, ie it has been signed.
+        """
+        for start, script_start, script_end in self.inputs:
+            if script_start == script_end:
+                return False
+        return True
+
+    def spends_same_outputs(self, other):
+        """Return True if the other transaction's inputs spend the same outputs as this one's, in the same order.
+        """
+        if len(self.inputs) != len(other.inputs):
+            return False
+        for i in range(len(self.inputs)):
+            if self.outpoint(i) != other.outpoint(i):
+                return False
+        return True
+
+    def matches(self, other):
+        """Return True if the other transaction is the same as this one, apart from the input scripts.
+
+        Only the version, the outpoints and the tail are compared, without deserializing either transaction.
+        """
+        return self.version() == other.version() and self.spends_same_outputs(other) and self.tail() == other.tail()
+
+    def with_script(self, i, script):
+        """Return a copy of the transaction with the script of input i replaced.
+
+        Only the one script is replaced. The positions of the parts after it are shifted, rather than found again.
+        """
+        return self.with_scripts({i: script})
+
+    def with_scripts(self, scripts):
+        """Return a copy of the transaction with the scripts of several inputs replaced, given as a dictionary of input number to script.
+
+        The transaction is copied once, however many scripts are replaced, rather than once for each.
+        """
+        data = self.data
+        parts = []
+        inputs = []
+        pos = 0
+        shift = 0
+        for j, (start, script_start, script_end) in enumerate(self.inputs):
+            if j not in scripts:
+                inputs.append((start + shift, script_start + shift, script_end + shift))
+                continue
+            script = scripts[j]
+            length_start = start + 36
+            length = num_to_var_int(len(script))
+            parts.append(data[pos:length_start])
+            parts.append(length)
+            parts.append(script)
+            pos = script_end
+            new_script_start = length_start + shift + len(length)
+            inputs.append((start + shift, new_script_start, new_script_start + len(script)))
+            shift = shift + len(length) + len(script) - (script_end - length_start)
+        parts.append(data[pos:])
+        return RawTransaction(''.join(parts), inputs, self.outputs_start + shift)
+
+    def unsigned(self):
+        """Return the transaction with all its input scripts taken out, in binary.
+
+        Apart from which input it's for and the script it's signed with, this is all the signature hash of an input depends on.
+        """
+        return self.signature_form(None, None)[:-4]
+
+    def signature_form(self, i, script, hashcode=SIGHASH_ALL):
+        """Return what's hashed to sign input i with SIGHASH_ALL: the transaction with script in input i, no other input scripts, and the hash code.
+
+        This is what pybitcointools signature_form gives, serialized, followed by the hash code, as txhash adds it.
+        """
+        if hashcode != SIGHASH_ALL:
+            raise Exception("Only SIGHASH_ALL is supported.")
+        data = self.data
+        parts = [data[:self.inputs[0][0]] if self.inputs else data[:self.outputs_start]]
+        for j, (start, script_start, script_end) in enumerate(self.inputs):
+            parts.append(data[start:start + 36])
+            if j == i:
+                parts.append(num_to_var_int(len(script)))
+                parts.append(script)
+            else:
+                parts.append('\x00')
+            parts.append(data[script_end:script_end + 4])
+        parts.append(data[self.outputs_start:])
+        parts.append(struct.pack('<I', hashcode))
+        return ''.join(parts)
+
+    def signature_hash(self, i, script, hashcode=SIGHASH_ALL):
+        return bin_dbl_sha256(self.signature_form(i, script, hashcode))
+
+class SigningContext(object):
+    """What the signature hashes of all the inputs of a transaction have in common, for signing several of them.
+
+    The context is good for the transaction it was made from, and any made from it by changing input scripts, as signing does,
+    since the scripts aren't part of what's signed. Make it before signing the first input, and pass it to each call to sign or multisign.
+    The hash states aren't sent when the context is pickled, so it can be sent to other processes with the inputs for them to sign.
+    """
+
+    def __init__(self, tx):
+        data = tx.data
+        self._head = data[:tx.inputs[0][0]] if tx.inputs else data[:tx.outputs_start]
+        self._outpoints = []
+        self._sequences = []
+        for start, script_start, script_end in tx.inputs:
+            self._outpoints.append(data[start:start + 36])
+            self._sequences.append(data[script_end:script_end + 4])
+        # Each input as it is when it isn't the one being signed: its outpoint, an empty script and its sequence number.
+        self._blanked = [o + '\x00' + q for o, q in zip(self._outpoints, self._sequences)]
+        self._tail = data[tx.outputs_start:] + struct.pack('<I', SIGHASH_ALL)
+        self._midstates = None
+        self._keys = {}
+
+    def __getstate__(self):
+        return (self._head, self._outpoints, self._sequences, self._blanked, self._tail, self._keys)
+
+    def __setstate__(self, state):
+        self._head, self._outpoints, self._sequences, self._blanked, self._tail, self._keys = state
+        self._midstates = None
+
+    def _midstate(self, i):
+        """Return the SHA256 state after hashing everything before input i, as it is when it isn't the one being signed.
+        """
+        if self._midstates is None:
+            self._midstates = [hashlib.sha256(self._head)]
+        while len(self._midstates) <= i:
+            h = self._midstates[-1].copy()
+            h.update(self._blanked[len(self._midstates) - 1])
+            self._midstates.append(h)
+        return self._midstates[i]
+
+    def signature_hash(self, i, script):
+        """Return the hash to sign for input i with SIGHASH_ALL, as if it had the script, the same as RawTransaction.signature_hash.
+        """
+        h = self._midstate(i).copy()
+        h.update(self._outpoints[i])
+        h.update(num_to_var_int(len(script)))
+        h.update(script)
+        h.update(self._sequences[i])
+        h.update(''.join(self._blanked[i + 1:]))
+        h.update(self._tail)
+        return hashlib.sha256(h.digest()).digest()
+
+    def pay_to_pubkey_hash(self, private_key):
+        """Return the public key of a private key, in binary, and the script of the address it makes, worked out once for each key.
+        """
+        keys = self._keys.get(private_key, None)
+        if keys is None:
+            public_key = privkey_to_pubkey(private_key.encode('hex') if len(private_key) <= 33 else private_key).decode('hex')
+            keys = (public_key, '\x76\xa9\x14' + bin_hash160(public_key) + '\x88\xac')
+            self._keys[private_key] = keys
+        return keys
+
+def _read_var_int(data, pos):
+    """Return the variable length integer at pos, and the position after it.
+    """
+    first = ord(data[pos])
+    if first < 253:
+        return first, pos + 1
+    if first == 253:
+        return struct.unpack('<H', data[pos + 1:pos + 3])[0], pos + 3
+    if first == 254:
+        return struct.unpack('<I', data[pos + 1:pos + 5])[0], pos + 5
+    return struct.unpack('<Q', data[pos + 1:pos + 9])[0], pos + 9
+
+def _parse_inputs(data):
+    """Find the inputs of a binary transaction, returning their positions and where the outputs start.
+    """
+    try:
+        count, pos = _read_var_int(data, 4)
+        inputs = []
+        for i in range(count):
+            start = pos
+            length, script_start = _read_var_int(data, start + 36)
+            script_end = script_start + length
+            inputs.append((start, script_start, script_end))
+            pos = script_end + 4
+        # Check the outputs and locktime are all there, so a truncated transaction is caught here rather than when it's used.
+        outputs, end = _read_var_int(data, pos)
+        for i in range(outputs):
+            length, end = _read_var_int(data, end + 8)
+            end = end + length
+    except (IndexError, struct.error):
+        raise Exception("Could not parse the transaction, it seems to be truncated.")
+    if end + 4 > len(data):
+        raise Exception("Could not parse the transaction, it seems to be truncated.")
+    if end + 4 < len(data):
+        raise Exception("Could not parse the transaction, it has %d bytes we didn't expect." % (len(data) - end - 4))
+    return inputs, pos
+
+def make_transaction(inputs, outputs):
+    """Make an unsigned transaction, as mktx does, but in binary.
+
+    inputs are dictionaries with 'output' (txid:n), like unspent() returns, and outputs are dictionaries with 'value' and 'address' or 'script', in hex.
+    """
+    parts = [VERSION, num_to_var_int(len(inputs))]
+    for inp in inputs:
+        txid, n = inp['output'].split(':')
+        parts.append(txid.decode('hex')[::-1])
+        parts.append(struct.pack('<I', int(n)))
+        parts.append('\x00')
+        parts.append(SEQUENCE_FINAL)
+    parts.append(num_to_var_int(len(outputs)))
+    for out in outputs:
+        if 'address' in out:
+            script = address_to_script(out['address']).decode('hex')
+        elif 'script' in out:
+            script = out['script'].decode('hex')
+        else:
+            raise Exception("Could not find 'address' or 'script' in output.")
+        parts.append(struct.pack('<Q', out['value']))
+        parts.append(num_to_var_int(len(script)))
+        parts.append(script)
+    parts.append(LOCKTIME)
+    return RawTransaction(''.join(parts))
+
+def _signature(context, i, script, private_key):
+    """Sign input i as if it had the script, returning the DER signature followed by the hash code, in binary, as multisign does in hex.
+    """
+    sig = der_encode_sig(*ecdsa_raw_sign(context.signature_hash(i, script), private_key))
+    return sig.decode('hex') + chr(SIGHASH_ALL)
+
+def sign(tx, i, private_key, context=None):
+    """Sign input i of a transaction spending an output paid to the address of the private key, as pybitcointools sign does.
+
+    When signing several inputs, pass the same SigningContext for each, or use sign_inputs.
+    """
+    return sign_inputs(tx, [i], private_key, context)
+
+def sign_inputs(tx, indexes, private_key, context=None):
+    """Sign each of the inputs numbered in indexes, as sign does, putting all the signatures into the transaction in one go.
+    """
+    if context is None:
+        context = SigningContext(tx)
+    public_key, script = context.pay_to_pubkey_hash(private_key)
+    scripts = {}
+    for i in indexes:
+        scripts[i] = serialize_script_unit(_signature(context, i, script, private_key)) + serialize_script_unit(public_key)
+    return tx.with_scripts(scripts)
+
+def multisign(tx, i, script, private_key, context=None):
+    """Return the signature for input i of a transaction spending a P2SH output with the redeem script, in binary.
+
+    When signing several inputs, pass the same SigningContext for each.
+    """
+    return _signature(context or SigningContext(tx), i, script, private_key)
+
+def multisignature_script(script, sigs, if_flags=None):
+    """Return the input script spending a P2SH output: the signatures, followed by the flags choosing the branch of an if/else script, if there are any, and then the redeem script.
+
+    This is the same script as pybitcointools apply_multisignatures makes, or realitykeysdemo.py's apply_multisignatures_with_if_flags.
+    """
+    units = [None] + sigs + (if_flags or []) + [script]
+    return ''.join([serialize_script_unit(u) for u in units])
+
+def apply_multisignatures(tx, i, script, sigs, if_flags=None):
+    """Put the signatures into input i, as multisignature_script makes them.
+    """
+    return tx.with_script(i, multisignature_script(script, sigs, if_flags))
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# The results of the commands in realitykeysdemo.py.
+#
+# Each execute_ function returns one of these. It's a list of the lines the command prints, so it can be used as it always was,
+# but it also has what the command made as attributes, so programs don't have to pick them out of the text.
+# That matters because which line holds what depends on whether the output is verbose.
+# Run a command with --json to print the attributes as a JSON object instead of the lines.
+
+from collections import OrderedDict
+
+class Result(list):
+    """The lines output by a command, with what it made as attributes.
+
+    Subclasses list the attributes they have in FIELDS. Any not set are None.
+    """
+
+    command = None
+    FIELDS = []
+
+    def __init__(self, lines=None, **fields):
+        list.__init__(self, lines or [])
+        for name in self.FIELDS:
+            setattr(self, name, None)
+        for name, value in fields.items():
+            if name not in self.FIELDS:
+                raise Exception("%s has no field %s." % (self.__class__.__name__, name))
+            setattr(self, name, value)
+
+    def as_dict(self):
+        """Return the command and its fields as a dictionary, ready to be output as JSON.
+        """
+        d = OrderedDict([('command', self.command)])
+        for name in self.FIELDS:
+            d[name] = getattr(self, name)
+        return d
+
+    def __reduce__(self):
+        # So results can be sent between processes with their fields, not just their lines.
+        return (self.__class__, (list(self),), self.__dict__)
+
+class MakeKeysResult(Result):
+    command = 'makekeys'
+    FIELDS = ['public_key', 'address', 'contract_id']
+
+class SetupResult(Result):
+    """The result of setup.
+
+    side is the side of the contract the user is on, 'yes' or 'no'.
+    fundings has an entry for each side with a stake, with the address it has to be paid to, the amount, and whether it has been.
+    If either hasn't, there is no transaction.
+    complete is True when the transaction has been signed by both parties.
+    next_step is the command that should be run next, by the other party if the transaction isn't complete yet, or by the winner if it is.
+    """
+    command = 'setup'
+    FIELDS = ['reality_key_id', 'side', 'p2sh_address', 'fundings', 'transaction', 'txid', 'complete', 'broadcast', 'next_step']
+
+class AggregateSetupResult(Result):
+    """The result of setup-aggregate.
+
+    contracts has the reality_key_id, P2SH address and total stake of each contract funded by the transaction, in the order of its outputs.
+    fundings has an entry for each party with a stake, with their public key, the address they have to pay their stakes to, the amount, and whether it has been.
+    The rest are as for setup.
+    """
+    command = 'setup-aggregate'
+    FIELDS = ['contracts', 'fundings', 'transaction', 'txid', 'complete', 'broadcast', 'next_step']
+
+class ClaimResult(Result):
+    """The result of claim.
+
+    status is 'claimed' if a transaction was made, otherwise why it couldn't be:
+    'undecided', if the fact hasn't been decided yet, 'unpublished' if the winning key hasn't been published yet, 'unfunded',
+    or 'not_ours' if neither of the contract's public keys is one of the user's.
+    """
+    command = 'claim'
+    FIELDS = ['reality_key_id', 'status', 'p2sh_address', 'amount', 'destination_address', 'transaction', 'txid', 'broadcast']
+
+class PayResult(Result):
+    command = 'pay'
+    FIELDS = ['destination_address', 'amount', 'change', 'transaction', 'txid', 'broadcast']
+
+class BroadcastResult(Result):
+    """The result of broadcast.
+
+    transactions has the txid, status and any error for each transaction, and endpoints has the stats of each endpoint.
+    """
+    command = 'broadcast'
+    FIELDS = ['transactions', 'endpoints']
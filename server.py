@@ -0,0 +1,234 @@
+#!/usr/bin/python
+
+# A long-running JSON-RPC server for the contract engine, used by the "serve" command of realitykeysdemo.py.
+#
+# Running a command for each contract means starting Python, importing pybitcointools, reading the seed,
+# and opening new connections to the Reality Keys API every time. The server does all that once,
+# then keeps the seed, fact cache, UTXO index, broadcaster and HTTP connections warm between calls.
+#
+# Requests are JSON-RPC 2.0, POSTed over HTTP to a local port, or to a Unix socket, eg:
+#    ./realitykeysdemo.py serve --port 8339
+#    curl -d '{"jsonrpc": "2.0", "id": 1, "method": "makekeys", "params": []}' http://127.0.0.1:8339/
+# Params can be a list, in the same order as the command line arguments, or an object of named arguments.
+# The result is what the command would print with --json, or for the batch commands, the list of result objects.
+# Several requests can be sent at once as a JSON array, as JSON-RPC allows.
+#
+# The methods spend the user's money, so anyone who can reach the server can move it.
+# By default it only listens on 127.0.0.1, and a Unix socket, which only users with access to its path can connect to, is better still.
+# Given a token, every request has to carry it in an "Authorization: Bearer <token>" header, or it's refused with a 401.
+# Listening on any address other than the loopback one is refused unless there's a token.
+
+import os
+import sys
+import hmac
+import types
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import simplejson
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8339
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+# Anything going wrong in the command itself, like not finding enough outputs to spend.
+COMMAND_ERROR = -32000
+
+class ContractRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep connections open between requests, so a client making lots of calls doesn't have to reconnect for each.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        if not self.server.contract_server.authorized(self.headers.getheader('authorization', None)):
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Bearer')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        response = self.server.contract_server.handle(body)
+        if response is None:
+            # Only notifications, which get no reply.
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        if not self.server.contract_server.verbose:
+            return
+        # Clients on a Unix socket don't have an address.
+        address = self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+        sys.stderr.write("%s - - [%s] %s\n" % (address, self.log_date_time_string(), format % args))
+
+class _TCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class RPCError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+def is_loopback(host):
+    """Return True if the host is an address only this machine can connect to.
+    """
+    return host == 'localhost' or host == '::1' or host.startswith('127.')
+
+class ContractServer(object):
+    """Answer JSON-RPC requests by calling the functions in methods, with the settings shared between all the calls.
+
+    methods is a dictionary of method name to a function taking the settings and then the params, like realitykeysdemo.execute_setup.
+    address is a (host, port) pair to listen for HTTP on, or the path of a Unix socket. If the port is 0, a free one is chosen.
+    Calls are run one at a time, as the commands assume nothing else is spending the same outputs while they work.
+    If a token is given, requests without it as a bearer token are refused. A host other than a loopback address needs one.
+    """
+
+    def __init__(self, settings, methods, address=(DEFAULT_HOST, DEFAULT_PORT), verbose=False, token=None):
+        if not isinstance(address, basestring) and not is_loopback(address[0]) and not token:
+            raise Exception("Refusing to listen on %s without a token, as anyone who could reach it could spend your money. Use a Unix socket, or give a token." % (address[0]))
+        self.settings = settings
+        self.methods = methods
+        self.verbose = verbose
+        self.token = token
+        self.calls = 0
+        self._lock = threading.Lock()
+        if isinstance(address, basestring):
+            if os.path.exists(address):
+                os.remove(address)
+            self._server = _UnixServer(address, ContractRequestHandler)
+        else:
+            self._server = _TCPServer(address, ContractRequestHandler)
+        self._server.contract_server = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    @property
+    def url(self):
+        """The URL to POST requests to, if we're listening on a port.
+        """
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s/' % (host, port)
+
+    def authorized(self, authorization):
+        """Return True if a request with this Authorization header, or None if it had none, should be answered.
+        """
+        if not self.token:
+            return True
+        if authorization is None or not authorization.startswith('Bearer '):
+            return False
+        return hmac.compare_digest(authorization[len('Bearer '):].strip(), self.token)
+
+    def handle(self, body):
+        """Return the JSON response to a JSON-RPC request, or None if it only contained notifications.
+        """
+        try:
+            request = simplejson.loads(body)
+        except ValueError:
+            return simplejson.dumps(error_response(None, PARSE_ERROR, "Parse error"))
+        if isinstance(request, list):
+            if len(request) == 0:
+                return simplejson.dumps(error_response(None, INVALID_REQUEST, "Empty batch"))
+            responses = [r for r in [self.handle_request(r) for r in request] if r is not None]
+            if len(responses) == 0:
+                return None
+            return simplejson.dumps(responses)
+        response = self.handle_request(request)
+        if response is None:
+            return None
+        return simplejson.dumps(response)
+
+    def handle_request(self, request):
+        """Return the response to a single JSON-RPC request, already parsed, or None if it was a notification.
+        """
+        if not isinstance(request, dict) or not isinstance(request.get('method', None), basestring):
+            return error_response(None, INVALID_REQUEST, "Invalid request")
+        request_id = request.get('id', None)
+        try:
+            result = self.call(request['method'], request.get('params', []))
+        except RPCError as e:
+            response = error_response(request_id, e.code, str(e))
+        except Exception as e:
+            response = error_response(request_id, COMMAND_ERROR, str(e))
+        else:
+            response = {'jsonrpc': '2.0', 'result': result, 'id': request_id}
+        if 'id' not in request:
+            return None
+        return response
+
+    def call(self, method, params):
+        """Call the named method with the params, a list or dictionary, and return the result.
+        """
+        func = self.methods.get(method, None)
+        if func is None:
+            raise RPCError(METHOD_NOT_FOUND, "Method not found: %s" % (method))
+        if isinstance(params, list):
+            args, kwargs = params, {}
+        elif isinstance(params, dict):
+            args, kwargs = [], dict((str(k), v) for k, v in params.items())
+        else:
+            raise RPCError(INVALID_PARAMS, "Params should be a list or an object")
+        check_params(func, method, len(args) + 1, kwargs)
+
+        with self._lock:
+            self.calls = self.calls + 1
+            result = func(self.settings, *args, **kwargs)
+            # The batch commands give us generators, which need running while we hold the lock.
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+        if hasattr(result, 'as_dict'):
+            result = result.as_dict()
+        return result
+
+    def start(self):
+        """Serve requests in a background thread, returning the server.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+        self._server.server_close()
+        if isinstance(self.address, basestring) and os.path.exists(self.address):
+            os.remove(self.address)
+
+def check_params(func, method, count, kwargs):
+    """Raise an RPCError if the function can't be called with count positional arguments and the named ones, rather than a TypeError from inside it.
+    """
+    code = func.func_code
+    names = code.co_varnames[:code.co_argcount]
+    required = code.co_argcount - len(func.func_defaults or ())
+    for name in kwargs:
+        if name not in names[1:]:
+            raise RPCError(INVALID_PARAMS, "Unknown param %s for %s" % (name, method))
+    if count > code.co_argcount:
+        raise RPCError(INVALID_PARAMS, "Too many params for %s, expected at most %d" % (method, code.co_argcount - 1))
+    for name in names[count:required]:
+        if name not in kwargs:
+            raise RPCError(INVALID_PARAMS, "Missing param %s for %s" % (name, method))
+
+def error_response(request_id, code, message):
+    return {'jsonrpc': '2.0', 'error': {'code': code, 'message': message}, 'id': request_id}
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+
+# Local stand-ins for the services realitykeysdemo.py talks to, so it can be tested and benchmarked without the network.
+#
+# FactServer serves fact JSON the same way as the Reality Keys API, from a dictionary of facts you give it.
+# Point realitykeysdemo.py at it with --api-url, or by setting api_url in the settings, eg:
+#    server = FactServer({'3': {'yes_pubkey': ..., 'no_pubkey': ..., 'winner': None, 'winner_privkey': None}})
+#    server.start()
+#    settings['api_url'] = server.api_url
+#
+# It also serves a stream of events, one for each fact as it's resolved, which clients follow by long polling
+# with factclient.FactEvents, so they hear about resolutions as they happen instead of polling each fact.
+# Each event has an id, counting up from 1, and the fact JSON. A client asks for the events after the last id it has seen,
+# and if there aren't any yet, the server holds the request open until there are, or until the wait it asked for is up:
+#    GET /api/v1/events/?since=<id>&wait=<seconds>  ->  {"events": [{"id": ..., "reality_key_id": ..., "fact": {...}}, ...], "last_id": ...}
+# Without since, it answers straight away with no events and the last id, so the client can start from there.
+# Point realitykeysdemo.py at it with --events-url, or by setting events_url in the settings to server.events_url.
+# Facts already resolved when the server is made are the first events. Resolve others while it's running with set_fact.
+#
+# To serve facts from a JSON file of reality_key_id to fact JSON, for trying out claims without the network:
+#    ./standin.py facts.json [--port <port>]
+#
+# BlockSource holds blocks of raw transactions in memory, standing in for a node, to keep a utxoindex.UTXOIndex up to date with sync.
+#
+# RPCServer answers sendrawtransaction like bitcoind's JSON-RPC interface, so broadcast.Broadcaster can be pointed at it, eg:
+#    ./realitykeysdemo.py claim ... --broadcast-endpoint http://127.0.0.1:<port>/
+
+import re
+import sys
+import time
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+import simplejson
+from pybitcointools import txhash
+
+from factclient import is_resolved
+
+FACT_PATH = re.compile(r'^/api/v1/fact/([^/?]+)/?(\?.*)?$')
+EVENTS_PATH = re.compile(r'^/api/v1/events/?(\?.*)?$')
+
+# The longest a client can ask to wait for events, and the most events sent in one response.
+MAX_EVENT_WAIT = 60
+MAX_EVENTS = 1000
+
+class StandinHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class StandinRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer requests with JSON, keeping connections open between requests.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, obj):
+        body = simplejson.dumps(obj)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep quiet, so we don't fill up the test and benchmark output.
+        pass
+
+class FactRequestHandler(StandinRequestHandler):
+
+    def do_GET(self):
+        m = EVENTS_PATH.match(self.path)
+        if m is not None:
+            self.send_events(urlparse.parse_qs((m.group(1) or '?')[1:]))
+            return
+        m = FACT_PATH.match(self.path)
+        if m is None:
+            self.send_json(404, {'error': 'Not found'})
+            return
+        fact_json = self.server.standin.fact(m.group(1))
+        if fact_json is None:
+            self.send_json(404, {'error': 'No such fact'})
+            return
+        self.send_json(200, fact_json)
+
+    def send_events(self, query):
+        try:
+            since = int(query['since'][0]) if 'since' in query else None
+            wait = min(MAX_EVENT_WAIT, float(query.get('wait', ['0'])[0]))
+        except ValueError:
+            self.send_json(400, {'error': 'Bad since or wait'})
+            return
+        events, last_id = self.server.standin.events(since, wait)
+        self.send_json(200, {'events': events, 'last_id': last_id})
+
+class FactServer(object):
+    """Serve facts like the Reality Keys API, on a local port, in a background thread.
+
+    facts is a dictionary of reality_key_id to fact JSON. Use set_fact to change them while the server is running.
+    Each fact that is resolved, or is already when the server is made, goes on the stream of events.
+    If port is 0, a free port is chosen.
+    """
+
+    handler = FactRequestHandler
+
+    def __init__(self, facts=None, host='127.0.0.1', port=0):
+        self._facts = {}
+        self._events = []
+        self._lock = threading.Lock()
+        self._new_events = threading.Condition(self._lock)
+        self._stopping = False
+        for reality_key_id, fact_json in sorted((facts or {}).items()):
+            self._set_fact(str(reality_key_id), fact_json)
+        self.requests = 0
+        self._server = StandinHTTPServer((host, port), self.handler)
+        self._server.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    @property
+    def api_url(self):
+        """The URL to fetch facts from, with %s where the ID goes, as used for api_url in the settings.
+        """
+        return self.url + '/api/v1/fact/%s/?accept_terms_of_service=current'
+
+    def fact(self, reality_key_id):
+        with self._lock:
+            self.requests = self.requests + 1
+            return self._facts.get(str(reality_key_id), None)
+
+    @property
+    def events_url(self):
+        """The URL to follow the stream of fact resolutions at, as used for events_url in the settings.
+        """
+        return self.url + '/api/v1/events/'
+
+    def set_fact(self, reality_key_id, fact_json):
+        with self._lock:
+            self._set_fact(str(reality_key_id), fact_json)
+            self._new_events.notify_all()
+
+    def _set_fact(self, reality_key_id, fact_json):
+        was_resolved = is_resolved(self._facts.get(reality_key_id, None) or {})
+        self._facts[reality_key_id] = fact_json
+        if is_resolved(fact_json) and not was_resolved:
+            self._events.append({'id': len(self._events) + 1, 'reality_key_id': reality_key_id, 'fact': fact_json})
+
+    def events(self, since=None, wait=0):
+        """Return a list of the events after the id since, and the id of the last event.
+
+        If there are none yet, wait up to wait seconds for one. If since is None, return no events straight away.
+        """
+        with self._lock:
+            if since is None:
+                return [], len(self._events)
+            deadline = time.time() + wait
+            while len(self._events) <= since and not self._stopping:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._new_events.wait(remaining)
+            return self._events[since:since + MAX_EVENTS], len(self._events)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # Let go of any clients waiting for events, so they aren't left hanging.
+        with self._lock:
+            self._stopping = True
+            self._new_events.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+class BlockSource(object):
+    """Hold a chain of blocks of raw transactions in memory, as a stand-in for a node, to feed a utxoindex.UTXOIndex with sync.
+    """
+
+    def __init__(self):
+        self._blocks = []
+        self._lock = threading.Lock()
+
+    @property
+    def height(self):
+        return len(self._blocks)
+
+    def add_block(self, transactions):
+        """Add a block of raw transactions to the end of the chain, returning its height.
+        """
+        with self._lock:
+            self._blocks.append(list(transactions))
+            return len(self._blocks)
+
+    def blocks_since(self, height):
+        """Return a list of (height, transactions) for each block after the given height.
+        """
+        with self._lock:
+            return [(h + 1, list(self._blocks[h])) for h in range(height, len(self._blocks))]
+
+class RPCRequestHandler(StandinRequestHandler):
+
+    def do_POST(self):
+        try:
+            request = simplejson.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        except ValueError:
+            self.send_json(500, {'result': None, 'error': {'code': -32700, 'message': 'Parse error'}, 'id': None})
+            return
+        try:
+            result = self.server.standin.call(request.get('method', None), request.get('params', []))
+        except RPCServerError as e:
+            self.send_json(500, {'result': None, 'error': {'code': e.code, 'message': str(e)}, 'id': request.get('id', None)})
+            return
+        self.send_json(200, {'result': result, 'error': None, 'id': request.get('id', None)})
+
+class RPCServerError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+class RPCServer(FactServer):
+    """Accept transactions with the sendrawtransaction call of bitcoind's JSON-RPC interface, on a local port, in a background thread.
+
+    Transactions received go in the mempool. If there's a block_source, mine puts them in a block there.
+    estimatefee answers with fee_rate, in BTC per 1000 bytes, or -1 if it's None, as bitcoind does until it has enough data.
+    To test retries and slow endpoints, set fail to the number of calls to refuse, and delay to the seconds to wait before answering.
+    """
+
+    handler = RPCRequestHandler
+
+    def __init__(self, block_source=None, host='127.0.0.1', port=0):
+        FactServer.__init__(self, None, host, port)
+        self.block_source = block_source
+        self.mempool = []
+        self.fail = 0
+        self.delay = 0
+        self.fee_rate = None
+
+    def call(self, method, params):
+        with self._lock:
+            self.requests = self.requests + 1
+            fail = self.fail > 0
+            if fail:
+                self.fail = self.fail - 1
+        if self.delay > 0:
+            time.sleep(self.delay)
+        if fail:
+            raise RPCServerError(-1, "Refusing, as asked")
+        if method == 'sendrawtransaction':
+            return self.sendrawtransaction(params[0])
+        if method == 'getblockcount':
+            return 0 if self.block_source is None else self.block_source.height
+        if method == 'estimatefee':
+            return -1 if self.fee_rate is None else self.fee_rate
+        raise RPCServerError(-32601, "Method not found")
+
+    def sendrawtransaction(self, tx):
+        txid = txhash(tx)
+        with self._lock:
+            if tx in self.mempool:
+                raise RPCServerError(-26, "txn-already-in-mempool")
+            self.mempool.append(tx)
+        return txid
+
+    def mine(self):
+        """Put the transactions in the mempool in a new block in the block source, returning its height.
+        """
+        with self._lock:
+            transactions = self.mempool
+            self.mempool = []
+        return self.block_source.add_block(transactions)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve facts like the Reality Keys API, and a stream of their resolutions, from a JSON file.')
+    parser.add_argument('facts', help='A JSON file of reality_key_id to fact JSON.')
+    parser.add_argument('--port', type=int, default=0, help='The port to serve on. Defaults to any free port.')
+    args = parser.parse_args()
+
+    with open(args.facts) as f:
+        facts = simplejson.load(f)
+    server = FactServer(facts, port=args.port).start()
+    print "--api-url %s --events-url %s" % (server.api_url, server.events_url)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,56 @@
 #!/usr/bin/python
 
 import realitykeysdemo
+import factclient
+import factstore
+import watcher
+import lrucache
+import ecbackend
+import standin
+import instrument
+import coinselect
+import utxoindex
+import rawtx
+import hdkeys
+import verify
+import ledger
+import fees
+import broadcast
+import server
+import multiprocessing
+import os
+import tempfile
+import gzip
+import pickle
+import socket
+import subprocess
+import sys
+import time
+import threading
+import simplejson
 import unittest
 from unittest import TestCase
 from pybitcointools import * # https://github.com/vbuterin/pybitcointools
 
+def decided_facts():
+    """Make some facts decided in favour of yes with keys we know, so that claims can be tested without fetching them.
+
+    Fact 103 hasn't been decided yet.
+    """
+    facts = {}
+    for fact_id in ['101', '102', '103']:
+        yes_priv = sha256('yes-' + fact_id)
+        no_priv = sha256('no-' + fact_id)
+        facts[fact_id] = {
+            'yes_pubkey': compress(privtopub(yes_priv)),
+            'no_pubkey': compress(privtopub(no_priv)),
+            'winner': 'Yes',
+            'winner_privkey': yes_priv
+        }
+    facts['103']['winner'] = None
+    facts['103']['winner_privkey'] = None
+    return facts
+
 class RealityKeysDemoTestCast(TestCase):
 
     # You can leave these as they are if you like, but don't be surprised if your transactions get spent out from under you while you're working on them...
@@ -47,6 +93,18 @@ class RealityKeysDemoTestCast(TestCase):
 
     normal_claim_tx_no_wins = '0100000001a3f0c901f726db5127fa45e74d23c30ea7a65e65eecded5c15f1f6d2c4b0827500000000fd6901004930460221008328683009415759039a726fb887856b89d98798bed4ab471071999f29b8c0930221009a2c8ac22d6e55505abaaad78f97c14cc11605e6cdf4eb8fce65cf6a491e608001493046022100ec49e507275dad01011de967b5f4294a3dd29f7eee81597bf3e02751475fe234022100fae39d29f588001dca3c9aef384ff30da7e33333621244d580c9539a2c0b1f5601004cd163524104e08a571e7a61d03fb293be00a8a3e106dfc78cc47e6ef7e088850f3883b22deaa4c904b7e9e96f6ce70a2e9c7a060374f3bbf3d5b081d68d98e6e73ec0093b222103ea19d70a96a072a1881a6177ab47144168f19f9648675eb189e35e4bde4b16cd52ae6752410460d353f4c834bccd1a0e690dc5b7a3c0e07f1ed916f05234ea539c08c0792f3ee90b7704a329e6e0a9e4cda2eb156ac6b1721f53a308d2bda2cce56efa925ddd21036d4f24332e9c49861591558f074a112f9718e47383c394106325ac5b65b9cd3052ae68ffffffff0120bf0200000000001976a9141244121c9220e72451a8200497f0f4fa1eed0e3788ac00000000'
 
+    # The public keys of the facts above, as recorded in the claim transactions, so that setup can be tested without fetching them.
+    facts = {
+        '3': {
+            'yes_pubkey': '0339c1817d51455acebcd4f6c0d0dcda537becf2d2ac34f4209cd31e28cab6d195',
+            'no_pubkey': '02882b16fb1e677ed36d73c64db841dad33df045771596285988428f59a8e3e346'
+        },
+        '1': {
+            'yes_pubkey': '03ea19d70a96a072a1881a6177ab47144168f19f9648675eb189e35e4bde4b16cd',
+            'no_pubkey': '036d4f24332e9c49861591558f074a112f9718e47383c394106325ac5b65b9cd30'
+        }
+    }
+
     def test_make_keys(self):
 
         alice_priv = realitykeysdemo.user_private_key(False, self.alice_seed)
@@ -70,6 +128,21 @@ class RealityKeysDemoTestCast(TestCase):
         self.assertNotEqual( out[1], self.bob_addr_mainnet)
         self.assertEqual( out[1], self.bob_addr_testnet)
 
+    def test_ec_backends(self):
+        alice_priv = realitykeysdemo.user_private_key(False, self.alice_seed)
+        yes_rk = self.facts['3']['yes_pubkey']
+        winner_privkey = sha256('yes-3')
+        for name in ecbackend.BACKENDS:
+            try:
+                backend = ecbackend.get_backend(name)
+            except ImportError:
+                continue
+            self.assertEqual(backend.privtopub(alice_priv), self.alice_pub)
+            self.assertEqual(backend.add_pubkeys(self.alice_pub, yes_rk), add_pubkeys(self.alice_pub, yes_rk))
+            self.assertEqual(backend.add_pubkeys(yes_rk, self.alice_pub), add_pubkeys(yes_rk, self.alice_pub))
+            self.assertEqual(backend.add_privkeys(alice_priv, winner_privkey), add_privkeys(alice_priv, winner_privkey))
+            self.assertEqual(backend.privtopub(add_privkeys(alice_priv, winner_privkey)), privtopub(add_privkeys(alice_priv, winner_privkey)))
+
     def test_unspent_outputs(self):
         addr = "mhBY19Pg1JkXQLHuuv72YxtSHy3Acje1NJ"
         ret = realitykeysdemo.unspent_outputs(addr, self.ecc_inputs)
@@ -165,6 +238,337 @@ class RealityKeysDemoTestCast(TestCase):
         #print bob_tx
         self.assertNotEqual(alice_tx, bob_tx)
 
+    def test_setup_batch(self):
+        settings = {
+            'seed': self.alice_seed,
+            'testnet': True,
+            'no_pushtx': True,
+            'ecc_voodoo': False,
+            'inputs': self.normal_inputs_yes_wins + self.normal_inputs_no_wins,
+            'facts': dict(self.facts)
+        }
+        contracts = [
+            {'reality_key_id': self.yes_fact_id, 'yes_key': self.alice_pub, 'yes_stake': 90000, 'no_key': self.bob_pub, 'no_stake': 90000},
+            {'reality_key_id': self.yes_fact_id, 'yes_key': self.alice_pub, 'yes_stake': 150000, 'no_key': self.bob_pub, 'no_stake': 90000},
+            {'reality_key_id': self.yes_fact_id, 'yes_key': self.alice_pub, 'yes_stake': 250000, 'no_key': self.bob_pub, 'no_stake': 90000},
+        ]
+        results = list(realitykeysdemo.execute_setup_batch(settings, contracts))
+        self.assertEqual(len(results), 3)
+        self.assertFalse(results[0]['complete'])
+
+        # Alice has two outputs of 100000, so she can stake 150000 with both of them, getting change...
+        tx = deserialize(results[1]['transaction'])
+        self.assertEqual(len(tx['ins']), 3)
+        self.assertEqual(tx['outs'][1]['value'], 200000 - 150000 - fees.DEFAULT_FEE_RATE/2)
+        self.assertEqual(tx['outs'][1]['script'], address_to_script(self.alice_addr_testnet))
+        # ...but she can't stake 250000.
+        self.assertTrue('error' in results[2])
+
+        # Bob completes the one that could be made.
+        settings['seed'] = self.bob_seed
+        contracts[0]['transaction'] = results[0]['transaction']
+        results = list(realitykeysdemo.execute_setup_batch(settings, contracts[:1]))
+        self.assertTrue(results[0]['complete'])
+        self.assertEqual(results[0]['transaction'], self.normal_claimable_tx_yes_wins)
+
+    def test_setup_aggregate(self):
+        index = utxoindex.UTXOIndex.from_inputs(self.normal_inputs_yes_wins + self.normal_inputs_no_wins)
+        settings = {'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'inputs': index, 'facts': decided_facts()}
+        # Alice is yes in one and no in the other, so each of them stakes 110000 in all.
+        contracts = [
+            {'reality_key_id': 101, 'yes_key': self.alice_pub, 'yes_stake': 60000, 'no_key': self.bob_pub, 'no_stake': 60000},
+            {'reality_key_id': 102, 'yes_key': self.bob_pub, 'yes_stake': 50000, 'no_key': self.alice_pub, 'no_stake': 50000},
+        ]
+        half_signed = realitykeysdemo.execute_setup_aggregate(settings, contracts)
+        self.assertFalse(half_signed.complete)
+        self.assertEqual([(f['address'], f['amount']) for f in half_signed.fundings], [(self.alice_addr_testnet, 110000), (self.bob_addr_testnet, 110000)])
+
+        settings['seed'] = self.bob_seed
+        complete = realitykeysdemo.execute_setup_aggregate(settings, contracts, half_signed.transaction)
+        self.assertTrue(complete.complete)
+        # One transaction pays both contracts, with one fee shared between them, and sends the rest back as change.
+        tx = deserialize(complete.transaction)
+        self.assertEqual(len(tx['ins']), 4)
+        self.assertEqual([o['value'] for o in tx['outs']], [120000, 100000, 200000 - 110000 - fees.DEFAULT_FEE_RATE/2, 200000 - 110000 - fees.DEFAULT_FEE_RATE/2])
+        self.assertEqual([o['script'] for o in tx['outs'][:2]], [address_to_script(c['p2sh_address']) for c in complete.contracts])
+        for i, inp in enumerate(tx['ins']):
+            self.assertTrue(verify_tx_input(complete.transaction, i, mk_pubkey_script(self.alice_addr_testnet if i < 2 else self.bob_addr_testnet), deserialize_script(inp['script'])[0], deserialize_script(inp['script'])[1]))
+
+        # The winner of each can claim it as usual.
+        claim = realitykeysdemo.execute_claim(settings, 102, self.bob_pub, self.alice_pub, 10000)
+        self.assertEqual((claim.status, claim.amount), ('claimed', 90000))
+        self.assertEqual(deserialize(claim.transaction)['ins'][0]['outpoint'], {'hash': complete.txid, 'index': 1})
+
+        # Contracts with anyone else have to be funded separately.
+        contracts.append({'reality_key_id': 101, 'yes_key': self.alice_pub, 'yes_stake': 1000, 'no_key': privtopub(sha256('carol')), 'no_stake': 1000})
+        self.assertRaises(Exception, realitykeysdemo.execute_setup_aggregate, settings, contracts)
+
+    def test_claim_waits_for_event(self):
+        facts = decided_facts()
+        undecided = dict(facts['101'], winner=None, winner_privkey=None)
+        settings = {'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'facts': facts, 'inputs': self.normal_inputs_yes_wins}
+        half_signed = realitykeysdemo.execute_setup(settings, '101', self.alice_pub, 90000, self.bob_pub, 90000)
+        complete = realitykeysdemo.execute_setup(dict(settings, seed=self.bob_seed), '101', self.alice_pub, 90000, self.bob_pub, 90000, half_signed.transaction)
+
+        # The fact hasn't been decided when Alice starts waiting to claim, and is while she's listening.
+        server = standin.FactServer({'101': undecided}).start()
+        try:
+            settings = {'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'inputs': [':' + complete.txid + ':0:180000'],
+                        'fact_client': factclient.FactClient(server.api_url, retries=0), 'events_url': server.events_url, 'wait': True}
+            timer = threading.Timer(0.2, server.set_fact, ['101', facts['101']])
+            timer.start()
+            claim = realitykeysdemo.execute_claim(settings, '101', self.alice_pub, self.bob_pub, None)
+            timer.join()
+        finally:
+            server.stop()
+        self.assertEqual((claim.status, claim.amount), ('claimed', 170000))
+        # The fact was only fetched once, before it was decided. We heard about the decision from the event.
+        self.assertEqual(server.requests, 1)
+
+    def test_contract_keys(self):
+        fd, keys_file = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            alice = {'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'facts': decided_facts(), 'keys_file': keys_file}
+            made = realitykeysdemo.execute_makekeys(alice, 101)
+            # The key is the BIP32 hardened child m/0'/101' of the seed.
+            xpriv = bip32_ckd(bip32_ckd(bip32_master_key(self.alice_seed), 2**31), 2**31 + 101)
+            self.assertEqual(made.public_key, privtopub(bip32_extract_key(xpriv)[:64]))
+            self.assertNotEqual(made.public_key, self.alice_pub)
+            self.assertNotEqual(realitykeysdemo.execute_makekeys(alice, 102).address, made.address)
+
+            # The public keys are kept in the file, so another run can find which contract a key is for without deriving them all again.
+            keys = hdkeys.ContractKeys(self.alice_seed, keys_file)
+            self.assertEqual(keys.contract_id(made.public_key), 101)
+            self.assertEqual(hdkeys.ContractKeys(self.bob_seed, keys_file).contract_id(made.public_key), None)
+
+            # Alice funds the contract from its own address, and Bob from his usual one.
+            inputs = [made.address + ':' + sha256('contract') + ':0:100000', self.normal_inputs_yes_wins[0]]
+            half_signed = realitykeysdemo.execute_setup(dict(alice, inputs=inputs), 101, made.public_key, 90000, self.bob_pub, 90000)
+            bob = {'seed': self.bob_seed, 'testnet': True, 'no_pushtx': True, 'facts': decided_facts(), 'inputs': inputs}
+            complete = realitykeysdemo.execute_setup(bob, 101, made.public_key, 90000, self.bob_pub, 90000, half_signed.transaction)
+            self.assertTrue(complete.complete)
+
+            # Without the file, the key for the contract with the same id as the fact is found anyway. The winnings go to Alice's usual address.
+            claim = realitykeysdemo.execute_claim({'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'facts': decided_facts(), 'inputs': [':' + complete.txid + ':0:180000']}, 101, made.public_key, self.bob_pub, 10000)
+            self.assertEqual(claim.status, 'claimed')
+            self.assertEqual(claim.destination_address, self.alice_addr_testnet)
+
+            refund = realitykeysdemo.execute_pay(dict(alice, inputs=inputs), self.alice_addr_testnet, 50000, 10000, 101)
+            self.assertEqual(deserialize(refund.transaction)['ins'][0]['outpoint']['hash'], sha256('contract'))
+
+            # Looking for a key that turns out not to be ours leaves no file behind, and finding one saves it there.
+            new_keys_file = keys_file + '-new'
+            fresh = {'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'facts': decided_facts(), 'keys_file': new_keys_file, 'inputs': inputs}
+            self.assertRaises(Exception, realitykeysdemo.execute_setup, dict(fresh), 102, self.bob_pub, 90000, privtopub(sha256('carol')), 90000)
+            self.assertFalse(os.path.exists(new_keys_file))
+            realitykeysdemo.execute_claim(dict(fresh, inputs=[':' + complete.txid + ':0:180000']), 101, made.public_key, self.bob_pub, 10000)
+            self.assertEqual(hdkeys.ContractKeys(self.alice_seed, new_keys_file).contract_id(made.public_key), 101)
+        finally:
+            for filename in [keys_file, keys_file + '-new']:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def test_setup_rejects_changed_transaction(self):
+        settings = {'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'inputs': self.normal_inputs_yes_wins, 'facts': dict(self.facts)}
+        half_signed = rawtx.RawTransaction.from_hex(realitykeysdemo.execute_setup(settings, self.yes_fact_id, self.alice_pub, 90000, self.bob_pub, 90000).transaction)
+        # Keep Alice's signature, but pay the contract somewhere else, as a dishonest counterparty might.
+        other = rawtx.make_transaction([], [{'address': self.alice_addr_testnet, 'value': 180000}])
+        changed = rawtx.RawTransaction(half_signed.data[:half_signed.outputs_start] + other.data[other.outputs_start:])
+        settings['seed'] = self.bob_seed
+        self.assertRaises(Exception, realitykeysdemo.execute_setup, settings, self.yes_fact_id, self.alice_pub, 90000, self.bob_pub, 90000, changed.hex())
+        self.assertTrue(realitykeysdemo.execute_setup(settings, self.yes_fact_id, self.alice_pub, 90000, self.bob_pub, 90000, half_signed.hex()).complete)
+
+    def test_setup_rejects_bad_signature(self):
+        settings = {'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'inputs': self.normal_inputs_yes_wins, 'facts': dict(self.facts)}
+        half_signed = rawtx.RawTransaction.from_hex(realitykeysdemo.execute_setup(settings, self.yes_fact_id, self.alice_pub, 90000, self.bob_pub, 90000).transaction)
+        # The same transaction, but with Alice's input signed by the wrong key, so the network would refuse it.
+        forged = rawtx.sign(half_signed, 0, sha256(self.bob_seed))
+        settings['seed'] = self.bob_seed
+        with self.assertRaisesRegexp(Exception, "signature for input 0"):
+            realitykeysdemo.execute_setup(settings, self.yes_fact_id, self.alice_pub, 90000, self.bob_pub, 90000, forged.hex())
+
+    def test_results(self):
+        settings = {'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'inputs': self.normal_inputs_yes_wins, 'facts': dict(self.facts)}
+        quiet = realitykeysdemo.execute_setup(settings, self.yes_fact_id, self.alice_pub, 90000, self.bob_pub, 90000)
+        verbose = realitykeysdemo.execute_setup(dict(settings, verbose=True), self.yes_fact_id, self.alice_pub, 90000, self.bob_pub, 90000)
+        # The lines differ, but the transaction is the same, without having to know where to look for it.
+        self.assertEqual(quiet.transaction, quiet[0])
+        self.assertEqual(verbose.transaction, quiet.transaction)
+        self.assertFalse(quiet.complete)
+        self.assertEqual(quiet.txid, None)
+        self.assertTrue(quiet.next_step.endswith(quiet.transaction))
+        self.assertEqual([f['funded'] for f in quiet.fundings], [True, True])
+        self.assertEqual(pickle.loads(pickle.dumps(quiet, 2)).as_dict(), quiet.as_dict())
+
+        settings['seed'] = self.bob_seed
+        complete = realitykeysdemo.execute_setup(settings, self.yes_fact_id, self.alice_pub, 90000, self.bob_pub, 90000, quiet.transaction)
+        self.assertTrue(complete.complete)
+        self.assertEqual(complete.txid, txhash(self.normal_claimable_tx_yes_wins))
+        self.assertEqual(deserialize(complete.transaction)['outs'][0]['script'], address_to_script(complete.p2sh_address))
+
+        unfunded = realitykeysdemo.execute_setup(settings, self.yes_fact_id, self.alice_pub, 250000, self.bob_pub, 90000)
+        self.assertEqual(unfunded.transaction, None)
+        self.assertEqual([(f['side'], f['funded']) for f in unfunded.fundings], [('yes', False), ('no', True)])
+
+        settings['facts'] = decided_facts()
+        undecided = realitykeysdemo.execute_claim(settings, '103', self.alice_pub, self.bob_pub, 10000)
+        self.assertEqual(undecided.status, 'undecided')
+        self.assertEqual(undecided.as_dict()['command'], 'claim')
+
+    def test_claim_batch(self):
+        facts = decided_facts()
+        inputs = []
+        for fact_id in ['101', '102']:
+            script = realitykeysdemo.mk_multisig_script_if_else([[self.alice_pub, facts[fact_id]['yes_pubkey']], [self.bob_pub, facts[fact_id]['no_pubkey']]])
+            inputs.append(p2sh_scriptaddr(script) + ':' + sha256(fact_id) + ':0:180000')
+        settings = {
+            'seed': self.alice_seed,
+            'testnet': True,
+            'no_pushtx': True,
+            'inputs': inputs,
+            'facts': facts
+        }
+        contracts = [{'reality_key_id': fact_id, 'yes_key': self.alice_pub, 'no_key': self.bob_pub} for fact_id in ['101', '102', '103']]
+
+        results = dict((r['reality_key_id'], r) for r in realitykeysdemo.execute_claim_batch(settings, contracts, 10000))
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results['101']['transaction'], realitykeysdemo.execute_claim(settings, '101', self.alice_pub, self.bob_pub, 10000)[0])
+        self.assertTrue('transaction' in results['102'])
+        self.assertTrue('error' in results['103'])
+
+        results = list(realitykeysdemo.execute_claim_batch(settings, contracts, 10000, True))
+        self.assertEqual(len(results), 2)
+        self.assertTrue('error' in results[0])
+        self.assertEqual(results[1]['reality_key_ids'], ['101', '102'])
+        self.assertEqual([c['reality_key_id'] for c in results[1]['contracts']], ['101', '102'])
+        tx_obj = deserialize(results[1]['transaction'])
+        self.assertEqual(len(tx_obj['ins']), 2)
+        self.assertEqual(tx_obj['outs'][0]['value'], 350000)
+
+        # A contract with none of our keys in it will never be claimed, and says so.
+        theirs = {'reality_key_id': '101', 'yes_key': privtopub(sha256('carol')), 'no_key': self.bob_pub}
+        for merge in [False, True]:
+            result = list(realitykeysdemo.execute_claim_batch(settings, [theirs], 10000, merge))[0]
+            self.assertEqual((result['status'], result['yes_key']), ('not_ours', theirs['yes_key']))
+
+    def test_claim_every_output(self):
+        # The contract on fact 101 was funded in two outputs, and the claims spend them both.
+        facts = decided_facts()
+        inputs = []
+        for fact_id, n, value in [('101', 0, 180000), ('101', 1, 50000), ('102', 0, 180000)]:
+            script = realitykeysdemo.mk_multisig_script_if_else([[self.alice_pub, facts[fact_id]['yes_pubkey']], [self.bob_pub, facts[fact_id]['no_pubkey']]])
+            inputs.append(p2sh_scriptaddr(script) + ':' + sha256(fact_id) + ':%d:%d' % (n, value))
+        settings = {'seed': self.alice_seed, 'testnet': True, 'no_pushtx': True, 'inputs': inputs, 'facts': facts}
+
+        claim = realitykeysdemo.execute_claim(settings, '101', self.alice_pub, self.bob_pub, None)
+        self.assertEqual(claim.amount, 230000 - 10000)
+        # Unless it's asked to work out the fee, execute_claim pays none, as it always has.
+        self.assertEqual(realitykeysdemo.execute_claim(settings, '102', self.alice_pub, self.bob_pub).amount, 180000)
+        tx = rawtx.RawTransaction.from_hex(claim.transaction)
+        self.assertEqual(len(tx.inputs), 2)
+        for i in range(2):
+            self.assertTrue(realitykeysdemo.verifier(settings).is_valid(tx, i, address_to_script(claim.p2sh_address).decode('hex')))
+
+        contracts = [{'reality_key_id': fact_id, 'yes_key': self.alice_pub, 'no_key': self.bob_pub} for fact_id in ['101', '102']]
+        merged = list(realitykeysdemo.execute_claim_batch(settings, contracts, None, True))
+        self.assertEqual(merged[0]['reality_key_ids'], ['101', '102'])
+        tx = rawtx.RawTransaction.from_hex(merged[0]['transaction'])
+        self.assertEqual(len(tx.inputs), 3)
+        # Three inputs with two signatures each take it past 1000 bytes, so the fee is for two.
+        self.assertEqual(deserialize(merged[0]['transaction'])['outs'][0]['value'], 410000 - 20000)
+
+    def test_batch_executor(self):
+        facts = decided_facts()
+        inputs = []
+        for fact_id in ['101', '102']:
+            script = realitykeysdemo.mk_multisig_script_if_else([[self.alice_pub, facts[fact_id]['yes_pubkey']], [self.bob_pub, facts[fact_id]['no_pubkey']]])
+            inputs.append(p2sh_scriptaddr(script) + ':' + sha256(fact_id) + ':0:180000')
+        settings = {
+            'seed': self.alice_seed,
+            'testnet': True,
+            'no_pushtx': True,
+            'inputs': inputs,
+            'facts': facts
+        }
+        contracts = [{'reality_key_id': fact_id, 'yes_key': self.alice_pub, 'no_key': self.bob_pub} for fact_id in ['101', '102', '103']]
+
+        serial = list(realitykeysdemo.execute_claim_batch(settings, contracts, 10000))
+        serial_merged = list(realitykeysdemo.execute_claim_batch(settings, contracts, 10000, True))
+
+        # Signing in other processes should make exactly the same transactions.
+        pool = multiprocessing.Pool(2)
+        try:
+            settings['executor'] = pool
+            self.assertEqual(list(realitykeysdemo.execute_claim_batch(settings, contracts, 10000)), serial)
+            self.assertEqual(list(realitykeysdemo.execute_claim_batch(settings, contracts, 10000, True)), serial_merged)
+
+            settings['seed'] = self.alice_seed
+            settings['inputs'] = self.normal_inputs_yes_wins
+            settings['facts'] = dict(self.facts)
+            setup_contracts = [{'reality_key_id': self.yes_fact_id, 'yes_key': self.alice_pub, 'yes_stake': 90000, 'no_key': self.bob_pub, 'no_stake': 90000}]
+            parallel = list(realitykeysdemo.execute_setup_batch(settings, setup_contracts))
+            del settings['executor']
+            self.assertEqual(parallel, list(realitykeysdemo.execute_setup_batch(settings, setup_contracts)))
+        finally:
+            pool.terminate()
+
+    def test_lazy_imports(self):
+        # Commands that don't need them shouldn't wait for the network, storage and parallelism modules to load.
+        check = "import sys, realitykeysdemo; print ' '.join(sorted(m for m in ['sqlite3', 'multiprocessing', 'simplejson', 'coincurve', 'utxoindex', 'broadcast', 'server', 'watcher'] if m in sys.modules))"
+        self.assertEqual(subprocess.check_output([sys.executable, '-c', check], cwd=os.path.dirname(os.path.abspath(__file__))).strip(), '')
+
+    def test_contract_script_cache(self):
+        settings = {'ecc_voodoo': True, 'script_cache': lrucache.LRUCache(1)}
+        yes_rk = self.facts['3']['yes_pubkey']
+        no_rk = self.facts['3']['no_pubkey']
+        script, addr, yes_compound, no_compound = realitykeysdemo.contract_script(settings, self.alice_pub, self.bob_pub, yes_rk, no_rk)
+        self.assertEqual(yes_compound, add_pubkeys(self.alice_pub, yes_rk))
+        self.assertEqual(addr, p2sh_scriptaddr(script))
+        self.assertEqual(realitykeysdemo.contract_script(settings, self.alice_pub, self.bob_pub, yes_rk, no_rk)[0], script)
+        self.assertEqual(settings['script_cache'].stats()['hits'], 1)
+
+        # The same keys make a different script without ECC voodoo, which pushes the first one out of the cache.
+        settings['ecc_voodoo'] = False
+        script2, addr2, yes_compound, no_compound = realitykeysdemo.contract_script(settings, self.alice_pub, self.bob_pub, yes_rk, no_rk)
+        self.assertNotEqual(script, script2)
+        self.assertEqual(yes_compound, None)
+        self.assertEqual(len(settings['script_cache']), 1)
+        self.assertEqual(settings['script_cache'].stats()['misses'], 2)
+
+    def test_profiler(self):
+        server = standin.FactServer(decided_facts()).start()
+        try:
+            profiler = instrument.Profiler()
+            finished = []
+            profiler.subscribe(lambda name, seconds: finished.append(name))
+            settings = {
+                'seed': self.alice_seed,
+                'testnet': True,
+                'no_pushtx': True,
+                'ecc_voodoo': True,
+                'inputs': self.ecc_inputs,
+                'script_cache': lrucache.LRUCache(),
+                'fact_client': factclient.FactClient(server.api_url, retries=0),
+                'profiler': profiler
+            }
+            out = realitykeysdemo.execute_setup(settings, '101', self.alice_pub, 90000, self.bob_pub, 90000, None)
+            self.assertEqual(len(out), 1)
+        finally:
+            server.stop()
+
+        summary = profiler.summary()
+        self.assertEqual(summary['fact_fetch']['calls'], 1)
+        self.assertEqual(summary['unspent']['calls'], 2)
+        self.assertEqual(summary['script']['calls'], 1)
+        # One privtopub for our own key, and two additions for the compound keys, inside the script stage.
+        self.assertEqual(summary['ec']['calls'], 3)
+        self.assertEqual(summary['sign']['calls'], 1)
+        self.assertEqual(summary['pushtx']['calls'], 0)
+        self.assertEqual(len(finished), 8)
+        self.assertTrue('realitykeysdemo_stage_calls_total{stage="unspent"} 2' in profiler.to_prometheus())
+        self.assertEqual(simplejson.loads(profiler.to_json())['sign']['calls'], 1)
+
     def test_claim_ecc_voodoo(self):
         settings = {
             'seed': self.alice_seed,
@@ -245,6 +649,877 @@ class RealityKeysDemoTestCast(TestCase):
         self.assertEqual(tx, self.normal_claim_tx_no_wins)
 
 
+class StubTransport(object):
+    """Serve canned fact JSON instead of fetching it, counting the requests made."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url):
+        self.requests.append(url)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return simplejson.dumps(response)
+
+class FactClientTestCase(TestCase):
+
+    undecided = {'yes_pubkey': '02aa', 'no_pubkey': '02bb', 'winner': None, 'winner_privkey': None}
+    decided = {'yes_pubkey': '02aa', 'no_pubkey': '02bb', 'winner': 'Yes', 'winner_privkey': 'cc'}
+
+    def test_caching(self):
+        transport = StubTransport([self.undecided, self.undecided, self.decided])
+        client = factclient.FactClient('http://localhost/fact/%s/', transport, 0, 0)
+
+        self.assertEqual(client.fact(3, False)['yes_pubkey'], '02aa')
+        # The public keys don't change, so we don't need to ask again for them.
+        self.assertEqual(client.fact(3, False)['no_pubkey'], '02bb')
+        self.assertEqual(transport.requests, ['http://localhost/fact/3/'])
+
+        # The winner might, until it's been published.
+        self.assertEqual(client.fact(3)['winner'], None)
+        self.assertEqual(client.fact(3)['winner'], 'Yes')
+        self.assertEqual(client.fact(3)['winner_privkey'], 'cc')
+        self.assertEqual(len(transport.requests), 3)
+        self.assertEqual(client.hits, 2)
+
+    def test_shared_between_threads(self):
+        # The watcher and the batch commands share a client between threads, and its stats shouldn't lose any lookups.
+        client = factclient.FactClient('http://localhost/fact/%s/', StubTransport([self.decided]), 0, 0)
+        client.fact(3)
+        def look_up():
+            for i in range(500):
+                client.fact(3)
+        threads = [threading.Thread(target=look_up) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((client.fetches, client.hits), (1, 4000))
+
+    def test_retries(self):
+        transport = StubTransport([socket.error("down"), factclient.HTTPError(503, '', "still down"), self.decided])
+        client = factclient.FactClient('http://localhost/fact/%s/', transport, 2, 0)
+        self.assertEqual(client.fact(3)['winner'], 'Yes')
+
+        transport = StubTransport([socket.error("down"), socket.error("still down"), self.decided])
+        client = factclient.FactClient('http://localhost/fact/%s/', transport, 1, 0)
+        self.assertRaises(socket.error, client.fact, 3)
+
+        # Asking for a fact that doesn't exist won't work however many times we try.
+        transport = StubTransport([factclient.HTTPError(404, '', "not found"), self.decided])
+        client = factclient.FactClient('http://localhost/fact/%s/', transport, 2, 0)
+        self.assertRaises(factclient.HTTPError, client.fact, 3)
+        self.assertEqual(len(transport.requests), 1)
+
+    def test_standin_server(self):
+        server = standin.FactServer(decided_facts()).start()
+        try:
+            client = factclient.FactClient(server.api_url, retries=0)
+            self.assertEqual(client.fact('101')['winner'], 'Yes')
+            self.assertEqual(client.fact('103', False)['winner'], None)
+            self.assertRaises(Exception, client.fact, '104')
+            self.assertEqual(server.requests, 3)
+        finally:
+            server.stop()
+
+    def test_fact_events(self):
+        facts = decided_facts()
+        server = standin.FactServer(facts).start()
+        try:
+            client = factclient.FactClient(server.api_url, retries=0)
+            # The facts already resolved are the first events, so following the stream from the start replays them.
+            replay = factclient.FactEvents(server.events_url)
+            replay.last_id = 0
+            self.assertEqual([reality_key_id for reality_key_id, fact_json in replay.poll(0)], ['101', '102'])
+
+            events = factclient.FactEvents(server.events_url, client=client)
+            events.subscribe()
+            self.assertEqual(events.last_id, 2)
+            self.assertEqual(events.poll(0), [])
+
+            # We hear about a fact as soon as it's resolved, without waiting out the poll.
+            resolved = dict(facts['103'], winner='No', winner_privkey=sha256('no-103'))
+            timer = threading.Timer(0.2, server.set_fact, ['103', resolved])
+            timer.start()
+            started = time.time()
+            self.assertEqual(events.poll(10), [('103', resolved)])
+            self.assertTrue(time.time() - started < 5)
+            timer.join()
+
+            # And the client already has it.
+            self.assertEqual(client.fact('103'), resolved)
+            self.assertEqual(server.requests, 0)
+        finally:
+            server.stop()
+class CoinSelectTestCase(TestCase):
+
+    def outputs(self, values):
+        return [{'output': sha256(str(i)) + ':0', 'value': v} for i, v in enumerate(values)]
+
+    def test_selection(self):
+        outputs = self.outputs([70000, 20000, 50000, 30000, 100000])
+        selector = coinselect.CoinSelector(outputs)
+
+        # A single output if there's one in range, otherwise a combination that needs no change, kept in the order they came in.
+        self.assertEqual(selector.select(95000, 5000), ([outputs[4]], 5000))
+        self.assertEqual(selector.select(80000, 0), ([outputs[2], outputs[3]], 0))
+        self.assertEqual(selector.select(120000, 1000), ([outputs[1], outputs[4]], 0))
+
+        # Failing that, as close as we can get, leaving change.
+        selected, excess = selector.select(115000, 1000)
+        self.assertEqual(sum([o['value'] for o in selected]) - 115000, excess)
+        self.assertEqual(excess, 5000)
+
+        self.assertEqual(selector.select(270001, 0), (None, 0))
+
+    def test_many_outputs(self):
+        outputs = self.outputs([1000 + (i * 7919) % 1000000 for i in range(5000)])
+        selector = coinselect.CoinSelector(outputs)
+        selected, excess = selector.select(123456789, 5000)
+        self.assertTrue(sum([o['value'] for o in selected]) >= 123456789)
+        # Deterministic, whichever order the outputs come in.
+        self.assertEqual(coinselect.CoinSelector(list(reversed(outputs))).select(123456789, 5000)[1], excess)
+
+class RawTransactionTestCase(TestCase):
+
+    fixtures = RealityKeysDemoTestCast
+
+    def setUp(self):
+        self.alice_priv = sha256(self.fixtures.alice_seed)
+        self.bob_priv = sha256(self.fixtures.bob_seed)
+        self.inputs = [{'output': sha256('coinbase') + ':%d' % i, 'value': 100000} for i in range(3)]
+        self.outputs = [{'address': self.fixtures.alice_addr_testnet, 'value': 150000}, {'address': self.fixtures.bob_addr_testnet, 'value': 140000}]
+
+    def test_same_as_pybitcointools(self):
+        tx = mktx(self.inputs, self.outputs)
+        raw = rawtx.make_transaction(self.inputs, self.outputs)
+        self.assertEqual(raw.hex(), tx)
+        self.assertEqual([raw.outpoint_string(i) for i in range(3)], [i['output'] for i in self.inputs])
+        self.assertEqual(list(raw.outputs()), [(o['value'], address_to_script(o['address']).decode('hex')) for o in self.outputs])
+
+        for i in range(3):
+            tx = sign(tx, i, self.alice_priv)
+            raw = rawtx.sign(raw, i, self.alice_priv)
+            self.assertEqual(raw.hex(), tx)
+            # The positions shifted by splicing in the script are the ones we'd find parsing it again.
+            self.assertEqual(raw.inputs, rawtx.RawTransaction(raw.data).inputs)
+        self.assertTrue(raw.is_fully_signed())
+        self.assertEqual(raw.txid(), txhash(tx))
+
+        script = mk_multisig_script([self.fixtures.alice_pub, self.fixtures.bob_pub], 2)
+        tx = mktx(self.inputs, self.outputs)
+        raw = rawtx.make_transaction(self.inputs, self.outputs)
+        sigs = [multisign(tx, 1, script, k) for k in [self.alice_priv, self.bob_priv]]
+        raw_sigs = [rawtx.multisign(raw, 1, script.decode('hex'), k) for k in [self.alice_priv, self.bob_priv]]
+        self.assertEqual(raw_sigs, [s.decode('hex') for s in sigs])
+        self.assertEqual(rawtx.apply_multisignatures(raw, 1, script.decode('hex'), raw_sigs).hex(), apply_multisignatures(tx, 1, script, sigs))
+        self.assertFalse(raw.is_fully_signed())
+
+    def test_signing_context(self):
+        tx = mktx(self.inputs, self.outputs)
+        raw = rawtx.make_transaction(self.inputs, self.outputs)
+        context = rawtx.SigningContext(raw)
+        script = mk_multisig_script([self.fixtures.alice_pub, self.fixtures.bob_pub], 2).decode('hex')
+        # Out of order, and from a copy sent to another process, the hashes are the same as hashing the whole transaction.
+        for c in [context, pickle.loads(pickle.dumps(context, 2))]:
+            for i in [2, 0, 1]:
+                self.assertEqual(c.signature_hash(i, script), raw.signature_hash(i, script))
+
+        signed = rawtx.sign_inputs(raw, range(3), self.alice_priv)
+        for i in range(3):
+            tx = sign(tx, i, self.alice_priv)
+            raw = rawtx.sign(raw, i, self.alice_priv, context)
+        self.assertEqual(raw.hex(), tx)
+        self.assertEqual(signed.hex(), tx)
+        self.assertEqual(signed.inputs, rawtx.RawTransaction(signed.data).inputs)
+        self.assertEqual(rawtx.multisign(signed, 1, script, self.bob_priv, context), rawtx.multisign(signed, 1, script, self.bob_priv))
+
+    def test_matches(self):
+        raw = rawtx.make_transaction(self.inputs, self.outputs)
+        signed = rawtx.sign(raw, 0, self.alice_priv)
+        self.assertTrue(signed.matches(raw))
+        self.assertFalse(signed.matches(rawtx.make_transaction(self.inputs, self.outputs[:1])))
+        self.assertFalse(signed.matches(rawtx.make_transaction(self.inputs[:2], self.outputs)))
+        self.assertFalse(signed.matches(rawtx.make_transaction(list(reversed(self.inputs)), self.outputs)))
+
+        self.assertRaises(Exception, rawtx.RawTransaction, raw.data[:-1])
+        self.assertRaises(Exception, rawtx.RawTransaction, raw.data + '\x00')
+        self.assertRaises(Exception, rawtx.RawTransaction.from_hex, 'not hex')
+
+class VerifyTestCase(TestCase):
+
+    fixtures = RealityKeysDemoTestCast
+
+    def setUp(self):
+        self.setup_tx = rawtx.RawTransaction.from_hex(self.fixtures.normal_claimable_tx_yes_wins)
+        self.scripts = [address_to_script(pubtoaddr(pub, 111)).decode('hex') for pub in [self.fixtures.alice_pub, self.fixtures.bob_pub]]
+
+    def claim(self, ecc_voodoo, seed):
+        settings = {'testnet': True, 'no_pushtx': True, 'facts': decided_facts(), 'ecc_voodoo': ecc_voodoo}
+        tx = None
+        for s in [self.fixtures.alice_seed, self.fixtures.bob_seed]:
+            tx = realitykeysdemo.execute_setup(dict(settings, seed=s, inputs=self.fixtures.normal_inputs_yes_wins), '101', self.fixtures.alice_pub, 90000, self.fixtures.bob_pub, 90000, tx).transaction
+        return realitykeysdemo.execute_claim(dict(settings, seed=seed, inputs=[':' + txhash(tx) + ':0:180000']), '101', self.fixtures.alice_pub, self.fixtures.bob_pub, 10000)
+
+    def test_pay_to_pubkey_hash(self):
+        for name in sorted(ecbackend.BACKENDS.keys()):
+            try:
+                backend = ecbackend.get_backend(name)
+            except ImportError:
+                continue
+            verifier = verify.Verifier(backend)
+            self.assertTrue(verifier.verify(self.setup_tx, self.scripts))
+            # Each input is only good for the address it was paid to.
+            self.assertFalse(verifier.is_valid(self.setup_tx, 0, self.scripts[1]))
+            with self.assertRaisesRegexp(verify.ScriptError, "Input 0"):
+                verifier.verify(self.setup_tx, list(reversed(self.scripts)))
+            # Anything else about the transaction changing breaks the signatures.
+            changed = rawtx.RawTransaction(self.setup_tx.data[:-4] + '\x01\x00\x00\x00')
+            self.assertFalse(verifier.is_valid(changed, 0, self.scripts[0]))
+            self.assertFalse(verifier.is_valid(self.setup_tx.with_script(1, ''), 1, self.scripts[1]))
+
+    def test_caches(self):
+        verifier = verify.Verifier(ecbackend.get_backend())
+        half_signed = self.setup_tx.with_script(1, '')
+        self.assertTrue(verifier.verify(half_signed, [self.scripts[0], None]))
+        self.assertEqual((len(verifier.sighashes), len(verifier.signatures)), (1, 1))
+        # The completed transaction shares the half-signed one's entry for the first input, so only the second is new.
+        self.assertTrue(verifier.verify(self.setup_tx, self.scripts))
+        self.assertEqual((len(verifier.sighashes), len(verifier.signatures)), (2, 2))
+
+    def test_claims(self):
+        verifier = verify.Verifier(ecbackend.get_backend())
+        for ecc_voodoo in [False, True]:
+            claim = self.claim(ecc_voodoo, self.fixtures.alice_seed)
+            tx = rawtx.RawTransaction.from_hex(claim.transaction)
+            script = address_to_script(claim.p2sh_address).decode('hex')
+            self.assertTrue(verifier.verify(tx, [script]))
+            # Sending the winnings somewhere else invalidates the signatures.
+            self.assertFalse(verifier.is_valid(rawtx.RawTransaction(tx.data[:tx.outputs_start + 1] + '\x00' + tx.data[tx.outputs_start + 2:]), 0, script))
+        # Bob lost, so although he can make a claim, it doesn't satisfy the script.
+        claim = self.claim(False, self.fixtures.bob_seed)
+        self.assertFalse(verifier.is_valid(rawtx.RawTransaction.from_hex(claim.transaction), 0, address_to_script(claim.p2sh_address).decode('hex')))
+
+    def test_numbers(self):
+        for n in [0, 1, -1, 16, 127, 128, -128, 255, 256, 2 ** 31 - 1]:
+            self.assertEqual(verify.decode_number(verify.encode_number(n)), n)
+        self.assertFalse(verify.cast_to_bool('\x00\x80'))
+        self.assertTrue(verify.cast_to_bool('\x00\x01'))
+
+class UTXOIndexTestCase(TestCase):
+
+    fixtures = RealityKeysDemoTestCast
+
+    def test_index(self):
+        index = utxoindex.UTXOIndex.from_inputs(['addr1:' + sha256('a') + ':0:5000', 'addr1:' + sha256('b') + ':1:3000', 'addr2:' + sha256('c') + ':0:5000', ':' + sha256('d') + ':0:4000'])
+        self.assertEqual(len(index), 4)
+        self.assertEqual([o['value'] for o in index.outputs('addr1')], [5000, 3000, 4000])
+        self.assertEqual(index.find('addr1', 3500)['value'], 4000)
+        self.assertEqual(index.find('addr1', 4500, 4900), None)
+        self.assertEqual(index.balance('addr2'), 9000)
+
+        self.assertEqual(index.remove(sha256('d') + ':0')['value'], 4000)
+        self.assertEqual(index.remove(sha256('d') + ':0'), None)
+        self.assertEqual(index.find('addr1', 3500)['value'], 5000)
+        self.assertEqual(index.outputs('addr3'), [])
+
+        # Each address is only fetched once.
+        fetched = []
+        def fetch(addr):
+            fetched.append(addr)
+            return [{'output': sha256(addr) + ':0', 'value': 1000}]
+        index = utxoindex.UTXOIndex(fetch)
+        self.assertEqual(index.balance('addr1'), 1000)
+        self.assertEqual(index.find('addr1', 1000)['output'], sha256('addr1') + ':0')
+        self.assertEqual(fetched, ['addr1'])
+
+    def test_inputs_file(self):
+        outputs = [('addr1', sha256('a'), 0, 5000), ('addr1', sha256('b'), 1, 3000), ('', sha256('c'), 2, 4000)]
+        contents = {
+            '.csv': "address,txid,vout,value\n" + "".join(["%s,%s,%d,%d\n" % o for o in outputs]),
+            '.jsonl': "".join([simplejson.dumps({'address': o[0], 'tx_hash': o[1], 'n': o[2], 'amount': o[3]}) + "\n" for o in outputs]),
+            '.txt': "".join(["%s:%s:%d:%d\n" % o for o in outputs]),
+        }
+        for suffix, content in contents.items():
+            for compressed in [False, True]:
+                fd, filename = tempfile.mkstemp(suffix + ('.gz' if compressed else ''))
+                os.close(fd)
+                try:
+                    f = gzip.open(filename, 'wb') if compressed else open(filename, 'w')
+                    f.write(content)
+                    f.close()
+                    self.assertEqual(list(utxoindex.read_inputs_file(filename)), outputs)
+                    index = utxoindex.UTXOIndex()
+                    self.assertEqual(utxoindex.load_inputs_file(index, filename), 3)
+                    self.assertEqual(index.outputs('addr1'), [{'output': sha256('a') + ':0', 'value': 5000, 'address': 'addr1'}, {'output': sha256('b') + ':1', 'value': 3000, 'address': 'addr1'}, {'output': sha256('c') + ':2', 'value': 4000, 'address': ''}])
+                    self.assertEqual(index.find('addr1', 3500)['value'], 4000)
+                finally:
+                    os.unlink(filename)
+
+        # A shared index is sent to worker processes by reference, not copied.
+        index.share()
+        self.assertTrue(pickle.loads(pickle.dumps(index, 2)) is index)
+        self.assertTrue(len(pickle.dumps(index, 2)) < 100)
+
+    def test_contract_lifecycle(self):
+        f = self.fixtures
+        source = standin.BlockSource()
+        index = utxoindex.UTXOIndex()
+        settings = {'testnet': True, 'no_pushtx': True, 'ecc_voodoo': False, 'facts': decided_facts(), 'inputs': index}
+
+        # Fund the temporary addresses from a block.
+        funding = mktx([{'output': sha256('coinbase') + ':0', 'value': 300000}], [{'address': f.alice_addr_testnet, 'value': 100000}, {'address': f.bob_addr_testnet, 'value': 100000}])
+        source.add_block([funding])
+        index.sync(source, 111)
+        self.assertEqual(index.balance(f.alice_addr_testnet), 100000)
+
+        settings['seed'] = f.alice_seed
+        tx = realitykeysdemo.execute_setup(settings, '101', f.alice_pub, 90000, f.bob_pub, 90000, None)[0]
+        # Nothing is spent until the transaction is complete.
+        self.assertEqual(len(index), 2)
+        settings['seed'] = f.bob_seed
+        tx = realitykeysdemo.execute_setup(settings, '101', f.alice_pub, 90000, f.bob_pub, 90000, tx)[0]
+        self.assertEqual(index.balance(f.alice_addr_testnet), 0)
+        self.assertEqual(len(index), 1)
+
+        # The claim finds the output the setup made, without being told about it.
+        settings['seed'] = f.alice_seed
+        claim_tx = realitykeysdemo.execute_claim(settings, '101', f.alice_pub, f.bob_pub, 10000)[0]
+        self.assertEqual(deserialize(claim_tx)['ins'][0]['outpoint']['hash'], txhash(tx))
+        self.assertEqual(index.balance(f.alice_addr_testnet), 170000)
+
+        # Seeing our own transactions again in a block changes nothing.
+        source.add_block([tx, claim_tx])
+        index.sync(source, 111)
+        self.assertEqual(index.balance(f.alice_addr_testnet), 170000)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.height, 2)
+
+class BroadcastTestCase(TestCase):
+
+    fixtures = RealityKeysDemoTestCast
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        self.servers = [standin.RPCServer().start(), standin.RPCServer().start()]
+        self.tx = mktx([{'output': sha256('coinbase') + ':0', 'value': 100000}], [{'address': self.fixtures.alice_addr_testnet, 'value': 90000}])
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        os.remove(self.filename)
+
+    def test_fallback_and_retry(self):
+        first, second = self.servers
+        url = first.url.replace('http://', 'http://user:secret@') + '/'
+        b = broadcast.Broadcaster([url, second.url], broadcast.BroadcastQueue(self.filename), 2, 2, 0.01).start()
+
+        # The first endpoint takes it, and sending it again does nothing.
+        self.assertTrue(b.broadcast(self.tx))
+        self.assertTrue(b.broadcast(self.tx))
+        self.assertEqual(first.mempool, [self.tx])
+
+        # If the first refuses, the second gets it.
+        first.fail = 1
+        tx2 = mktx([{'output': sha256('coinbase') + ':1', 'value': 100000}], [{'address': self.fixtures.alice_addr_testnet, 'value': 90000}])
+        self.assertTrue(b.broadcast(tx2))
+        self.assertEqual(second.mempool, [tx2])
+
+        # If both refuse, we try again later, until we run out of retries.
+        first.fail = 2
+        second.fail = 2
+        tx3 = mktx([{'output': sha256('coinbase') + ':2', 'value': 100000}], [{'address': self.fixtures.alice_addr_testnet, 'value': 90000}])
+        self.assertTrue(b.broadcast(tx3))
+        self.assertEqual(b.queue.get(txhash(tx3))['attempts'], 3)
+        first.fail = 10
+        second.fail = 10
+        tx4 = mktx([{'output': sha256('coinbase') + ':3', 'value': 100000}], [{'address': self.fixtures.alice_addr_testnet, 'value': 90000}])
+        self.assertFalse(b.broadcast(tx4))
+        b.stop()
+
+        stats = b.stats()
+        self.assertEqual(stats[first.url + '/']['accepted'], 2)
+        self.assertEqual(stats[first.url + '/']['refused'], 6)
+        self.assertEqual(stats[second.url + '/']['accepted'], 1)
+
+        # Transactions queued but not sent are picked up next time.
+        b = broadcast.Broadcaster([second.url], broadcast.BroadcastQueue(self.filename))
+        tx5 = mktx([{'output': sha256('coinbase') + ':4', 'value': 100000}], [{'address': self.fixtures.alice_addr_testnet, 'value': 90000}])
+        b.submit(tx5)
+        b.queue.close()
+        second.fail = 0
+        b = broadcast.Broadcaster([second.url], broadcast.BroadcastQueue(self.filename)).start()
+        b.wait()
+        self.assertEqual(b.status(txhash(tx5)), broadcast.SENT)
+        self.assertEqual(b.status(txhash(tx4)), broadcast.FAILED)
+        self.assertEqual(second.mempool[-1], tx5)
+        b.stop()
+
+    def test_one_shot(self):
+        # A command waiting on a single transaction is told it couldn't be sent after one retry, not after minutes of them.
+        self.servers[0].fail = 10
+        settings = {'broadcast_endpoints': [self.servers[0].url]}
+        b = realitykeysdemo.broadcaster(settings, True)
+        started = time.time()
+        self.assertFalse(b.broadcast(self.tx))
+        self.assertTrue(time.time() - started < broadcast.DEFAULT_BACKOFF)
+        self.assertEqual(b.queue.get(txhash(self.tx))['attempts'], broadcast.ONE_SHOT_RETRIES + 1)
+        b.stop()
+
+        # One that's already there, like the one a batch or the server starts, is used as it is.
+        self.assertTrue(realitykeysdemo.broadcaster(settings, True) is b)
+
+    def test_pay(self):
+        f = self.fixtures
+        index = utxoindex.UTXOIndex()
+        index.add(f.alice_addr_testnet, sha256('coinbase'), 0, 100000)
+        settings = {'testnet': True, 'seed': f.alice_seed, 'inputs': index, 'broadcast_endpoints': [self.servers[0].url]}
+        realitykeysdemo.execute_pay(settings, f.bob_addr_testnet, 50000, 10000)
+        settings['broadcaster'].stop()
+        self.assertEqual(len(self.servers[0].mempool), 1)
+        self.assertEqual(index.balance(f.bob_addr_testnet), 50000)
+
+class ServerTestCase(TestCase):
+
+    fixtures = RealityKeysDemoTestCast
+
+    def settings(self):
+        f = self.fixtures
+        index = utxoindex.UTXOIndex.from_inputs([f.alice_addr_testnet + ':' + sha256('alice') + ':0:100000', f.bob_addr_testnet + ':' + sha256('bob') + ':0:100000'])
+        return {'testnet': True, 'no_pushtx': True, 'seed': f.alice_seed, 'facts': decided_facts(), 'inputs': index}
+
+    def test_http(self):
+        f = self.fixtures
+        s = server.ContractServer(self.settings(), realitykeysdemo.RPC_METHODS, ('127.0.0.1', 0)).start()
+        transport = factclient.HTTPTransport()
+        def call(method, params, request_id=1):
+            return simplejson.loads(transport.post(s.url, simplejson.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': method, 'params': params})))
+
+        self.assertEqual(call('makekeys', [])['result'], {'command': 'makekeys', 'public_key': f.alice_pub, 'address': f.alice_addr_testnet, 'contract_id': None})
+        expected = realitykeysdemo.execute_setup(self.settings(), '101', f.alice_pub, 50000, f.bob_pub, 50000)
+        params = {'reality_key_id': '101', 'yes_winner_public_key': f.alice_pub, 'yes_stake_amount': 50000, 'no_winner_public_key': f.bob_pub, 'no_stake_amount': 50000}
+        self.assertEqual(call('setup', params)['result'], expected.as_dict())
+        self.assertEqual(call('setup', ['101', f.alice_pub, 50000, f.bob_pub, 50000, None])['result'], expected.as_dict())
+
+        self.assertEqual(call('setup', ['101', f.bob_pub, 50000, f.bob_pub, 50000])['error']['code'], server.COMMAND_ERROR)
+        self.assertEqual(call('setup', ['101'])['error']['code'], server.INVALID_PARAMS)
+        self.assertEqual(call('setup', {'stake': 1})['error']['code'], server.INVALID_PARAMS)
+        self.assertEqual(call('launch', [])['error']['code'], server.METHOD_NOT_FOUND)
+
+        # Batches of requests get a list of responses, leaving out notifications.
+        body = simplejson.dumps([{'jsonrpc': '2.0', 'id': 1, 'method': 'makekeys'}, {'jsonrpc': '2.0', 'method': 'makekeys'}, {'jsonrpc': '2.0', 'id': 2, 'method': 'setup_batch', 'params': [[{'reality_key_id': 101, 'yes_key': f.alice_pub, 'yes_stake': 50000, 'no_key': f.bob_pub, 'no_stake': 50000}]]}])
+        responses = simplejson.loads(transport.post(s.url, body))
+        self.assertEqual([r['id'] for r in responses], [1, 2])
+        self.assertEqual(responses[1]['result'][0]['transaction'], expected.transaction)
+        self.assertEqual(s.calls, 7)
+        s.stop()
+
+    def test_token(self):
+        # Anyone who can reach the server can spend with it, so it won't listen beyond this machine without a token.
+        self.assertRaises(Exception, server.ContractServer, self.settings(), realitykeysdemo.RPC_METHODS, ('0.0.0.0', 0))
+
+        s = server.ContractServer(self.settings(), realitykeysdemo.RPC_METHODS, ('0.0.0.0', 0), token='secret').start()
+        url = 'http://127.0.0.1:%d/' % (s.address[1])
+        transport = factclient.HTTPTransport()
+        body = simplejson.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'makekeys', 'params': []})
+        try:
+            for headers in [None, {'Authorization': 'Bearer wrong'}]:
+                try:
+                    transport.post(url, body, headers)
+                    self.fail("The request should have been refused.")
+                except factclient.HTTPError as e:
+                    self.assertEqual(e.status, 401)
+            response = simplejson.loads(transport.post(url, body, {'Authorization': 'Bearer secret'}))
+            self.assertEqual(response['result']['public_key'], self.fixtures.alice_pub)
+            self.assertEqual(s.calls, 1)
+        finally:
+            s.stop()
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'realitykeysdemo.sock')
+        s = server.ContractServer(self.settings(), realitykeysdemo.RPC_METHODS, path).start()
+        body = simplejson.dumps({'jsonrpc': '2.0', 'id': 'a', 'method': 'makekeys', 'params': []})
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall("POST / HTTP/1.0\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        response = ''
+        while True:
+            data = sock.recv(4096)
+            if not data:
+                break
+            response = response + data
+        sock.close()
+        s.stop()
+        self.assertEqual(simplejson.loads(response.split("\r\n\r\n", 1)[1])['result']['public_key'], self.fixtures.alice_pub)
+        self.assertFalse(os.path.exists(path))
+        os.rmdir(os.path.dirname(path))
+
+class ProfilerTestCase(TestCase):
+
+    def test_nested_stages(self):
+        now = [0.0]
+        profiler = instrument.Profiler(lambda: now[0])
+        with profiler.stage('script'):
+            now[0] = now[0] + 1
+            with profiler.stage('ec'):
+                now[0] = now[0] + 2
+        summary = profiler.summary()
+        self.assertEqual(summary['script']['seconds'], 3)
+        self.assertEqual(summary['script']['self_seconds'], 1)
+        self.assertEqual(summary['ec']['seconds'], 2)
+
+        # Without a profiler in the settings, stages do nothing.
+        with instrument.stage({}, 'ec'):
+            pass
+        with instrument.stage({'profiler': profiler}, 'ec'):
+            pass
+        self.assertEqual(profiler.summary()['ec']['calls'], 2)
+
+class FactStoreTestCase(TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_warm_restart(self):
+        store = factstore.FactStore(self.filename)
+        transport = StubTransport([FactClientTestCase.undecided, FactClientTestCase.decided])
+        client = factclient.FactClient('http://localhost/fact/%s/', transport, 0, 0, store)
+        client.fact(3, False)
+        client.fact(4)
+        store.put_compound_public_key('04aa', '02bb', '04cc')
+        store.close()
+
+        # After a restart, nothing we already knew needs fetching again.
+        store = factstore.FactStore(self.filename)
+        transport = StubTransport([])
+        client = factclient.FactClient('http://localhost/fact/%s/', transport, 0, 0, store)
+        self.assertEqual(client.fact(3, False)['yes_pubkey'], '02aa')
+        self.assertEqual(client.fact(4)['winner_privkey'], 'cc')
+        self.assertEqual(transport.requests, [])
+        self.assertEqual(store.winners(), {'4': 'Yes'})
+        self.assertEqual(store.compound_public_key('04aa', '02bb'), '04cc')
+        self.assertEqual(store.compound_public_key('04aa', '02dd'), None)
+        store.close()
+
+class LedgerTestCase(TestCase):
+
+    fixtures = RealityKeysDemoTestCast
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_contract_lifecycle(self):
+        f = self.fixtures
+        book = ledger.Ledger(self.filename)
+        settings = {'seed': f.alice_seed, 'testnet': True, 'no_pushtx': True, 'facts': decided_facts(), 'inputs': f.normal_inputs_yes_wins, 'ledger': book}
+        realitykeysdemo.execute_makekeys(settings)
+        half_signed = realitykeysdemo.execute_setup(settings, '101', f.alice_pub, 90000, f.bob_pub, 90000)
+        realitykeysdemo.execute_setup(settings, '102', f.alice_pub, 250000, f.bob_pub, 90000)
+        self.assertEqual(book.contract('101', f.alice_pub, f.bob_pub)['state'], 'half_signed')
+        self.assertEqual(book.contract('102', f.alice_pub, f.bob_pub)['state'], 'unfunded')
+        # Fact 101 was decided in Alice's favour, and she can't tell whether Bob has completed the transaction yet.
+        self.assertEqual([c['reality_key_id'] for c in book.claimable()], ['101'])
+
+        # Bob completes it, but he lost.
+        bob_settings = dict(settings, seed=f.bob_seed, ledger=ledger.Ledger())
+        complete = realitykeysdemo.execute_setup(bob_settings, '101', f.alice_pub, 90000, f.bob_pub, 90000, half_signed.transaction)
+        self.assertEqual(bob_settings['ledger'].contract('101', f.alice_pub, f.bob_pub)['state'], 'complete')
+        self.assertEqual(bob_settings['ledger'].contract('101', f.alice_pub, f.bob_pub)['funding_txid'], complete.txid)
+        self.assertEqual(bob_settings['ledger'].claimable(), [])
+
+        # A claim we don't send doesn't count, so the contract can still be claimed.
+        claim_settings = dict(settings, inputs=[':' + complete.txid + ':0:180000'])
+        realitykeysdemo.execute_claim(claim_settings, '101', f.alice_pub, f.bob_pub, 10000)
+        self.assertEqual(book.contract('101', f.alice_pub, f.bob_pub)['state'], 'half_signed')
+        self.assertEqual([c['reality_key_id'] for c in book.claimable()], ['101'])
+
+        server = standin.RPCServer().start()
+        try:
+            claim_settings.update({'no_pushtx': False, 'broadcast_endpoints': [server.url]})
+            claim = realitykeysdemo.execute_claim(claim_settings, '101', f.alice_pub, f.bob_pub, 10000)
+            claim_settings['broadcaster'].stop()
+        finally:
+            server.stop()
+        self.assertTrue(claim.broadcast)
+        self.assertEqual(book.contract('101', f.alice_pub, f.bob_pub)['claim_txid'], claim.txid)
+        self.assertEqual(book.claimable(), [])
+        book.close()
+
+        # Replaying the file gets us back to the same place.
+        replayed = ledger.Ledger(self.filename)
+        self.assertEqual(replayed.index.contracts, book.index.contracts)
+        self.assertEqual(replayed.index.winners, {'101': 'Yes'})
+        self.assertEqual(replayed.index.keys.keys(), [f.alice_pub])
+        self.assertEqual(replayed.claimable(), [])
+        replayed.close()
+
+    def test_resolution_after_funding(self):
+        index = ledger.LedgerIndex()
+        index.apply({'event': 'setup', 'reality_key_id': '7', 'yes_key': 'a', 'no_key': 'b', 'side': 'no', 'state': 'broadcast'})
+        # Running setup again for a contract that has already been broadcast doesn't take it back to half signed.
+        index.apply({'event': 'setup', 'reality_key_id': '7', 'yes_key': 'a', 'no_key': 'b', 'side': 'no', 'state': 'half_signed'})
+        self.assertEqual(index.contract(7, 'a', 'b')['state'], 'broadcast')
+        self.assertFalse(index.is_claimable(7, 'a', 'b'))
+        index.apply({'event': 'resolved', 'reality_key_id': '7', 'winner': 'No'})
+        self.assertTrue(index.is_claimable(7, 'a', 'b'))
+        index.apply({'event': 'claim', 'reality_key_id': '7', 'yes_key': 'a', 'no_key': 'b', 'state': 'claimed', 'txid': 'ff'})
+        self.assertEqual(index.claimable(), [])
+
+    def test_batched_sync(self):
+        book = ledger.Ledger(self.filename, sync_every=3, sync_interval=3600)
+        for i in range(2):
+            book.record('resolved', reality_key_id=i, winner='Yes')
+        # Still buffered.
+        self.assertEqual(list(ledger.read_records(self.filename)), [])
+        book.record('resolved', reality_key_id=2, winner='No')
+        self.assertEqual([r['reality_key_id'] for r in ledger.read_records(self.filename)], [0, 1, 2])
+        book.record_resolved(3, 'Yes')
+        book.record_resolved(3, 'Yes')
+        book.close()
+        self.assertEqual(len(list(ledger.read_records(self.filename))), 4)
+
+        # A record we crashed part way through writing is ignored, then cut off when we next write.
+        with open(self.filename, 'ab') as f:
+            f.write('{"event": "resol')
+        self.assertEqual(len(list(ledger.read_records(self.filename))), 4)
+        book = ledger.Ledger(self.filename)
+        book.record('resolved', reality_key_id=4, winner='No')
+        self.assertEqual(book.index.winners, {'0': 'Yes', '1': 'Yes', '2': 'No', '3': 'Yes', '4': 'No'})
+        book.close()
+        self.assertEqual(len(list(ledger.read_records(self.filename))), 5)
+
+    def test_open_ledger(self):
+        # Only the commands that record what they do open the ledger, so the rest don't leave a file behind.
+        filename = self.filename + '-new'
+        self.assertEqual(realitykeysdemo.open_ledger('broadcast', filename), None)
+        self.assertEqual(realitykeysdemo.open_ledger('setup', filename, True), None)
+        self.assertFalse(os.path.exists(filename))
+        try:
+            book = realitykeysdemo.open_ledger('setup', filename)
+            book.record('resolved', reality_key_id=4, winner='No')
+            book.close()
+            self.assertTrue(os.path.exists(filename))
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+class FeesTestCase(TestCase):
+
+    fixtures = RealityKeysDemoTestCast
+
+    def test_script_sizes(self):
+        f = self.fixtures
+        reality_key = f.facts['3']['yes_pubkey']
+        key_sizes = [fees.public_key_size(k) for k in [f.alice_pub, reality_key]]
+        self.assertEqual(fees.multisig_script_size(key_sizes), len(mk_multisig_script([f.alice_pub, reality_key], 2, 2)) / 2)
+        script = realitykeysdemo.mk_multisig_script_if_else([[f.alice_pub, reality_key], [f.bob_pub, reality_key]])
+        self.assertEqual(fees.if_else_script_size([key_sizes, key_sizes]), len(script) / 2)
+
+    def test_claim_sizes(self):
+        f = self.fixtures
+        engine = fees.FeeEngine()
+        # The claims we made before are no bigger than we estimate, and only short by the bytes the signatures came out shorter.
+        for tx, ecc_voodoo in [(f.ecc_claim_tx, True), (f.normal_claim_tx_yes_wins, False), (f.normal_claim_tx_no_wins, False)]:
+            redeem_script = deserialize_script(deserialize(tx)['ins'][0]['script'])[-1]
+            estimate = engine.claim_size([(len(redeem_script) / 2, ecc_voodoo)], f.bob_addr_testnet)
+            self.assertTrue(0 <= estimate - len(tx) / 2 <= 2 * (2 if not ecc_voodoo else 1))
+        self.assertEqual(engine.claim_fee([(209, False)], f.bob_addr_testnet), 10000)
+
+        # Merging a hundred claims costs more than one, but much less than a hundred.
+        merged = engine.claim_fee([(209, False)] * 100, f.bob_addr_testnet)
+        self.assertEqual(merged, fees.fee_for_size(engine.claim_size([(209, False)] * 100, f.bob_addr_testnet), fees.DEFAULT_FEE_RATE))
+        self.assertTrue(10000 < merged < 100 * 10000)
+
+    def test_setup_fees(self):
+        # At the default rate, setup pays what it always has.
+        self.assertEqual(fees.FeeEngine().setup_fees(), (10000, 20000))
+        self.assertEqual(fees.FeeEngine(fees.FixedFeeRate(20000)).setup_fees(), (20000, 40000))
+        f = self.fixtures
+        # At three times the rate, outputs of 100000 can't pay stakes of 90000 and half the fee, but they can for stakes of 80000.
+        settings = {'seed': f.alice_seed, 'testnet': True, 'no_pushtx': True, 'facts': dict(f.facts), 'inputs': f.normal_inputs_yes_wins, 'fee_rate': '30000'}
+        self.assertEqual(realitykeysdemo.execute_setup(dict(settings), f.yes_fact_id, f.alice_pub, 90000, f.bob_pub, 90000).transaction, None)
+        half_signed = realitykeysdemo.execute_setup(dict(settings), f.yes_fact_id, f.alice_pub, 80000, f.bob_pub, 80000)
+        self.assertEqual([o['value'] for o in deserialize(half_signed.transaction)['outs']], [160000])
+
+    def test_setup_fees_many_inputs(self):
+        # Alice funds her stake from a dozen small outputs, which takes the transaction well past 1000 bytes, so it has to pay more.
+        f = self.fixtures
+        inputs = [f.alice_addr_testnet + ':' + sha256('small-%d' % i) + ':0:10000' for i in range(12)] + [f.normal_inputs_yes_wins[0]]
+        settings = {'seed': f.alice_seed, 'testnet': True, 'no_pushtx': True, 'facts': dict(f.facts), 'inputs': inputs}
+        half_signed = realitykeysdemo.execute_setup(dict(settings), f.yes_fact_id, f.alice_pub, 80000, f.bob_pub, 80000)
+        complete = realitykeysdemo.execute_setup(dict(settings, seed=f.bob_seed), f.yes_fact_id, f.alice_pub, 80000, f.bob_pub, 80000, half_signed.transaction)
+        self.assertTrue(complete.complete)
+        tx = deserialize(complete.transaction)
+        spent = sum([int(i.split(':')[3]) for i in inputs if i.split(':')[1] in [inp['outpoint']['hash'] for inp in tx['ins']]])
+        paid = spent - sum([o['value'] for o in tx['outs']])
+        self.assertTrue(len(complete.transaction) / 2 > 1000)
+        self.assertTrue(paid >= fees.fee_for_size(len(complete.transaction) / 2, fees.DEFAULT_FEE_RATE))
+
+    def test_fee_rates(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            rate = fees.make_fee_rate(filename)
+            self.assertEqual(rate.satoshis_per_kb(), fees.DEFAULT_FEE_RATE)
+            with open(filename, 'w') as f:
+                f.write('25000\n')
+            os.utime(filename, (0, 0))
+            self.assertEqual(rate.satoshis_per_kb(), 25000)
+            # A directory where the file should be can't be read, so we use the default.
+            os.remove(filename)
+            os.mkdir(filename)
+            self.assertEqual(rate.satoshis_per_kb(), fees.DEFAULT_FEE_RATE)
+            os.rmdir(filename)
+            self.assertEqual(rate.satoshis_per_kb(), fees.DEFAULT_FEE_RATE)
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        self.assertEqual(fees.make_fee_rate('15000').satoshis_per_kb(), 15000)
+        server = standin.RPCServer().start()
+        try:
+            rate = fees.make_fee_rate(server.url)
+            # Until bitcoind has an estimate, we use the default.
+            self.assertEqual(rate.satoshis_per_kb(), fees.DEFAULT_FEE_RATE)
+            server.fee_rate = 0.00021
+            self.assertEqual(rate.satoshis_per_kb(), 21000)
+        finally:
+            server.stop()
+        # Nor if we can't reach it.
+        self.assertEqual(fees.BitcoindFeeRate('http://127.0.0.1:1/').satoshis_per_kb(), fees.DEFAULT_FEE_RATE)
+
+class WatcherTestCase(TestCase):
+
+    def test_poll_interval(self):
+        deadline = 1399939200
+        fact_json = {'settlement_date': '2014-05-13'}
+        self.assertEqual(watcher.settlement_time(fact_json), deadline)
+        self.assertEqual(watcher.poll_interval(fact_json, deadline + 100, 30, 3600), 30)
+        self.assertEqual(watcher.poll_interval(fact_json, deadline - 4000, 30, 3600), 1000)
+        self.assertEqual(watcher.poll_interval(fact_json, deadline - 100000, 30, 3600), 3600)
+        self.assertEqual(watcher.poll_interval({}, deadline, 30, 3600), 3600)
+
+    def test_claims_on_resolution(self):
+        clock = [1000]
+        def sleep(seconds):
+            clock[0] = clock[0] + seconds
+
+        polls = []
+        def fetch(settings, reality_key_id):
+            polls.append((clock[0], reality_key_id))
+            if reality_key_id == '3' and len(polls) > 2:
+                return FactClientTestCase.decided
+            return FactClientTestCase.undecided
+
+        claimed = []
+        def claim(settings, contracts):
+            claimed.append((clock[0], contracts))
+            return [{'reality_key_id': c['reality_key_id']} for c in contracts]
+
+        w = watcher.Watcher({}, fetch, claim, 2, 30, 60, lambda: clock[0], sleep)
+        w.add({'reality_key_id': 3, 'yes_key': 'a'})
+        w.add({'reality_key_id': 3, 'yes_key': 'b'})
+        w.add({'reality_key_id': 4, 'yes_key': 'c'})
+        self.assertEqual(w.pending(), 3)
+
+        results = []
+        pool = watcher.ThreadPool(2)
+        for i in range(3):
+            sleep(60)
+            results.extend(w.run_once(pool))
+        pool.terminate()
+
+        # Each fact is polled once per round, however many contracts depend on it.
+        self.assertEqual(len(polls), 5)
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(len(claimed[0][1]), 2)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(w.pending(), 1)
+
+    def test_claims_on_event(self):
+        clock = [1000]
+        def sleep(seconds):
+            clock[0] = clock[0] + seconds
+
+        class Events(object):
+            subscribed = False
+            polls = 0
+            def subscribe(self):
+                self.subscribed = True
+            def poll(self, timeout):
+                # Nothing happens for a while, then fact 4 is resolved, along with one we aren't watching, then fact 3.
+                self.polls = self.polls + 1
+                sleep(50)
+                return [[], [('5', FactClientTestCase.decided), ('4', FactClientTestCase.decided)], [('3', FactClientTestCase.decided)]][self.polls - 1]
+
+        polls = []
+        def fetch(settings, reality_key_id):
+            polls.append((clock[0], reality_key_id))
+            return FactClientTestCase.undecided
+
+        claimed = []
+        def claim(settings, contracts):
+            claimed.append(contracts[0]['reality_key_id'])
+            return [{'reality_key_id': c['reality_key_id']} for c in contracts]
+
+        events = Events()
+        w = watcher.Watcher({}, fetch, claim, 2, 30, 3600, lambda: clock[0], sleep, events)
+        w.add({'reality_key_id': 3, 'yes_key': 'a'})
+        w.add({'reality_key_id': 4, 'yes_key': 'b'})
+        results = list(w.run())
+
+        self.assertTrue(events.subscribed)
+        # Each fact was polled once at the start, then we waited for the events rather than polling again.
+        self.assertEqual(sorted(polls), [(1000, '3'), (1000, '4')])
+        self.assertEqual(claimed, [4, 3])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(w.pending(), 0)
+
+    def test_retries_failed_claims(self):
+        clock = [1000]
+        def sleep(seconds):
+            clock[0] = clock[0] + seconds
+
+        def fetch(settings, reality_key_id):
+            return FactClientTestCase.decided
+
+        # a fails once then works, b never works, and c isn't ours so there's no point trying it again.
+        claimed = []
+        def claim(settings, contracts):
+            claimed.append((clock[0], sorted([c['yes_key'] for c in contracts])))
+            results = []
+            for c in contracts:
+                result = {'reality_key_id': str(c['reality_key_id']), 'yes_key': c['yes_key'], 'no_key': c['no_key']}
+                if c['yes_key'] == 'a' and len(claimed) > 1:
+                    result['transaction'] = 'tx'
+                elif c['yes_key'] == 'c':
+                    result.update({'error': "Not ours.", 'status': 'not_ours'})
+                else:
+                    result.update({'error': "Not funded yet.", 'status': 'unfunded'})
+                results.append(result)
+            return results
+
+        w = watcher.Watcher({}, fetch, claim, 2, 30, 3600, lambda: clock[0], sleep, max_attempts=3)
+        for key in ['a', 'b', 'c']:
+            w.add({'reality_key_id': 3, 'yes_key': key, 'no_key': 'z'})
+        results = list(w.run())
+
+        # Each retry waits twice as long as the one before, and b is given up on after its third try.
+        self.assertEqual(claimed, [(1000, ['a', 'b', 'c']), (1030, ['a', 'b']), (1090, ['b'])])
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len([r for r in results if 'transaction' in r]), 1)
+        self.assertEqual(w.pending(), 0)
 
 def main():
     unittest.main() 
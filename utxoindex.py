@@ -0,0 +1,437 @@
+#!/usr/bin/python
+
+# A local index of unspent outputs, so realitykeysdemo.py doesn't have to re-parse its --inputs, or ask blockchain.info, every time it needs an output.
+#
+# Outputs are indexed by outpoint (txid:n), and by address, sorted by value, so we can find one in a range of values with bisect.
+# The index can be filled from "address:txid:n:amount" strings like the ones given with --inputs, from a fetch function like pybitcointools unspent(),
+# which is called at most once for each address, or from a source of blocks, like standin.BlockSource.
+# As we make our own transactions, apply_transaction removes the outputs they spend and adds the ones they create,
+# so later commands in the same run see them without fetching anything.
+#
+# Large UTXO dumps can be loaded with load_inputs_file, as used by --inputs-file. It reads one row at a time,
+# and each output is kept as a small UTXO record with a binary outpoint rather than a dictionary of strings,
+# so millions of outputs fit in a few hundred megabytes.
+
+import csv
+import gzip
+import struct
+import threading
+from bisect import bisect_left
+
+import simplejson
+
+from pybitcointools import bin_to_b58check, hex_to_b58check
+
+from coinselect import CoinSelector
+from rawtx import RawTransaction
+
+def output_address(script, magic_byte=0):
+    """Return the address an output script pays to, or None if it isn't one we understand.
+
+    P2SH addresses are made with the mainnet version byte, whatever the network, like p2sh_scriptaddr does by default,
+    so they match the addresses realitykeysdemo.py makes for contracts.
+    """
+    if len(script) == 50 and script.startswith('76a914') and script.endswith('88ac'):
+        return bin_to_b58check(script[6:-4].decode('hex'), magic_byte)
+    if len(script) == 46 and script.startswith('a914') and script.endswith('87'):
+        return hex_to_b58check(script[4:-2], 5)
+    return None
+
+def parse_input(input_string):
+    """Parse an "address:txid:n:amount" string, as given with --inputs, into an output dictionary like unspent() returns.
+
+    The address may be empty, meaning the output can be used for any address.
+    """
+    parts = input_string.split(":")
+    return {
+        'output': parts[1] + ':' + str(int(parts[2])),
+        'value': int(parts[3]),
+        'address': parts[0]
+    }
+
+def outpoint_key(txid, n):
+    """Pack a txid in hex and an output number into the 36 bytes we index outpoints by.
+    """
+    return txid.decode('hex') + struct.pack('<I', int(n))
+
+def outpoint_string(key):
+    """Turn a key made by outpoint_key back into the "txid:n" form used by unspent() and mktx.
+    """
+    return key[:32].encode('hex') + ':' + str(struct.unpack('<I', key[32:])[0])
+
+class UTXO(object):
+    """An unspent output, kept as small as we can, as there may be millions of them.
+    """
+
+    __slots__ = ('key', 'value', 'address', 'sequence')
+
+    def __init__(self, key, value, address, sequence):
+        self.key = key
+        self.value = value
+        self.address = address
+        self.sequence = sequence
+
+    def __getstate__(self):
+        return (self.key, self.value, self.address, self.sequence)
+
+    def __setstate__(self, state):
+        self.key, self.value, self.address, self.sequence = state
+
+    @property
+    def outpoint(self):
+        return outpoint_string(self.key)
+
+    def as_dict(self):
+        """Return the output as a dictionary, like unspent() returns.
+        """
+        return {'output': self.outpoint, 'value': self.value, 'address': self.address}
+
+class _AddressOutputs(object):
+    """The outputs of one address, sorted by value, with the values in a list of their own for bisect.
+
+    Outputs of the same value are kept in the order they were added.
+    New outputs are added to the end, and the lists are only sorted again when they're next looked at,
+    so loading lots of outputs for the same address takes one sort rather than an insertion each.
+    """
+
+    __slots__ = ('values', 'utxos', 'dirty')
+
+    def __init__(self):
+        self.values = []
+        self.utxos = []
+        self.dirty = False
+
+    def __getstate__(self):
+        return (self.values, self.utxos, self.dirty)
+
+    def __setstate__(self, state):
+        self.values, self.utxos, self.dirty = state
+
+    def add(self, utxo):
+        if len(self.values) > 0 and utxo.value < self.values[-1]:
+            self.dirty = True
+        self.values.append(utxo.value)
+        self.utxos.append(utxo)
+
+    def sort(self):
+        if self.dirty:
+            self.utxos.sort(key=lambda u: (u.value, u.sequence))
+            self.values = [u.value for u in self.utxos]
+            self.dirty = False
+
+    def remove(self, utxo):
+        self.sort()
+        i = bisect_left(self.values, utxo.value)
+        while self.utxos[i] is not utxo:
+            i = i + 1
+        del self.values[i]
+        del self.utxos[i]
+
+# Indexes shared with worker processes: id -> index. See UTXOIndex.share.
+_shared = {}
+
+def _shared_index(index_id):
+    if index_id not in _shared:
+        raise Exception("The UTXO index wasn't shared before the worker processes were started.")
+    return _shared[index_id]
+
+class UTXOIndex(object):
+    """Unspent outputs, indexed by outpoint and by address.
+
+    If fetch is supplied, it is called with an address the first time we're asked about an address we don't know, and should return
+    its unspent outputs, like pybitcointools unspent(). Otherwise addresses we haven't been told about have no outputs.
+    Outputs with no address are treated as belonging to every address, as they are by unspent_outputs.
+    """
+
+    def __init__(self, fetch=None):
+        self.fetch = fetch
+        # The height of the last block applied by sync.
+        self.height = 0
+        # outpoint key -> UTXO
+        self._utxos = {}
+        # address -> _AddressOutputs
+        self._addresses = {}
+        self._sequence = 0
+        self._fetched = set()
+        self._selectors = {}
+        self._shared_id = None
+        self._lock = threading.RLock()
+
+    def share(self):
+        """Let worker processes forked after this is called use this index, without it being copied into every job sent to them.
+
+        Each worker gets its own copy when it's forked, so the outputs our transactions spend in a worker are not seen by the others.
+        Batches apply the transactions they make to the index in the main process as well, for the jobs after them.
+        """
+        self._shared_id = id(self)
+        _shared[self._shared_id] = self
+        return self
+
+    def __reduce_ex__(self, protocol):
+        if self._shared_id is not None:
+            return (_shared_index, (self._shared_id,))
+        return object.__reduce_ex__(self, protocol)
+
+    def __getstate__(self):
+        # Let the index be sent to another process, eg as part of the settings of a batch job. It gets its own copy.
+        state = dict(self.__dict__)
+        del state['_lock']
+        state['_selectors'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_inputs(cls, input_strings, fetch=None):
+        """Make an index from a list of "address:txid:n:amount" strings, as given with --inputs.
+        """
+        index = cls(fetch)
+        for input_string in input_strings:
+            index.add_output(parse_input(input_string))
+        return index
+
+    def __len__(self):
+        return len(self._utxos)
+
+    def __contains__(self, outpoint):
+        txid, n = outpoint.split(':')
+        return outpoint_key(txid, n) in self._utxos
+
+    def get(self, outpoint):
+        txid, n = outpoint.split(':')
+        utxo = self._utxos.get(outpoint_key(txid, n), None)
+        if utxo is None:
+            return None
+        return utxo.as_dict()
+
+    def add(self, address, txid, n, value):
+        """Add an unspent output. If we already have it, it is left as it is.
+        """
+        key = outpoint_key(txid, n)
+        with self._lock:
+            if key in self._utxos:
+                return
+            address = address or ''
+            outputs = self._addresses.get(address, None)
+            if outputs is None:
+                outputs = self._addresses[address] = _AddressOutputs()
+            else:
+                # Use the same string for every output of an address.
+                address = outputs.utxos[0].address
+            self._sequence = self._sequence + 1
+            utxo = UTXO(key, int(value), address, self._sequence)
+            self._utxos[key] = utxo
+            outputs.add(utxo)
+            self._changed(address)
+
+    def add_many(self, rows):
+        """Add outputs from an iterable of (address, txid, n, value), as yielded by read_inputs_file, returning how many there were.
+
+        This does the same as calling add for each one, but faster, for loading big UTXO dumps.
+        """
+        count = 0
+        utxos = self._utxos
+        addresses = self._addresses
+        pack = struct.Struct('<I').pack
+        with self._lock:
+            for address, txid, n, value in rows:
+                count = count + 1
+                key = txid.decode('hex') + pack(n)
+                if key in utxos:
+                    continue
+                outputs = addresses.get(address, None)
+                if outputs is None:
+                    outputs = addresses[address] = _AddressOutputs()
+                else:
+                    address = outputs.utxos[0].address
+                self._sequence = self._sequence + 1
+                utxo = UTXO(key, value, address, self._sequence)
+                utxos[key] = utxo
+                outputs.add(utxo)
+            self._selectors.clear()
+        return count
+
+    def add_output(self, output):
+        """Add an output given as a dictionary, like unspent() returns.
+        """
+        txid, n = output['output'].split(':')
+        self.add(output.get('address', ''), txid, n, output['value'])
+
+    def remove(self, outpoint):
+        """Remove an output, eg because it has been spent, returning it, or None if we didn't have it.
+        """
+        txid, n = outpoint.split(':')
+        with self._lock:
+            utxo = self._utxos.pop(outpoint_key(txid, n), None)
+            if utxo is None:
+                return None
+            outputs = self._addresses[utxo.address]
+            outputs.remove(utxo)
+            if len(outputs.utxos) == 0:
+                del self._addresses[utxo.address]
+            self._changed(utxo.address)
+            return utxo.as_dict()
+
+    def _changed(self, address):
+        # Outputs with no address belong to every address, so if they change, every address has.
+        if address == '':
+            self._selectors.clear()
+        else:
+            self._selectors.pop(address, None)
+
+    def _ensure_fetched(self, address):
+        if self.fetch is None or address in self._fetched or address == '':
+            return
+        outputs = self.fetch(address)
+        with self._lock:
+            self._fetched.add(address)
+            for o in outputs:
+                self.add_output({'output': o['output'], 'value': o['value'], 'address': o.get('address', address) or address})
+
+    def _utxos_for(self, address):
+        """Return the UTXOs for an address, including the ones with no address, sorted by value.
+        """
+        self._ensure_fetched(address)
+        outputs = self._addresses.get(address, None)
+        utxos = []
+        if outputs is not None:
+            outputs.sort()
+            utxos = outputs.utxos
+        if address != '' and '' in self._addresses:
+            # Outputs with no address count for every address.
+            utxos = sorted(utxos + self._addresses[''].utxos, key=lambda u: (u.value, u.sequence))
+        return utxos
+
+    def outputs(self, address):
+        """Return the unspent outputs for an address, as dictionaries like unspent() returns, in the order they were added.
+        """
+        with self._lock:
+            return [u.as_dict() for u in sorted(self._utxos_for(address), key=lambda u: u.sequence)]
+
+    def balance(self, address):
+        with self._lock:
+            return sum([u.value for u in self._utxos_for(address)])
+
+    def find(self, address, min_value, max_value=None):
+        """Return the smallest output for the address worth at least min_value, and no more than max_value if given, or None.
+        """
+        with self._lock:
+            self._ensure_fetched(address)
+            best = None
+            # Look in the address's own outputs, and the ones with no address, which belong to every address.
+            for a in set([address, '']):
+                outputs = self._addresses.get(a, None)
+                if outputs is None:
+                    continue
+                outputs.sort()
+                i = bisect_left(outputs.values, min_value)
+                if i == len(outputs.values):
+                    continue
+                utxo = outputs.utxos[i]
+                if best is None or (utxo.value, utxo.sequence) < (best.value, best.sequence):
+                    best = utxo
+            if best is None or (max_value is not None and best.value > max_value):
+                return None
+            return best.as_dict()
+
+    def selector(self, address):
+        """Return a coinselect.CoinSelector for the address's outputs, reusing it until they change.
+        """
+        with self._lock:
+            self._ensure_fetched(address)
+            selector = self._selectors.get(address, None)
+            if selector is None:
+                selector = CoinSelector(self.outputs(address))
+                self._selectors[address] = selector
+            return selector
+
+    def apply_transaction(self, tx, magic_byte=0):
+        """Update the index for a transaction: remove the outputs it spends, and add the ones it creates.
+
+        The transaction can be in hex, or a RawTransaction.
+        """
+        if not isinstance(tx, RawTransaction):
+            tx = RawTransaction.from_hex(tx)
+        with self._lock:
+            for i in range(len(tx.inputs)):
+                self.remove(tx.outpoint_string(i))
+            tx_id = tx.txid()
+            for i, (value, script) in enumerate(tx.outputs()):
+                address = output_address(script.encode('hex'), magic_byte)
+                if address is not None:
+                    self.add(address, tx_id, i, value)
+
+    def sync(self, source, magic_byte=0):
+        """Apply the transactions in any blocks we haven't seen yet from a block source, such as standin.BlockSource.
+        """
+        for height, transactions in source.blocks_since(self.height):
+            for tx in transactions:
+                self.apply_transaction(tx, magic_byte)
+            self.height = height
+
+# The names we accept for each field in the header of a CSV file, or the keys of a JSONL object.
+INPUT_FIELDS = [
+    ('address', ['address', 'addr']),
+    ('txid', ['txid', 'tx_hash', 'hash']),
+    ('n', ['n', 'vout', 'tx_output_n', 'index']),
+    ('value', ['value', 'amount', 'satoshis']),
+]
+
+def read_inputs_file(filename):
+    """Read a UTXO dump one row at a time, yielding (address, txid, n, value) for each output.
+
+    Files ending in .csv are read as CSV with a header row, and .jsonl files as one JSON object per line,
+    with the fields named as in INPUT_FIELDS. Anything else is read as one "address:txid:n:amount" string per line, as given with --inputs.
+    Files ending in .gz are decompressed as they are read.
+    """
+    name = filename.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+        f = gzip.open(filename, 'rb')
+    else:
+        f = open(filename, 'r')
+
+    try:
+        if name.endswith('.csv'):
+            reader = csv.reader(f)
+            header = [h.strip().lower() for h in reader.next()]
+            columns = []
+            for field, names in INPUT_FIELDS:
+                found = [header.index(n) for n in names if n in header]
+                if len(found) == 0:
+                    raise Exception("The inputs file %s has no %s column." % (filename, field))
+                columns.append(found[0])
+            a, t, n, v = columns
+            for row in reader:
+                if len(row) == 0:
+                    continue
+                yield row[a] or '', row[t], int(row[n]), int(row[v])
+        elif name.endswith('.jsonl') or name.endswith('.json'):
+            for line in f:
+                line = line.strip()
+                if line == "":
+                    continue
+                obj = simplejson.loads(line)
+                values = []
+                for field, names in INPUT_FIELDS:
+                    found = [obj[n] for n in names if n in obj]
+                    if len(found) == 0:
+                        raise Exception("An output in the inputs file %s has no %s." % (filename, field))
+                    values.append(found[0])
+                yield values[0] or '', values[1], int(values[2]), int(values[3])
+        else:
+            for line in f:
+                line = line.strip()
+                if line == "":
+                    continue
+                parts = line.split(":")
+                yield parts[0] or '', parts[1], int(parts[2]), int(parts[3])
+    finally:
+        f.close()
+
+def load_inputs_file(index, filename):
+    """Add every output in a UTXO dump to the index, returning how many there were.
+    """
+    return index.add_many(read_inputs_file(filename))
@@ -0,0 +1,329 @@
+#!/usr/bin/python
+
+# Checking the signatures in transactions before we countersign or broadcast them, used by realitykeysdemo.py.
+#
+# Without this, a transaction with a bad signature from the other party, or a claim that doesn't satisfy the contract's script,
+# was only found out when the network refused it. A Verifier runs the scripts of each input itself, the way bitcoind does,
+# for the kinds of outputs realitykeysdemo.py spends: the temporary addresses, which are pay-to-pubkey-hash,
+# and the P2SH addresses of contracts, whose redeem scripts are made by mk_multisig_script_if_else or mk_multisig_script.
+# Only the opcodes those need are supported, and only SIGHASH_ALL signatures. Anything else fails to verify.
+#
+# Working out the hash a signature signs means serializing and hashing the whole transaction, so the hashes are cached.
+# The hash for an input only depends on the rest of the transaction without its input scripts, so the key is that, the input and the script,
+# and a half-signed transaction and the completed version of it share their entries.
+# Checking a signature is much slower again, so signatures found to be valid are remembered too, and the completed transaction
+# doesn't need the other party's signatures checking a second time.
+# The elliptic curve work is done by an ecbackend, which for thousands of transactions a second should be secp256k1.
+
+from pybitcointools import N, SIGHASH_ALL, bin_hash160
+
+from lrucache import LRUCache
+
+# How many signature hashes, and valid signatures, to remember.
+SIGHASH_CACHE_SIZE = 10000
+SIGNATURE_CACHE_SIZE = 10000
+
+OP_0 = 0
+OP_PUSHDATA1 = 76
+OP_PUSHDATA2 = 77
+OP_PUSHDATA4 = 78
+OP_1NEGATE = 79
+OP_1 = 81
+OP_16 = 96
+OP_IF = 99
+OP_NOTIF = 100
+OP_ELSE = 103
+OP_ENDIF = 104
+OP_VERIFY = 105
+OP_DUP = 118
+OP_EQUAL = 135
+OP_EQUALVERIFY = 136
+OP_HASH160 = 169
+OP_CHECKSIG = 172
+OP_CHECKSIGVERIFY = 173
+OP_CHECKMULTISIG = 174
+OP_CHECKMULTISIGVERIFY = 175
+
+MAX_PUBKEYS_PER_MULTISIG = 20
+
+class ScriptError(Exception):
+    pass
+
+def parse_script(script):
+    """Split a binary script into a list of (opcode, data) pairs, where data is what a push op pushes, or None for other ops.
+    """
+    ops = []
+    pos = 0
+    try:
+        while pos < len(script):
+            op = ord(script[pos])
+            pos = pos + 1
+            if op == OP_0:
+                ops.append((op, ''))
+                continue
+            if op < OP_PUSHDATA1:
+                length = op
+            elif op == OP_PUSHDATA1:
+                length = ord(script[pos])
+                pos = pos + 1
+            elif op == OP_PUSHDATA2:
+                length = ord(script[pos]) + (ord(script[pos + 1]) << 8)
+                pos = pos + 2
+            elif op == OP_PUSHDATA4:
+                length = ord(script[pos]) + (ord(script[pos + 1]) << 8) + (ord(script[pos + 2]) << 16) + (ord(script[pos + 3]) << 24)
+                pos = pos + 4
+            else:
+                ops.append((op, None))
+                continue
+            if pos + length > len(script):
+                raise ScriptError("Script push runs past the end of the script.")
+            ops.append((op, script[pos:pos + length]))
+            pos = pos + length
+    except IndexError:
+        raise ScriptError("Script ends in the middle of a push.")
+    return ops
+
+def cast_to_bool(value):
+    for i, c in enumerate(value):
+        if c != '\x00':
+            # Negative zero is false too.
+            return not (i == len(value) - 1 and c == '\x80')
+    return False
+
+def decode_number(value):
+    """Decode a number from the stack, which is little-endian with a sign bit.
+    """
+    if len(value) > 4:
+        raise ScriptError("Number on the stack is too big.")
+    if value == '':
+        return 0
+    n = 0
+    for i, c in enumerate(value):
+        n = n | (ord(c) << (8 * i))
+    if ord(value[-1]) & 0x80:
+        return -(n & ~(0x80 << (8 * (len(value) - 1))))
+    return n
+
+def encode_number(n):
+    if n == 0:
+        return ''
+    negative = n < 0
+    n = abs(n)
+    out = []
+    while n:
+        out.append(n & 0xff)
+        n = n >> 8
+    if out[-1] & 0x80:
+        out.append(0x80 if negative else 0)
+    elif negative:
+        out[-1] = out[-1] | 0x80
+    return ''.join([chr(c) for c in out])
+
+def decode_der_signature(sig):
+    """Return the r and s of a DER-encoded signature, without the hash type, or raise ScriptError if it isn't one.
+    """
+    if len(sig) < 8 or sig[0] != '\x30' or ord(sig[1]) != len(sig) - 2 or sig[2] != '\x02':
+        raise ScriptError("Signature is not DER encoded.")
+    rlen = ord(sig[3])
+    if 5 + rlen >= len(sig) or sig[4 + rlen] != '\x02':
+        raise ScriptError("Signature is not DER encoded.")
+    slen = ord(sig[5 + rlen])
+    if 6 + rlen + slen != len(sig):
+        raise ScriptError("Signature is not DER encoded.")
+    r = int(sig[4:4 + rlen].encode('hex') or '0', 16)
+    s = int(sig[6 + rlen:].encode('hex') or '0', 16)
+    if not (0 < r < N and 0 < s < N):
+        raise ScriptError("Signature values are out of range.")
+    return r, s
+
+class Verifier(object):
+    """Check the input scripts of transactions, as RawTransactions, against the scripts of the outputs they spend.
+
+    backend is an ecbackend backend to check signatures with.
+    """
+
+    def __init__(self, backend, sighash_cache_size=SIGHASH_CACHE_SIZE, signature_cache_size=SIGNATURE_CACHE_SIZE):
+        self.backend = backend
+        self.sighashes = LRUCache(sighash_cache_size)
+        self.signatures = LRUCache(signature_cache_size)
+
+    def verify(self, tx, output_scripts):
+        """Check every input of a transaction, given the binary scripts of the outputs they spend, in the same order.
+
+        Inputs with None for their output script are skipped, eg because they're someone else's and they haven't signed yet.
+        Raises ScriptError, saying which input failed, if any of them does.
+        """
+        unsigned = tx.unsigned()
+        for i, output_script in enumerate(output_scripts):
+            if output_script is not None:
+                try:
+                    self._verify_input(tx, unsigned, i, output_script)
+                except ScriptError as e:
+                    raise ScriptError("Input %d is not validly signed: %s" % (i, e))
+        return True
+
+    def verify_input(self, tx, i, output_script):
+        """Check input i of a transaction, given the binary script of the output it spends.
+        """
+        try:
+            return self._verify_input(tx, tx.unsigned(), i, output_script)
+        except ScriptError as e:
+            raise ScriptError("Input %d is not validly signed: %s" % (i, e))
+
+    def is_valid(self, tx, i, output_script):
+        try:
+            return self.verify_input(tx, i, output_script)
+        except ScriptError:
+            return False
+
+    def _verify_input(self, tx, unsigned, i, output_script):
+        input_ops = parse_script(tx.script(i))
+        for op, data in input_ops:
+            if data is None and not (op == OP_1NEGATE or OP_1 <= op <= OP_16):
+                raise ScriptError("Input script contains something other than pushes.")
+        stack = []
+        self._run(input_ops, stack, tx, unsigned, i, None)
+        p2sh_stack = list(stack)
+        self._run(parse_script(output_script), stack, tx, unsigned, i, output_script)
+        if len(stack) == 0 or not cast_to_bool(stack[-1]):
+            raise ScriptError("Script evaluated to false.")
+
+        if is_p2sh(output_script):
+            if len(p2sh_stack) == 0:
+                raise ScriptError("No redeem script.")
+            redeem_script = p2sh_stack.pop()
+            self._run(parse_script(redeem_script), p2sh_stack, tx, unsigned, i, redeem_script)
+            if len(p2sh_stack) == 0 or not cast_to_bool(p2sh_stack[-1]):
+                raise ScriptError("Redeem script evaluated to false.")
+        return True
+
+    def _run(self, ops, stack, tx, unsigned, i, script_code):
+        """Run the ops, as parsed from script_code, with the stack.
+        """
+        # Whether each IF we're inside is taking the branch we're in.
+        branches = []
+        for op, data in ops:
+            executing = all(branches)
+            if op in (OP_IF, OP_NOTIF):
+                value = False
+                if executing:
+                    value = cast_to_bool(self._pop(stack))
+                    if op == OP_NOTIF:
+                        value = not value
+                branches.append(value)
+                continue
+            if op == OP_ELSE:
+                if not branches:
+                    raise ScriptError("ELSE without IF.")
+                branches[-1] = not branches[-1]
+                continue
+            if op == OP_ENDIF:
+                if not branches:
+                    raise ScriptError("ENDIF without IF.")
+                branches.pop()
+                continue
+            if not executing:
+                continue
+
+            if data is not None:
+                stack.append(data)
+            elif op == OP_1NEGATE or OP_1 <= op <= OP_16:
+                stack.append(encode_number(op - OP_1 + 1))
+            elif op == OP_DUP:
+                stack.append(self._top(stack))
+            elif op == OP_HASH160:
+                stack.append(bin_hash160(self._pop(stack)))
+            elif op in (OP_EQUAL, OP_EQUALVERIFY):
+                equal = self._pop(stack) == self._pop(stack)
+                if op == OP_EQUALVERIFY:
+                    if not equal:
+                        raise ScriptError("EQUALVERIFY failed.")
+                else:
+                    stack.append('\x01' if equal else '')
+            elif op == OP_VERIFY:
+                if not cast_to_bool(self._pop(stack)):
+                    raise ScriptError("VERIFY failed.")
+            elif op in (OP_CHECKSIG, OP_CHECKSIGVERIFY):
+                pub = self._pop(stack)
+                sig = self._pop(stack)
+                valid = self.check_signature(tx, unsigned, i, script_code, sig, pub)
+                if op == OP_CHECKSIGVERIFY:
+                    if not valid:
+                        raise ScriptError("CHECKSIGVERIFY failed.")
+                else:
+                    stack.append('\x01' if valid else '')
+            elif op in (OP_CHECKMULTISIG, OP_CHECKMULTISIGVERIFY):
+                valid = self._check_multisig(stack, tx, unsigned, i, script_code)
+                if op == OP_CHECKMULTISIGVERIFY:
+                    if not valid:
+                        raise ScriptError("CHECKMULTISIGVERIFY failed.")
+                else:
+                    stack.append('\x01' if valid else '')
+            else:
+                raise ScriptError("Unsupported opcode %d." % (op))
+        if branches:
+            raise ScriptError("IF without ENDIF.")
+
+    def _check_multisig(self, stack, tx, unsigned, i, script_code):
+        n = decode_number(self._pop(stack))
+        if n < 0 or n > MAX_PUBKEYS_PER_MULTISIG:
+            raise ScriptError("Bad number of public keys for CHECKMULTISIG.")
+        pubs = [self._pop(stack) for j in range(n)]
+        m = decode_number(self._pop(stack))
+        if m < 0 or m > n:
+            raise ScriptError("Bad number of signatures for CHECKMULTISIG.")
+        sigs = [self._pop(stack) for j in range(m)]
+        # The extra item CHECKMULTISIG famously pops by mistake, which is why redeem scripts are spent with an OP_0 first.
+        self._pop(stack)
+        # The keys and signatures were popped in reverse, so this goes through them in order, like bitcoind does.
+        # Each signature has to match one of the keys after the one the previous signature matched.
+        while sigs:
+            if len(pubs) < len(sigs):
+                return False
+            if self.check_signature(tx, unsigned, i, script_code, sigs[-1], pubs[-1]):
+                sigs.pop()
+            pubs.pop()
+        return True
+
+    def check_signature(self, tx, unsigned, i, script_code, sig, pub):
+        """Return True if sig, with its hash type on the end, is a valid signature by pub of input i, signed as if it had script_code.
+        """
+        if len(sig) == 0 or ord(sig[-1]) != SIGHASH_ALL:
+            return False
+        try:
+            r, s = decode_der_signature(sig[:-1])
+        except ScriptError:
+            return False
+        sighash = self.signature_hash(tx, unsigned, i, script_code)
+        key = (sighash, sig, pub)
+        if self.signatures.get(key, False):
+            return True
+        try:
+            valid = self.backend.verify(sighash, r, s, pub)
+        except Exception:
+            # Not a public key at all.
+            valid = False
+        if valid:
+            self.signatures.put(key, True)
+        return valid
+
+    def signature_hash(self, tx, unsigned, i, script_code):
+        key = (unsigned, i, script_code)
+        sighash = self.sighashes.get(key, None)
+        if sighash is None:
+            sighash = tx.signature_hash(i, script_code)
+            self.sighashes.put(key, sighash)
+        return sighash
+
+    def _pop(self, stack):
+        if len(stack) == 0:
+            raise ScriptError("Tried to take from an empty stack.")
+        return stack.pop()
+
+    def _top(self, stack):
+        if len(stack) == 0:
+            raise ScriptError("Tried to take from an empty stack.")
+        return stack[-1]
+
+def is_p2sh(script):
+    return len(script) == 23 and script[0] == chr(OP_HASH160) and script[1] == '\x14' and script[22] == chr(OP_EQUAL)
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+# Watch the facts behind a set of contracts, and claim each contract as soon as its fact is resolved.
+# Used by the "watch" command of realitykeysdemo.py, so the winner doesn't have to keep running "claim" until it works.
+#
+# Each fact is only polled once however many contracts depend on it.
+# Facts are polled more often as their settlement date approaches, and less often while it's still a long way off.
+# Polling is done by a small, fixed pool of worker threads working from a schedule, not a thread per contract,
+# so a single process can keep track of tens of thousands of open contracts.
+# (This script targets Python 2, so it can't use asyncio for this.)
+#
+# If there's a stream of fact resolutions to follow, given as a factclient.FactEvents, the watcher waits on that between polls,
+# and claims the contracts on each fact as soon as it hears it's been resolved. Each fact is still polled once at the start,
+# in case it was resolved before we started listening, then only every max_interval, in case an event goes astray.
+#
+# A claim can fail for reasons that pass, like the contract not having been funded yet, or the network being down.
+# So when a contract's claim fails, its fact goes back on the schedule, to be claimed again after min_interval,
+# doubling each time it fails again, up to max_interval. We give up after MAX_CLAIM_ATTEMPTS tries,
+# or straight away if the failure is one that will never pass, like the contract not being ours.
+
+import time
+import heapq
+import calendar
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from factclient import is_resolved
+
+DEFAULT_WORKERS = 8
+MIN_POLL_INTERVAL = 30
+MAX_POLL_INTERVAL = 3600
+MAX_CLAIM_ATTEMPTS = 5
+
+# The statuses of claim results that will never be any different, so there's no point trying again.
+PERMANENT_STATUSES = ['not_ours']
+
+def contract_key(contract):
+    """Return what a contract is identified by in claim results: its fact and the public keys of the two sides.
+    """
+    return (str(contract['reality_key_id']), contract.get('yes_key', None), contract.get('no_key', None))
+
+def result_contracts(result):
+    """Return the keys of the contracts a claim result is for: the one it names, or each in its contracts if it's for a merged claim.
+    """
+    if 'contracts' in result:
+        return [contract_key(c) for c in result['contracts']]
+    return [contract_key(result)]
+
+def settlement_time(fact_json):
+    """Return the time the fact is due to be settled, as a Unix timestamp, or None if we can't tell.
+    """
+    for field in ['settlement_date', 'objection_period_settlement_date']:
+        value = fact_json.get(field, None)
+        if not value:
+            continue
+        for fmt, length in [('%Y-%m-%dT%H:%M:%S', 19), ('%Y-%m-%d %H:%M:%S', 19), ('%Y-%m-%d', 10)]:
+            try:
+                return calendar.timegm(time.strptime(value[:length], fmt))
+            except ValueError:
+                continue
+    return None
+
+def poll_interval(fact_json, now, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+    """Return how many seconds to wait before polling an unresolved fact again.
+
+    We poll a quarter of the remaining time before the settlement date, within the limits given,
+    so the closer we get the more often we check. Once the date has passed we poll as often as we're allowed.
+    """
+    deadline = settlement_time(fact_json)
+    if deadline is None:
+        return max_interval
+    interval = (deadline - now) / 4
+    return max(min_interval, min(max_interval, interval))
+
+class Watcher(object):
+    """Poll the facts behind a set of contracts, and claim the contracts whose facts have been resolved.
+
+    fetch is called with the settings and a reality_key_id, and should return the latest JSON for the fact, like realitykeysdemo.fetch_fact.
+    claim is called with the settings and a list of contracts on a resolved fact, and should return an iterable of results,
+    like realitykeysdemo.execute_claim_batch, each saying which contracts it's for, and with an error if the claim failed.
+    Failed claims are tried again up to max_attempts times in all.
+    events is a factclient.FactEvents to hear about resolutions from, if there is a stream of them to follow.
+    clock and sleep can be replaced to test the scheduling without waiting.
+    """
+
+    def __init__(self, settings, fetch, claim, workers=DEFAULT_WORKERS, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL, clock=time.time, sleep=time.sleep, events=None, max_attempts=MAX_CLAIM_ATTEMPTS):
+        self.settings = settings
+        self.fetch = fetch
+        self.claim = claim
+        self.events = events
+        self.max_attempts = max_attempts
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.clock = clock
+        self.sleep = sleep
+
+        # reality_key_id -> the contracts that depend on it
+        self._contracts = OrderedDict()
+        # (when to poll next, reality_key_id)
+        self._schedule = []
+        # contract_key -> the number of times claiming it has failed
+        self._attempts = {}
+
+    def add(self, contract):
+        """Start watching a contract. Its fact will be polled straight away.
+        """
+        reality_key_id = str(contract['reality_key_id'])
+        if reality_key_id not in self._contracts:
+            self._contracts[reality_key_id] = []
+            heapq.heappush(self._schedule, (self.clock(), reality_key_id))
+        self._contracts[reality_key_id].append(contract)
+
+    def pending(self):
+        """Return the number of contracts still waiting for their fact to be resolved.
+        """
+        return sum([len(c) for c in self._contracts.values()])
+
+    def _due(self, now):
+        due = []
+        while len(self._schedule) > 0 and self._schedule[0][0] <= now:
+            reality_key_id = heapq.heappop(self._schedule)[1]
+            # Facts we heard were resolved from an event have already been claimed, and a fact may be on the schedule twice.
+            if reality_key_id in self._contracts and reality_key_id not in due:
+                due.append(reality_key_id)
+        return due
+
+    def _poll(self, reality_key_id):
+        try:
+            return reality_key_id, self.fetch(self.settings, reality_key_id), None
+        except Exception as e:
+            return reality_key_id, None, e
+
+    def run_once(self, pool):
+        """Poll every fact that is due, claim the contracts on any that have been resolved, and reschedule the rest.
+
+        Yields the results of the claims.
+        """
+        now = self.clock()
+        due = self._due(now)
+        for reality_key_id, fact_json, error in pool.imap_unordered(self._poll, due):
+            if error is None and is_resolved(fact_json):
+                for result in self._claim(reality_key_id, now):
+                    yield result
+                continue
+
+            if error is None and self.events is not None:
+                interval = self.max_interval
+            elif error is None:
+                interval = poll_interval(fact_json, now, self.min_interval, self.max_interval)
+            else:
+                interval = self.min_interval
+            heapq.heappush(self._schedule, (now + interval, reality_key_id))
+
+    def listen(self, timeout):
+        """Wait up to timeout seconds for events, claiming the contracts on any facts they say have been resolved.
+
+        Yields the results of the claims. If the events can't be fetched, we wait out the time anyway and leave it to polling.
+        """
+        try:
+            resolved = self.events.poll(timeout)
+        except Exception:
+            self.sleep(timeout)
+            return
+        for reality_key_id, fact_json in resolved:
+            if reality_key_id in self._contracts and is_resolved(fact_json):
+                for result in self._claim(reality_key_id, self.clock()):
+                    yield result
+
+    def _claim(self, reality_key_id, now):
+        """Claim the contracts on a resolved fact, yielding the results, and put any that failed back on the schedule to try again.
+        """
+        contracts = self._contracts.pop(reality_key_id)
+        failed = set()
+        for result in self.claim(self.settings, contracts):
+            if 'error' in result and result.get('status', None) not in PERMANENT_STATUSES:
+                failed.update(result_contracts(result))
+            yield result
+
+        retry = []
+        attempts = 0
+        for contract in contracts:
+            key = contract_key(contract)
+            if key not in failed:
+                self._attempts.pop(key, None)
+                continue
+            self._attempts[key] = self._attempts.get(key, 0) + 1
+            if self._attempts[key] < self.max_attempts:
+                retry.append(contract)
+                attempts = max(attempts, self._attempts[key])
+            else:
+                del self._attempts[key]
+        if len(retry) > 0:
+            self._contracts.setdefault(reality_key_id, []).extend(retry)
+            interval = min(self.max_interval, self.min_interval * 2 ** (attempts - 1))
+            heapq.heappush(self._schedule, (now + interval, reality_key_id))
+
+    def run(self):
+        """Keep polling and claiming until every contract has been claimed, or we've given up on it, yielding the results of the claims.
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            if self.events is not None:
+                try:
+                    self.events.subscribe()
+                except Exception:
+                    # We can't follow the events, so we'll have to poll as if there weren't any.
+                    self.events = None
+            while len(self._contracts) > 0:
+                wait = self._schedule[0][0] - self.clock()
+                if wait > 0 and self.events is not None:
+                    for result in self.listen(wait):
+                        yield result
+                    continue
+                if wait > 0:
+                    self.sleep(wait)
+                for result in self.run_once(pool):
+                    yield result
+        finally:
+            pool.terminate()